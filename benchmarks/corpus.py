@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+Generate a deterministic synthetic Python corpus for benchmarking.
+
+Every function is built from a shape seed, which fixes its statements,
+and a name seed, which fixes its identifiers. A duplicate reuses the
+shape seed of an earlier function with fresh names, so it is a clone up
+to renaming, exactly what the hunter reports.
+
+    python benchmarks/corpus.py OUTPUT_DIR [--files 200] [--depth 3] [--duplication 0.2]
+"""
+
+import argparse
+import os
+import random
+from typing import Dict, List, NamedTuple
+
+_WORDS = (
+    "item", "value", "total", "count", "index", "result", "data", "node", "key",
+    "entry", "buffer", "offset", "limit", "size", "state", "record", "row", "name",
+)
+_OPERATORS = ("+", "-", "*", "//", "%")
+_COMPARISONS = ("<", ">", "==", "!=", "<=")
+_CALLS = ("len", "abs", "min", "max", "sorted", "list")
+
+
+class CorpusSpec(NamedTuple):
+    """Knobs of a generated corpus; equal specs always give equal files"""
+    files: int = 200
+    functions_per_file: int = 8
+    statements: int = 6       # statements per block
+    depth: int = 3            # deepest nesting of if/for/while/try blocks
+    duplication: float = 0.2  # share of functions that are renamed copies
+    seed: int = 0
+
+
+class _FunctionWriter:
+    """Writes one function; ``shape`` drives structure and ``names`` identifiers"""
+
+    def __init__(self, shape: random.Random, names: Dict[int, str], spec: CorpusSpec):
+        self.shape = shape
+        self.names = names
+        self.spec = spec
+        self.lines = []
+
+    def name(self) -> str:
+        return self.names[self.shape.randrange(len(self.names))]
+
+    def expression(self, depth: int = 0) -> str:
+        choice = self.shape.random()
+        if depth >= 2 or choice < 0.3:
+            return self.name() if self.shape.random() < 0.7 else str(self.shape.randrange(10))
+        if choice < 0.7:
+            operator = self.shape.choice(_OPERATORS)
+            return f"({self.expression(depth + 1)} {operator} {self.expression(depth + 1)})"
+        return f"{self.shape.choice(_CALLS)}({self.expression(depth + 1)})"
+
+    def condition(self) -> str:
+        return f"{self.expression(1)} {self.shape.choice(_COMPARISONS)} {self.expression(1)}"
+
+    def block(self, indent: int, depth: int) -> None:
+        pad = "    " * indent
+        for _ in range(self.shape.randint(1, self.spec.statements)):
+            choice = self.shape.random()
+            if depth < self.spec.depth and choice < 0.25:
+                kind = self.shape.choice(("if", "for", "while", "try"))
+                if kind == "if":
+                    self.lines.append(f"{pad}if {self.condition()}:")
+                elif kind == "for":
+                    self.lines.append(f"{pad}for {self.name()} in range({self.expression(1)}):")
+                elif kind == "while":
+                    self.lines.append(f"{pad}while {self.condition()}:")
+                else:
+                    self.lines.append(f"{pad}try:")
+                self.block(indent + 1, depth + 1)
+                if kind == "try":
+                    self.lines.append(f"{pad}except ValueError:")
+                    self.lines.append(f"{pad}    {self.name()} = None")
+                elif kind == "while":
+                    self.lines.append(f"{pad}    break")
+            elif choice < 0.8:
+                self.lines.append(f"{pad}{self.name()} = {self.expression()}")
+            else:
+                self.lines.append(f"{pad}{self.name()} += {self.expression()}")
+
+    def write(self, function_name: str) -> List[str]:
+        params = ", ".join(self.names[i] for i in range(3))
+        self.lines.append(f"def {function_name}({params}):")
+        for i in range(3, len(self.names)):
+            self.lines.append(f"    {self.names[i]} = {i}")
+        self.block(1, 0)
+        self.lines.append(f"    return {self.name()}")
+        return self.lines
+
+
+def _names(rng: random.Random, count: int) -> Dict[int, str]:
+    words = rng.sample(_WORDS, count)
+    return {i: f"{word}_{rng.randrange(100)}" for i, word in enumerate(words)}
+
+
+def generate_corpus(spec: CorpusSpec) -> Dict[str, str]:
+    """Return ``{relative path: source}`` for every file of the corpus"""
+    rng = random.Random(spec.seed)
+    shapes = []
+    files = {}
+    for file_number in range(spec.files):
+        lines = [f'"""Synthetic module {file_number}"""', ""]
+        for function_number in range(spec.functions_per_file):
+            if shapes and rng.random() < spec.duplication:
+                shape_seed = rng.choice(shapes)
+            else:
+                shape_seed = rng.randrange(2 ** 32)
+                shapes.append(shape_seed)
+            names = _names(random.Random(rng.randrange(2 ** 32)), 6)
+            writer = _FunctionWriter(random.Random(shape_seed), names, spec)
+            lines.extend(writer.write(f"function_{file_number}_{function_number}"))
+            lines.extend(["", ""])
+        # Spread files over a few packages so discovery has directories to walk
+        files[os.path.join(f"package_{file_number % 10}", f"module_{file_number}.py")] = \
+            "\n".join(lines)
+    return files
+
+
+def write_corpus(directory: str, spec: CorpusSpec) -> List[str]:
+    """Write the corpus under ``directory`` and return the file paths"""
+    paths = []
+    for relative, source in generate_corpus(spec).items():
+        path = os.path.join(directory, relative)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(source)
+        paths.append(path)
+    return paths
+
+
+def add_spec_arguments(parser: argparse.ArgumentParser) -> None:
+    defaults = CorpusSpec()
+    parser.add_argument('--files', type=int, default=defaults.files)
+    parser.add_argument('--functions-per-file', type=int, default=defaults.functions_per_file)
+    parser.add_argument('--statements', type=int, default=defaults.statements,
+                        help='Most statements per block')
+    parser.add_argument('--depth', type=int, default=defaults.depth,
+                        help='Deepest block nesting')
+    parser.add_argument('--duplication', type=float, default=defaults.duplication,
+                        help='Share of functions that are renamed copies (0-1)')
+    parser.add_argument('--seed', type=int, default=defaults.seed)
+
+
+def spec_from_args(args: argparse.Namespace) -> CorpusSpec:
+    return CorpusSpec(args.files, args.functions_per_file, args.statements, args.depth,
+                      args.duplication, args.seed)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('output', help='Directory to write the corpus to')
+    add_spec_arguments(parser)
+    args = parser.parse_args()
+    paths = write_corpus(args.output, spec_from_args(args))
+    print(f"Wrote {len(paths)} files to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+Compare the object-tree and flat-array fingerprint paths.
+
+Parses every file once, then times sizing, candidate selection and
+fingerprinting on the same trees with each representation.
+
+    python benchmarks/flat_tree.py [PATHS...]
+
+With no paths, the standard library is used as the corpus.
+"""
+
+import argparse
+import os
+import sys
+import sysconfig
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from python_repetition_hunter.repetition_hunter import (  # noqa: E402
+    _TRIVIAL_NODES,
+    _flat_records,
+    _preorder_nodes,
+    collect_python_files,
+    compute_fingerprints,
+    compute_subtree_sizes,
+    flatten_tree,
+    get_builtin_names,
+    parse_python_file,
+)
+
+
+def tree_path(trees, builtin_names, min_complexity):
+    count = 0
+    for filepath, tree in trees:
+        sizes = compute_subtree_sizes(tree)
+        candidates = [
+            node for node in _preorder_nodes(tree)
+            if not isinstance(node, _TRIVIAL_NODES) and sizes[node] >= min_complexity
+        ]
+        if candidates:
+            fingerprints = compute_fingerprints(tree, builtin_names)
+            count += len([fingerprints[node].hex() for node in candidates])
+    return count
+
+
+def flat_path(trees, builtin_names, min_complexity):
+    count = 0
+    for filepath, tree in trees:
+        count += len(_flat_records(filepath, flatten_tree(tree, builtin_names), min_complexity))
+    return count
+
+
+def best_of(repeat, func, *args):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('paths', nargs='*', help='Files or directories (default: stdlib)')
+    parser.add_argument('--min-complexity', type=int, default=4)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    files = collect_python_files(args.paths or [sysconfig.get_paths()['stdlib']])
+    trees = []
+    for filepath in files:
+        try:
+            trees.append((filepath, parse_python_file(filepath)))
+        except (SyntaxError, OSError, UnicodeDecodeError, ValueError, RecursionError):
+            continue
+
+    builtin_names = get_builtin_names()
+    tree_time, tree_count = best_of(args.repeat, tree_path, trees, builtin_names, args.min_complexity)
+    flat_time, flat_count = best_of(args.repeat, flat_path, trees, builtin_names, args.min_complexity)
+    assert tree_count == flat_count
+
+    print(f"{len(trees)} files, {tree_count} candidates")
+    print(f"tree: {tree_time:.3f}s")
+    print(f"flat: {flat_time:.3f}s ({tree_time / flat_time:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
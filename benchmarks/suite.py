@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+"""
+Time every phase of a scan on a synthetic corpus and report JSON.
+
+Generates a corpus (see ``corpus.py``), then for each engine runs discovery,
+``find_repetitions``, sorting and printing as the command line does. The
+phases ``find_repetitions`` reports through ``ScanStats`` are recorded with
+their wall and CPU time for the best of ``--repeat`` runs and, in a separate
+traced run, the peak traced memory during every phase (which includes
+whatever earlier phases still hold).
+
+``--breakdown`` also times parsing, candidate extraction, normalization and
+grouping separately, by running them one after the other from the module's
+internals; those figures are indicative only and may drift from what
+``find_repetitions`` does.
+
+    python benchmarks/suite.py [--engines flat,tree] [--files 200] [--output results.json]
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from corpus import add_spec_arguments, spec_from_args, write_corpus  # noqa: E402
+from python_repetition_hunter import __version__  # noqa: E402
+from python_repetition_hunter.repetition_hunter import (  # noqa: E402
+    ENGINES,
+    _TRIVIAL_NODES,
+    NodeResolver,
+    RepetitionIndex,
+    ScanStats,
+    _flat_records,
+    _group_results,
+    _node_record,
+    _preorder_with_parents,
+    collect_python_files,
+    compute_fingerprints,
+    compute_subtree_sizes,
+    drop_subsumed_groups,
+    find_repetitions,
+    flatten_tree,
+    get_builtin_names,
+    normalized_dump,
+    parse_python_file,
+    print_results,
+    sort_results,
+)
+
+BREAKDOWN_PHASES = ("discovery", "parse", "extraction", "normalization", "grouping", "sorting",
+                    "printing")
+
+
+def extract(engine, trees, builtin_names, min_complexity):
+    """Build each file's working representation and select its candidates"""
+    extracted = []
+    for filepath, tree in trees:
+        if engine == "flat":
+            # Candidate selection happens inside _flat_records, during normalization
+            extracted.append((filepath, tree, flatten_tree(tree, builtin_names), None))
+            continue
+        sizes = compute_subtree_sizes(tree)
+        nodes, parents = _preorder_with_parents(tree)
+        candidates = [
+            (index, node) for index, node in enumerate(nodes)
+            if not isinstance(node, _TRIVIAL_NODES) and sizes[node] >= min_complexity
+        ]
+        extracted.append((filepath, tree, (sizes, parents), candidates))
+    return extracted
+
+
+def normalize(engine, extracted, builtin_names, min_complexity):
+    """Turn candidates into NodeRecords carrying their generic forms"""
+    file_records = []
+    for filepath, tree, data, candidates in extracted:
+        if engine == "flat":
+            file_records.append((filepath, _flat_records(filepath, data, min_complexity)))
+            continue
+        sizes, parents = data
+        fingerprints = compute_fingerprints(tree, builtin_names) if engine == "tree" else None
+        records = []
+        for index, node in candidates:
+            if fingerprints is not None:
+                generic_form = fingerprints[node].hex()
+            else:
+                generic_form = normalized_dump(node, builtin_names)
+            records.append(_node_record(generic_form, filepath, node, sizes[node], index,
+                                        parents[index]))
+        file_records.append((filepath, records))
+    return file_records
+
+
+def group(engine, file_records, min_complexity, min_repetition):
+    index = RepetitionIndex(min_complexity, engine)
+    for filepath, records in file_records:
+        index._set_records(filepath, records)
+    groups, _ = drop_subsumed_groups(index._repeated_groups(min_complexity, min_repetition))
+    return _group_results(groups, NodeResolver())
+
+
+def render(results):
+    with contextlib.redirect_stdout(io.StringIO()) as output:
+        print_results(results)
+    return len(output.getvalue())
+
+
+def scan(engine, corpus_dir, min_complexity, min_repetition, hooks):
+    """Run one scan as ``main`` does, reporting its phases to ``hooks``"""
+    with hooks.phase("discovery"):
+        files = collect_python_files([corpus_dir])
+    results = find_repetitions(files, min_complexity, min_repetition, engine=engine, hooks=hooks)
+    with hooks.phase("sorting"):
+        ranked = sort_results(results)
+    with hooks.phase("printing"):
+        render(ranked)
+    return {"files": len(files), "results": len(results)}
+
+
+def time_engine(engine, corpus_dir, min_complexity, min_repetition, repeat):
+    """Phase times and counters of the fastest of ``repeat`` scans"""
+    best = None
+    for _ in range(repeat):
+        stats = ScanStats()
+        wall, cpu = time.perf_counter(), time.process_time()
+        counts = scan(engine, corpus_dir, min_complexity, min_repetition, stats)
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+        if best is None or wall < best[0]:
+            report = stats.as_dict()
+            counts["nodes"] = report["counters"]["candidates"]
+            best = (wall, cpu, report["phases"], counts)
+    wall, cpu, phases, counts = best
+    return phases, {"wall": round(wall, 6), "cpu": round(cpu, 6)}, counts
+
+
+class PeakMemory(ScanStats):
+    """Records the peak traced memory of every phase"""
+
+    def __init__(self):
+        super().__init__()
+        self.peaks = {}
+
+    def phase_started(self, name):
+        tracemalloc.reset_peak()
+
+    def phase_finished(self, name, wall, cpu):
+        self.peaks[name] = tracemalloc.get_traced_memory()[1]
+
+
+def trace_engine(engine, corpus_dir, min_complexity, min_repetition):
+    hooks = PeakMemory()
+    tracemalloc.start()
+    try:
+        scan(engine, corpus_dir, min_complexity, min_repetition, hooks)
+    finally:
+        tracemalloc.stop()
+    return hooks.peaks
+
+
+def run_phases(engine, corpus_dir, min_complexity, min_repetition, measure):
+    """Run one hand-split scan, passing every phase through ``measure(name, func, *args)``"""
+    builtin_names = get_builtin_names()
+    files = measure("discovery", collect_python_files, [corpus_dir])
+    trees = measure("parse", lambda: [(path, parse_python_file(path)) for path in files])
+    extracted = measure("extraction", extract, engine, trees, builtin_names, min_complexity)
+    file_records = measure("normalization", normalize, engine, extracted, builtin_names,
+                           min_complexity)
+    results = measure("grouping", group, engine, file_records, min_complexity, min_repetition)
+    ranked = measure("sorting", sort_results, results)
+    measure("printing", render, ranked)
+    return {
+        "files": len(files),
+        "nodes": sum(len(records) for _, records in file_records),
+        "results": len(results),
+    }
+
+
+def time_breakdown(engine, corpus_dir, min_complexity, min_repetition, repeat):
+    """Best wall and CPU time of each hand-split phase"""
+    best = {}
+
+    def measure(name, func, *args):
+        wall, cpu = time.perf_counter(), time.process_time()
+        result = func(*args)
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+        if name not in best or wall < best[name]["wall"]:
+            best[name] = {"wall": round(wall, 6), "cpu": round(cpu, 6)}
+        return result
+
+    for _ in range(repeat):
+        run_phases(engine, corpus_dir, min_complexity, min_repetition, measure)
+    return {name: best[name] for name in BREAKDOWN_PHASES}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--engines', default="flat,tree",
+                        help=f'Comma-separated engines out of {",".join(ENGINES)} '
+                             '(default: flat,tree)')
+    parser.add_argument('--min-complexity', type=int, default=4)
+    parser.add_argument('--min-repetition', type=int, default=2)
+    parser.add_argument('--repeat', type=int, default=3, help='Timed runs per engine')
+    parser.add_argument('--no-memory', action='store_true', help='Skip the traced memory run')
+    parser.add_argument('--breakdown', action='store_true',
+                        help='Also time parsing, extraction and normalization separately')
+    parser.add_argument('--output', help='Write the JSON report here instead of stdout')
+    add_spec_arguments(parser)
+    args = parser.parse_args()
+
+    engines = args.engines.split(",")
+    unknown = set(engines) - set(ENGINES)
+    if unknown:
+        parser.error(f"unknown engines: {', '.join(sorted(unknown))}")
+
+    spec = spec_from_args(args)
+    report = {
+        "version": __version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "corpus": spec._asdict(),
+        "min_complexity": args.min_complexity,
+        "min_repetition": args.min_repetition,
+        "engines": {},
+    }
+    with tempfile.TemporaryDirectory() as corpus_dir:
+        write_corpus(corpus_dir, spec)
+        for engine in engines:
+            phases, total, counts = time_engine(engine, corpus_dir, args.min_complexity,
+                                                args.min_repetition, args.repeat)
+            if not args.no_memory:
+                for name, peak in trace_engine(engine, corpus_dir, args.min_complexity,
+                                               args.min_repetition).items():
+                    phases[name]["peak_bytes"] = peak
+            report["engines"][engine] = {
+                "phases": phases,
+                "total_wall": total["wall"],
+                "total_cpu": total["cpu"],
+                "counts": counts,
+            }
+            if args.breakdown:
+                report["engines"][engine]["breakdown"] = time_breakdown(
+                    engine, corpus_dir, args.min_complexity, args.min_repetition, args.repeat)
+
+    try:
+        import resource
+    except ImportError:  # Windows
+        pass
+    else:
+        # Kilobytes on Linux, bytes on macOS
+        report["max_rss"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,6 +4,11 @@ __version__ = "1.0.3"
 __author__ = "Andres GU"
 __email__ = "andres@waza.baby"
 
-from .repetition_hunter import main, find_repetitions, RepetitionResult
+from .repetition_hunter import (
+    main, find_repetitions, RepetitionIndex, RepetitionResult, Location, ScanHooks, ScanStats,
+)
 
-__all__ = ["main", "find_repetitions", "RepetitionResult"]
\ No newline at end of file
+__all__ = [
+    "main", "find_repetitions", "RepetitionIndex", "RepetitionResult", "Location", "ScanHooks",
+    "ScanStats",
+]
\ No newline at end of file
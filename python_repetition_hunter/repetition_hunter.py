@@ -8,12 +8,159 @@ Based on the Clojure repetition-hunter algorithm.
 
 import ast
 import argparse
-import copy
+import cProfile
+import collections.abc
+import hashlib
+import heapq
+import itertools
+import json
 import os
+import re
+import shutil
+import sqlite3
+import struct
+import subprocess
 import sys
-from collections import defaultdict
+import tempfile
+import textwrap
+import time
+import zlib
+from array import array
+from bisect import bisect_right
+from collections import Counter, OrderedDict, defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack, contextmanager, redirect_stdout
 from dataclasses import dataclass
-from typing import List, Set, Tuple
+from functools import partial
+from typing import (Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Sequence, Set,
+                    Tuple)
+
+
+ENGINES = ("flat", "tree", "legacy")
+# How much of a node is abstracted before grouping, strictest first; every
+# level also abstracts what the levels before it do
+NORMALIZE_LEVELS = ("names", "arguments", "attributes", "constants")
+DEFAULT_CACHE_DIR = ".repetition_hunter_cache"
+# Directories never worth descending into, on top of --exclude and .gitignore;
+# virtual environments are recognized by their pyvenv.cfg whatever their name
+DEFAULT_EXCLUDES = (".git", ".hg", ".svn", ".tox", ".nox", "__pycache__", "node_modules",
+                    "site-packages")
+CACHE_FORMAT = 4
+INDEX_FORMAT = 3
+
+
+class Location:
+    """Position of one instance of a repetition, without its AST.
+
+    ``index`` is the node's position in a pre-order walk of its file, which is
+    enough to find the node again by re-parsing the file. A location with a
+    ``span`` above 1 covers that many consecutive statements starting there.
+    """
+    __slots__ = ('filepath', 'lineno', 'end_lineno', 'col_offset', 'end_col_offset',
+                 'fingerprint', 'index', 'span')
+
+    def __init__(self, filepath: str, lineno: int, end_lineno: int = 0, col_offset: int = 0,
+                 end_col_offset: int = 0, fingerprint: str = "", index: int = -1,
+                 span: int = 1):
+        self.filepath = filepath
+        self.lineno = lineno
+        self.end_lineno = end_lineno
+        self.col_offset = col_offset
+        self.end_col_offset = end_col_offset
+        self.fingerprint = fingerprint
+        self.index = index
+        self.span = span
+
+    @classmethod
+    def from_node(cls, filepath: str, lineno: int, node: Optional[ast.AST]) -> 'Location':
+        return cls(filepath, lineno,
+                   getattr(node, 'end_lineno', None) or lineno,
+                   getattr(node, 'col_offset', 0),
+                   getattr(node, 'end_col_offset', None) or 0)
+
+    def _key(self) -> tuple:
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, Location):
+            return NotImplemented
+        return self._key() == other._key()
+
+    def __hash__(self) -> int:
+        return hash(self._key())
+
+    def __repr__(self) -> str:
+        return f"Location({self.filepath!r}, {self.lineno}, {self.end_lineno}, index={self.index})"
+
+
+class NodeResolver:
+    """Re-parses files on demand to recover the node behind a ``Location``.
+
+    Only the most recently used files are kept, so resolving the nodes of the
+    results being printed does not pin every parse tree in memory.
+    """
+
+    def __init__(self, max_files: int = 16):
+        self.max_files = max_files
+        self._files = OrderedDict()
+
+    def _file(self, filepath: str) -> Tuple[List[ast.AST], List[int]]:
+        tree = self._files.get(filepath)
+        if tree is None:
+            try:
+                tree = _preorder_with_parents(parse_python_file(filepath))
+            except (SyntaxError, OSError, UnicodeDecodeError, ValueError, RecursionError):
+                tree = ([], [])
+            self._files[filepath] = tree
+            if len(self._files) > self.max_files:
+                self._files.popitem(last=False)
+        else:
+            self._files.move_to_end(filepath)
+        return tree
+
+    def node(self, location: Location) -> Optional[ast.AST]:
+        """Return the node at a location, or None if the file no longer has it"""
+        nodes, _ = self._file(location.filepath)
+        if 0 <= location.index < len(nodes):
+            return nodes[location.index]
+        return None
+
+    def nodes(self, location: Location) -> List[ast.AST]:
+        """Return every statement a location spans (just its node if span is 1)"""
+        node = self.node(location)
+        if node is None:
+            return []
+        if location.span == 1:
+            return [node]
+
+        nodes, parents = self._file(location.filepath)
+        parent = nodes[parents[location.index]]
+        for _, value in ast.iter_fields(parent):
+            if isinstance(value, list):
+                for position, item in enumerate(value):
+                    if item is node:
+                        return value[position:position + location.span]
+        return [node]
+
+
+class NodeList(collections.abc.Sequence):
+    """Read-only ``(filename, line, node)`` view over a list of locations.
+
+    Nodes are only materialized when an item is read.
+    """
+
+    def __init__(self, locations: List[Location], resolver: Optional[NodeResolver] = None):
+        self.locations = locations
+        self.resolver = resolver if resolver is not None else NodeResolver()
+
+    def __len__(self) -> int:
+        return len(self.locations)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        location = self.locations[i]
+        return (location.filepath, location.lineno, self.resolver.node(location))
 
 
 @dataclass
@@ -21,12 +168,134 @@ class RepetitionResult:
     """Result of a repetition analysis"""
     complexity: int
     repetition: int
-    original_nodes: List[Tuple[str, int, ast.AST]]  # (filename, line, node)
+    original_nodes: Sequence[Tuple[str, int, Optional[ast.AST]]]  # (filename, line, node)
     generic_form: str
+    kind: str = "node"  # "sequence" for runs of statements, "similar" for near-misses
+    similarity: float = 1.0  # Lowest verified pairwise score of a "similar" cluster
+    level: str = "names"  # Normalization level a "node" group was found at
+
+    @property
+    def locations(self) -> List[Location]:
+        """Compact positions of every instance, without parsing any file"""
+        if isinstance(self.original_nodes, NodeList):
+            return self.original_nodes.locations
+        return [Location.from_node(fp, ln, node) for fp, ln, node in self.original_nodes]
+
+
+@dataclass
+class FileStats:
+    """What analyzing one file cost and produced"""
+    filepath: str
+    seconds: float = 0.0    # wall time of parsing and fingerprinting
+    bytes_read: int = 0
+    nodes: int = 0          # AST nodes visited
+    candidates: int = 0     # records at or above the complexity threshold
+    cached: bool = False    # records came from the fingerprint cache
+
+
+class ScanHooks:
+    """Callbacks ``find_repetitions`` makes while it runs; override any of them"""
+
+    def phase_started(self, name: str) -> None:
+        pass
+
+    def phase_finished(self, name: str, wall: float, cpu: float) -> None:
+        pass
+
+    def file_analyzed(self, stats: FileStats) -> None:
+        pass
+
+    def count(self, name: str, value: int) -> None:
+        """A counter such as ``distinct_fingerprints`` or ``groups``"""
+
+
+class ScanStats(ScanHooks):
+    """Hooks that collect phase timings, counters and per-file costs.
+
+    Phases are accumulated by name, so several runs can share one instance.
+    """
+
+    def __init__(self):
+        self.phases = {}  # name -> [wall, cpu]
+        self.counters = {}
+        self.files = []
+
+    def phase_finished(self, name: str, wall: float, cpu: float) -> None:
+        totals = self.phases.setdefault(name, [0.0, 0.0])
+        totals[0] += wall
+        totals[1] += cpu
+
+    def file_analyzed(self, stats: FileStats) -> None:
+        self.files.append(stats)
+
+    def count(self, name: str, value: int) -> None:
+        self.counters[name] = value
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        """Time a block of work as a phase, e.g. sorting and printing in ``main``"""
+        with _phase(self, name):
+            yield
+
+    def as_dict(self, top: int = 5) -> dict:
+        """Everything collected, with the ``top`` slowest and largest files"""
+        analyzed = [stats for stats in self.files if not stats.cached]
+
+        def describe(stats):
+            return {'path': stats.filepath, 'seconds': round(stats.seconds, 6),
+                    'bytes': stats.bytes_read, 'nodes': stats.nodes}
+
+        return {
+            'phases': {name: {'wall': round(wall, 6), 'cpu': round(cpu, 6)}
+                       for name, (wall, cpu) in self.phases.items()},
+            'counters': dict(
+                files=len(self.files),
+                cached_files=len(self.files) - len(analyzed),
+                bytes_read=sum(stats.bytes_read for stats in analyzed),
+                nodes=sum(stats.nodes for stats in analyzed),
+                candidates=sum(stats.candidates for stats in self.files),
+                **self.counters,
+            ),
+            'slowest_files': [describe(stats) for stats in
+                              heapq.nlargest(top, analyzed, key=lambda stats: stats.seconds)],
+            'largest_files': [describe(stats) for stats in
+                              heapq.nlargest(top, analyzed, key=lambda stats: stats.bytes_read)],
+        }
+
+    def format(self, top: int = 5) -> str:
+        """A plain-text report of ``as_dict``"""
+        report = self.as_dict(top)
+        lines = ["Phases (wall / cpu seconds):"]
+        lines += [f"  {name:<14}{times['wall']:>10.3f}{times['cpu']:>10.3f}"
+                  for name, times in report['phases'].items()]
+        lines.append("Counters:")
+        lines += [f"  {name:<24}{value:>12}" for name, value in report['counters'].items()]
+        for title, key in (("Slowest files", 'slowest_files'), ("Largest files", 'largest_files')):
+            lines.append(f"{title}:")
+            lines += [f"  {entry['seconds']:>8.3f}s {entry['bytes']:>9} B  {entry['path']}"
+                      for entry in report[key]]
+        return "\n".join(lines)
+
+
+@contextmanager
+def _phase(hooks: Optional[ScanHooks], name: str) -> Iterator[None]:
+    if hooks is None:
+        yield
+        return
+    hooks.phase_started(name)
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield
+    finally:
+        hooks.phase_finished(name, time.perf_counter() - wall, time.process_time() - cpu)
 
 
 class ASTNormalizer(ast.NodeTransformer):
-    """Normalizes AST nodes by replacing variables with generic placeholders"""
+    """Normalizes AST nodes by replacing variables with generic placeholders.
+
+    No engine uses it any more; ``normalized_dump`` produces the dump of its
+    output without rewriting the tree, and is tested against it.
+    """
     
     def __init__(self, builtin_names: Set[str]):
         self.builtin_names = builtin_names
@@ -43,6 +312,35 @@ class ASTNormalizer(ast.NodeTransformer):
             
         return ast.Name(id=self.var_map[node.id], ctx=node.ctx)
 
+    def visit(self, node: ast.AST) -> ast.AST:
+        """Normalize ``node`` in place, in the order ``NodeTransformer`` would.
+
+        An explicit stack replaces the recursive ``generic_visit``, so trees
+        of any depth are handled.
+        """
+        if isinstance(node, ast.Name):
+            return self.visit_Name(node)
+        # (node, parent, field, position in the field's list or None)
+        stack = [(node, None, None, None)]
+        while stack:
+            current, parent, field, position = stack.pop()
+            if isinstance(current, ast.Name):
+                replacement = self.visit_Name(current)
+                if position is None:
+                    setattr(parent, field, replacement)
+                else:
+                    getattr(parent, field)[position] = replacement
+                continue
+            children = []
+            for name, value in ast.iter_fields(current):
+                if isinstance(value, list):
+                    children.extend((item, current, name, i) for i, item in enumerate(value)
+                                    if isinstance(item, ast.AST))
+                elif isinstance(value, ast.AST):
+                    children.append((value, current, name, None))
+            stack.extend(reversed(children))
+        return node
+
 
 def get_builtin_names() -> Set[str]:
     """Get set of Python builtin names"""
@@ -54,23 +352,90 @@ def parse_python_file(filepath: str) -> ast.AST:
     """Parse a Python file and return its AST"""
     with open(filepath, 'r', encoding='utf-8') as f:
         content = f.read()
-    return ast.parse(content, filename=filepath)
+    tree = ast.parse(content, filename=filepath)
+    if sys.version_info < (3, 8):
+        _add_end_linenos(tree)
+    return tree
+
+
+def _add_end_linenos(tree: ast.AST) -> None:
+    """Give nodes the ``end_lineno`` that ``ast`` only sets from 3.8 on.
+
+    Each node ends on the last line any node inside it starts on, which
+    misses a closing bracket alone on its line; end columns stay unknown.
+    """
+    nodes, parents = _preorder_with_parents(tree)
+    ends = [getattr(node, 'lineno', 0) for node in nodes]
+    for index in range(len(nodes) - 1, 0, -1):
+        parent = parents[index]
+        if ends[index] > ends[parent]:
+            ends[parent] = ends[index]
+    for node, end in zip(nodes, ends):
+        if hasattr(node, 'lineno'):
+            node.end_lineno = end
+
+
+# Single names, constants and contexts are never reported on their own
+_TRIVIAL_NODES = (ast.Name, ast.Constant, ast.Load, ast.Store, ast.Del)
+
+
+# Node kinds --granularity selects candidates by; any ast class name works too
+GRANULARITIES = {
+    "function": (ast.FunctionDef, ast.AsyncFunctionDef),
+    "class": (ast.ClassDef,),
+    "statement": (ast.stmt,),
+    "expression": (ast.expr,),
+}
+_GRANULARITY_TYPES: Dict[Tuple[str, ...], Tuple[type, ...]] = {}
+
+
+def _granularity_types(granularity: Optional[Iterable[str]]) -> Optional[Tuple[type, ...]]:
+    """The node classes a granularity keeps as candidates, None for all of them"""
+    if granularity is None:
+        return None
+    key = tuple(granularity)
+    types = _GRANULARITY_TYPES.get(key)
+    if types is None:
+        types = []
+        for kind in key:
+            if kind in GRANULARITIES:
+                types.extend(GRANULARITIES[kind])
+                continue
+            node_type = getattr(ast, kind, None)
+            if not (isinstance(node_type, type) and issubclass(node_type, ast.AST)):
+                raise ValueError(f"Unknown granularity: {kind}")
+            types.append(node_type)
+        if not types:
+            raise ValueError("A granularity needs at least one node kind")
+        types = _GRANULARITY_TYPES[key] = tuple(types)
+    return types
+
+
+def _enclosing_candidates(parents: Sequence[int], selected: Sequence[bool]) -> List[int]:
+    """Pre-order index of the nearest selected ancestor of every node, -1 for none"""
+    enclosing = [-1] * len(parents)
+    for i in range(1, len(parents)):
+        parent = parents[i]
+        enclosing[i] = parent if selected[parent] else enclosing[parent]
+    return enclosing
 
 
-def extract_all_nodes(node: ast.AST) -> List[ast.AST]:
-    """Extract all AST nodes from a tree, excluding trivial ones"""
+def extract_all_nodes(node: ast.AST, granularity: Optional[Iterable[str]] = None
+                      ) -> List[ast.AST]:
+    """Extract all AST nodes from a tree, excluding trivial ones.
+
+    ``granularity`` (keys of ``GRANULARITIES`` or ``ast`` class names) only
+    keeps nodes of those kinds.
+    """
+    kinds = _granularity_types(granularity)
     nodes = []
-    
-    def collect_nodes(n):
-        if isinstance(n, ast.AST):
-            # Skip trivial nodes (single names, constants)
-            if not isinstance(n, (ast.Name, ast.Constant, ast.Load, ast.Store, ast.Del)):
-                nodes.append(n)
-            
-            for child in ast.iter_child_nodes(n):
-                collect_nodes(child)
-    
-    collect_nodes(node)
+    stack = [node]
+    while stack:
+        n = stack.pop()
+        # Skip trivial nodes (single names, constants)
+        if not isinstance(n, _TRIVIAL_NODES) and (kinds is None or isinstance(n, kinds)):
+            nodes.append(n)
+        stack.extend(reversed(list(ast.iter_child_nodes(n))))
     return nodes
 
 
@@ -82,167 +447,3333 @@ def calculate_complexity(node: ast.AST) -> int:
     return count
 
 
+def compute_subtree_sizes(tree: ast.AST) -> Dict[ast.AST, int]:
+    """Annotate every node with its subtree size in one post-order pass.
+
+    The size of a node equals ``calculate_complexity(node)``, but each node is
+    visited once per file instead of once per ancestor.
+    """
+    sizes = {}
+    stack = [(tree, False)]
+    while stack:
+        node, finished = stack.pop()
+        if finished:
+            sizes[node] = 1 + sum(sizes[child] for child in ast.iter_child_nodes(node))
+            continue
+        stack.append((node, True))
+        for child in ast.iter_child_nodes(node):
+            stack.append((child, False))
+    return sizes
+
+
 def normalize_ast(node: ast.AST, builtin_names: Set[str]) -> ast.AST:
     """Create a generic version of an AST node by replacing variables"""
     normalizer = ASTNormalizer(builtin_names)
     return normalizer.visit(node)
 
 
-def ast_to_string(node: ast.AST) -> str:
-    """Convert AST node to a string representation"""
-    return ast.dump(node, indent=None)
+# Fields abstracted by the looser normalization levels, with the position in
+# NORMALIZE_LEVELS of the first level that does: argument names join the
+# renamed variables, attribute names and constant values become placeholders
+_LOOSE_FIELDS = {ast.arg: ('arg', 1), ast.Attribute: ('attr', 2), ast.Constant: ('value', 3)}
+if sys.version_info < (3, 8):
+    # Literals only parse to ast.Constant from 3.8 on
+    _LOOSE_FIELDS.update({ast.Num: ('n', 3), ast.Str: ('s', 3), ast.Bytes: ('s', 3),
+                          ast.NameConstant: ('value', 3)})
 
 
-def find_repetitions(files: List[str], min_complexity: int = 3, min_repetition: int = 2) -> List[RepetitionResult]:
-    """Find repetitions across multiple Python files"""
-    builtin_names = get_builtin_names()
-    
-    # Collect all nodes from all files
-    all_nodes = []
-    
-    for filepath in files:
-        if not os.path.exists(filepath):
-            print(f"Warning: File {filepath} not found", file=sys.stderr)
-            continue
-            
-        try:
-            tree = parse_python_file(filepath)
-            nodes = extract_all_nodes(tree)
-            
-            for node in nodes:
-                complexity = calculate_complexity(node)
-                if complexity >= min_complexity:
-                    all_nodes.append((filepath, node.lineno if hasattr(node, 'lineno') else 0, node))
-                    
-        except (SyntaxError, OSError, UnicodeDecodeError) as e:
-            print(f"Error parsing {filepath}: {e}", file=sys.stderr)
+def _abstract_value(node_type: type, value: object) -> str:
+    """Placeholder of an abstracted attribute name or constant.
+
+    It is never the ``repr`` of a value, so a form with placeholders cannot
+    equal one without. Constants keep their type.
+    """
+    return "*" if node_type is ast.Attribute else "*" + type(value).__name__
+
+
+def _ordered_levels(levels: Iterable[str]) -> Tuple[str, ...]:
+    """Check normalization levels and sort them strictest first"""
+    levels = set(levels)
+    unknown = levels - set(NORMALIZE_LEVELS)
+    if unknown:
+        raise ValueError(f"Unknown normalization level: {', '.join(sorted(unknown))}")
+    if not levels:
+        raise ValueError("At least one normalization level is needed")
+    return tuple(level for level in NORMALIZE_LEVELS if level in levels)
+
+
+def _level_form(level: str, form: str) -> str:
+    # Names-level forms are left as they are, so caches and indexes keep working
+    return form if level == "names" else f"{level}:{form}"
+
+
+def form_level(form: str) -> str:
+    """The normalization level a generic form was computed at"""
+    level, separator, _ = form.partition(':')
+    return level if separator and level in NORMALIZE_LEVELS else "names"
+
+
+# ast.dump leaves out empty fields from Python 3.13 on
+_DUMP_HIDES_EMPTY = sys.version_info >= (3, 13)
+
+
+def _dump(node: ast.AST, builtin_names: Optional[Set[str]] = None, rank: int = 0) -> str:
+    """``ast.dump(node)`` built with an explicit stack instead of recursion.
+
+    With ``builtin_names``, variables are renamed as ``normalize_ast`` would
+    rename them, so a normalized dump needs neither a copy nor a rewrite.
+    ``rank`` > 0 also abstracts the fields of ``_LOOSE_FIELDS`` up to that
+    level; their placeholders are written unquoted.
+    """
+    var_map = {}
+    parts = []
+    # Items are text to emit, or nodes and lists still to be formatted
+    stack = [node]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, str):
+            parts.append(item)
             continue
-    
-    # Group by normalized form
-    generic_groups = defaultdict(list)
-    
-    for filepath, lineno, node in all_nodes:
-        try:
-            # Deep copy to preserve original variable names for display
-            node_copy = copy.deepcopy(node)
-            generic_node = normalize_ast(node_copy, builtin_names)
-            generic_form = ast_to_string(generic_node)
-            complexity = calculate_complexity(node)
-            
-            generic_groups[generic_form].append((filepath, lineno, node, complexity))
-        except (ValueError, RecursionError) as e:
-            print(f"Error normalizing node at {filepath}:{lineno}: {e}", file=sys.stderr)
+        if isinstance(item, list):
+            if not item:
+                parts.append("[]")
+                continue
+            pieces = ["["]
+            for i, element in enumerate(item):
+                if i:
+                    pieces.append(", ")
+                pieces.append(element if isinstance(element, (ast.AST, list)) else repr(element))
+            pieces.append("]")
+            stack.extend(reversed(pieces))
             continue
-    
-    # Create results for repeated forms
-    results = []
-    for generic_form, instances in generic_groups.items():
-        if len(instances) >= min_repetition:
-            complexity = instances[0][3]  # All instances should have same complexity
-            original_nodes = [(fp, ln, node) for fp, ln, node, _ in instances]
-            
-            results.append(RepetitionResult(
-                complexity=complexity,
-                repetition=len(instances),
-                original_nodes=original_nodes,
-                generic_form=generic_form
+
+        cls = type(item)
+        pieces = [cls.__name__ + "("]
+        for name in item._fields:
+            try:
+                value = getattr(item, name)
+            except AttributeError:
+                continue
+            if value is None and getattr(cls, name, ...) is None:
+                continue
+            if _DUMP_HIDES_EMPTY and (value is None or value == []) \
+                    and not isinstance(item, (ast.Constant, ast.MatchSingleton)):
+                continue
+            if builtin_names is not None and cls is ast.Name and name == "id" \
+                    and value not in builtin_names:
+                if value not in var_map:
+                    var_map[value] = f"x_{len(var_map)}"
+                value = var_map[value]
+            pieces.append(("" if len(pieces) == 1 else ", ") + name + "=")
+            loose = _LOOSE_FIELDS.get(cls) if rank else None
+            if loose is not None and loose[0] == name and rank >= loose[1]:
+                if cls is not ast.arg:
+                    pieces.append(_abstract_value(cls, value))
+                    continue
+                if value not in builtin_names:
+                    if value not in var_map:
+                        var_map[value] = f"x_{len(var_map)}"
+                    pieces.append(var_map[value])
+                    continue
+            pieces.append(value if isinstance(value, (ast.AST, list)) else repr(value))
+        pieces.append(")")
+        stack.extend(reversed(pieces))
+    return "".join(parts)
+
+
+def ast_to_string(node: ast.AST) -> str:
+    """Convert AST node to a string representation"""
+    return _dump(node)
+
+
+def normalized_dump(node: ast.AST, builtin_names: Set[str], level: str = "names") -> str:
+    """The legacy engine's form of a node, leaving the node untouched.
+
+    Equal to ``ast_to_string(normalize_ast(copy.deepcopy(node), builtin_names))``
+    in one non-recursive pass. A looser ``level`` (see ``NORMALIZE_LEVELS``)
+    also renames arguments along with variables, or replaces attribute names
+    and constants with placeholders.
+    """
+    return _dump(node, builtin_names, NORMALIZE_LEVELS.index(level))
+
+
+def _variable_field(node: ast.AST, builtin_names: Set[str], rank: int) -> Optional[str]:
+    """The field holding the variable name a node stands for at a level, if any"""
+    if isinstance(node, ast.Name):
+        return 'id' if node.id not in builtin_names else None
+    if rank and isinstance(node, ast.arg):
+        return 'arg' if node.arg not in builtin_names else None
+    return None
+
+
+def _digest_node(node: ast.AST, fingerprints: Dict[ast.AST, bytes],
+                 corrections: List[Tuple[int, int]], variable: Optional[str],
+                 rank: int = 0) -> bytes:
+    """Hash a node from its own fields and the digests of its children.
+
+    ``variable`` names the field left out as a renamed variable; at ``rank``
+    2 and up attribute names, and at 3 constants, become placeholders.
+    """
+    loose = _LOOSE_FIELDS.get(type(node)) if rank >= 2 else None
+    fields = []
+    for name, value in ast.iter_fields(node):
+        if name == variable:
+            fields.append(None)
+        elif loose is not None and loose[0] == name and 2 <= loose[1] <= rank:
+            fields.append(_abstract_value(type(node), value))
+        elif isinstance(value, ast.AST):
+            fields.append(fingerprints[value])
+        elif isinstance(value, list):
+            fields.append(tuple(
+                fingerprints[item] if isinstance(item, ast.AST) else repr(item)
+                for item in value
             ))
-    
-    return results
+        else:
+            fields.append(repr(value))
 
+    key = repr((type(node).__name__, tuple(fields), tuple(corrections)))
+    return hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
 
-def sort_results(results: List[RepetitionResult], sort_by: str = "complexity") -> List[RepetitionResult]:
-    """Sort results by complexity * repetition or repetition * complexity"""
-    if sort_by == "repetition":
-        return sorted(results, key=lambda r: (r.repetition, r.complexity), reverse=True)
-    else:
-        return sorted(results, key=lambda r: (r.complexity, r.repetition), reverse=True)
 
+def compute_fingerprints(tree: ast.AST, builtin_names: Set[str],
+                         level: str = "names") -> Dict[ast.AST, bytes]:
+    """Fingerprint every subtree of a tree in a single bottom-up pass.
 
-def shorten_path(filepath: str) -> str:
-    """Shorten file path for display by removing ./ prefix and common directories"""
-    if filepath.startswith('./'):
-        filepath = filepath[2:]
-    if filepath.startswith('src/'):
-        filepath = filepath[4:]
-    return filepath
+    Two nodes get the same fingerprint exactly when their normalized copies
+    (``normalize_ast`` followed by ``ast_to_string``) would be equal, but
+    nothing is copied or dumped. Variables are encoded Baker-style: every
+    occurrence is the distance back to the previous occurrence of the same
+    name, or 0 if that occurrence is outside the subtree. That distance only
+    becomes visible at the lowest common ancestor of the two occurrences, so
+    it is recorded there once, keeping the whole pass linear in tree size.
 
+    A looser ``level`` groups as ``normalized_dump`` does at that level.
+    """
+    rank = NORMALIZE_LEVELS.index(level)
+    fingerprints = {}
+    corrections = defaultdict(list)
+    last_seen = {}      # variable name -> position of its latest occurrence
+    position = 0        # number of variable occurrences visited so far
+    path_nodes = []     # ancestors of the node being visited, root first
+    path_starts = []    # position of the first variable inside each ancestor
 
-def print_results(results: List[RepetitionResult]) -> None:
-    """Print formatted results in compact format"""
-    for result in results:
-        # Build compact location list
-        locations = [
-            f"{shorten_path(fp)}:{ln}"
-            for fp, ln, _ in result.original_nodes
+    stack = [(tree, False)]
+    while stack:
+        node, finished = stack.pop()
+        variable = _variable_field(node, builtin_names, rank)
+
+        if finished:
+            path_nodes.pop()
+            path_starts.pop()
+            fingerprints[node] = _digest_node(
+                node, fingerprints, corrections.pop(node, ()), variable, rank
+            )
+            continue
+
+        if variable is not None:
+            name = getattr(node, variable)
+            previous = last_seen.get(name)
+            if previous is not None:
+                owner = bisect_right(path_starts, previous) - 1
+                corrections[path_nodes[owner]].append(
+                    (position - path_starts[owner], position - previous)
+                )
+            last_seen[name] = position
+
+        path_nodes.append(node)
+        path_starts.append(position)
+        if variable is not None:
+            position += 1
+
+        stack.append((node, True))
+        children = list(ast.iter_child_nodes(node))
+        for child in reversed(children):
+            stack.append((child, False))
+
+    return fingerprints
+
+
+# Markers used in FlatTree labels in place of child nodes and variable names
+_CHILD = None
+_VARIABLE = Ellipsis
+
+# Process-wide intern tables shared by every FlatTree
+_TYPE_IDS: Dict[type, int] = {}
+_TYPE_IS_TRIVIAL: List[bool] = []
+_LABEL_IDS: Dict[tuple, int] = {}
+_LABEL_DIGESTS: List[bytes] = []
+
+
+class FlatTree:
+    """A parsed module flattened into parallel arrays in pre-order.
+
+    Node ``i`` has type ``types[i]``, parent ``parents[i]`` (-1 for the root),
+    ``sizes[i]`` nodes in its subtree and, for variables, a per-file
+    ``names[i]`` slot (-1 otherwise). ``labels[i]`` identifies everything
+    else ``ast.dump`` would print for the node besides its children. Children
+    of ``i`` start at ``i + 1`` and follow each other at ``j + sizes[j]``, so
+    every pass below is a plain loop over integer arrays.
+
+    When flattened for looser normalization levels, ``level_labels`` holds
+    the labels of each of them and ``level_names`` the variable slots once
+    arguments count as variables.
+    """
+
+    def __init__(self):
+        self.types = array('i')
+        self.parents = array('i')
+        self.sizes = array('i')
+        self.names = array('i')
+        self.labels = array('i')
+        self.level_labels: Dict[str, array] = {}
+        self.level_names = array('i')
+        self.linenos = array('i')
+        self.end_linenos = array('i')
+        self.col_offsets = array('i')
+        self.end_col_offsets = array('i')
+
+    def __len__(self) -> int:
+        return len(self.types)
+
+    def is_trivial(self, index: int) -> bool:
+        return _TYPE_IS_TRIVIAL[self.types[index]]
+
+    def _level(self, level: str) -> Tuple[array, array]:
+        """Labels and variable slots of the nodes at a normalization level"""
+        if level == "names":
+            return self.labels, self.names
+        if level not in self.level_labels:
+            raise ValueError(f"Not flattened for normalization level {level}")
+        return self.level_labels[level], self.level_names
+
+    def fingerprints(self, level: str = "names") -> List[bytes]:
+        """Compute the same grouping as ``compute_fingerprints`` over the arrays.
+
+        Digests differ from the object-tree engine, but two nodes share one
+        here exactly when they share one there.
+        """
+        sizes = self.sizes
+        labels, names = self._level(level)
+        corrections = self._name_corrections(names)
+        digests = [b''] * len(sizes)
+
+        for i in range(len(sizes) - 1, -1, -1):
+            parts = [_LABEL_DIGESTS[labels[i]]]
+            child, end = i + 1, i + sizes[i]
+            while child < end:
+                parts.append(digests[child])
+                child += sizes[child]
+            offsets = corrections.get(i)
+            if offsets:
+                parts.append(struct.pack(f'<{len(offsets)}I', *offsets))
+            digests[i] = hashlib.blake2b(b''.join(parts), digest_size=16).digest()
+
+        return digests
+
+    def level_fingerprints(self, levels: Iterable[str]) -> Dict[str, List[bytes]]:
+        """``fingerprints`` at several levels in one backward loop, strictest first.
+
+        A node whose label, corrections and children are the same as at the
+        previous level keeps that level's digest object, so ``is`` tells
+        which nodes a looser level actually changed.
+        """
+        sizes = self.sizes
+        levels = _ordered_levels(levels)
+        corrections = {}
+        passes = []
+        for level in levels:
+            labels, names = self._level(level)
+            if id(names) not in corrections:
+                corrections[id(names)] = self._name_corrections(names)
+            passes.append((labels, corrections[id(names)], [b''] * len(sizes)))
+
+        for i in range(len(sizes) - 1, -1, -1):
+            end = i + sizes[i]
+            previous = None
+            for labels, level_corrections, digests in passes:
+                label = labels[i]
+                offsets = level_corrections.get(i)
+                same = previous is not None and label == previous[0][i] \
+                    and offsets == previous[1].get(i)
+                parts = [_LABEL_DIGESTS[label]]
+                child = i + 1
+                while child < end:
+                    digest = digests[child]
+                    parts.append(digest)
+                    same = same and digest is previous[2][child]
+                    child += sizes[child]
+                if same:
+                    digests[i] = previous[2][i]
+                else:
+                    if offsets:
+                        parts.append(struct.pack(f'<{len(offsets)}I', *offsets))
+                    digests[i] = hashlib.blake2b(b''.join(parts), digest_size=16).digest()
+                previous = (labels, level_corrections, digests)
+
+        return {level: digests for level, (_, _, digests) in zip(levels, passes)}
+
+    def _name_corrections(self, names: Optional[array] = None) -> Dict[int, List[int]]:
+        """Place each variable's back-reference at its lowest common ancestor.
+
+        See ``compute_fingerprints``; offsets come in (offset, distance) pairs.
+        """
+        corrections = defaultdict(list)
+        last_seen = {}
+        position = 0
+        path = []
+        path_starts = []
+
+        for i, (parent, name) in enumerate(zip(self.parents,
+                                               self.names if names is None else names)):
+            while path and path[-1] != parent:
+                path.pop()
+                path_starts.pop()
+            if name >= 0:
+                previous = last_seen.get(name)
+                if previous is not None:
+                    owner = bisect_right(path_starts, previous) - 1
+                    corrections[path[owner]] += (position - path_starts[owner], position - previous)
+                last_seen[name] = position
+            path.append(i)
+            path_starts.append(position)
+            if name >= 0:
+                position += 1
+
+        return corrections
+
+
+def _intern_type(node_type: type) -> int:
+    type_id = _TYPE_IDS.get(node_type)
+    if type_id is None:
+        type_id = _TYPE_IDS[node_type] = len(_TYPE_IS_TRIVIAL)
+        _TYPE_IS_TRIVIAL.append(issubclass(node_type, _TRIVIAL_NODES))
+    return type_id
+
+
+def _intern_label(label: tuple) -> int:
+    label_id = _LABEL_IDS.get(label)
+    if label_id is None:
+        label_id = _LABEL_IDS[label] = len(_LABEL_DIGESTS)
+        _LABEL_DIGESTS.append(
+            hashlib.blake2b(repr(label).encode('utf-8'), digest_size=16).digest()
+        )
+    return label_id
+
+
+def flatten_tree(tree: ast.AST, builtin_names: Set[str],
+                 levels: Iterable[str] = ("names",)) -> FlatTree:
+    """Flatten a tree into a ``FlatTree`` with one pre-order walk.
+
+    Labels of the looser ``levels`` are worked out in the same walk.
+    """
+    flat = FlatTree()
+    # (level, its labels, rank), loosest last
+    loose = [(level, flat.level_labels.setdefault(level, array('i')),
+              NORMALIZE_LEVELS.index(level))
+             for level in _ordered_levels(levels) if level != "names"]
+    names = {}
+    stack = [(tree, -1)]
+
+    while stack:
+        node, parent = stack.pop()
+        index = len(flat.types)
+        node_type = type(node)
+        layout = []
+        children = []
+        name = -1
+        abstracted = _LOOSE_FIELDS.get(node_type) if loose else None
+        abstract_at = -1
+
+        for field, value in ast.iter_fields(node):
+            if isinstance(value, ast.AST):
+                layout.append(_CHILD)
+                children.append(value)
+            elif isinstance(value, list):
+                items = []
+                for item in value:
+                    if isinstance(item, ast.AST):
+                        items.append(_CHILD)
+                        children.append(item)
+                    else:
+                        items.append(repr(item))
+                layout.append(tuple(items))
+            elif node_type is ast.Name and field == 'id' and value not in builtin_names:
+                layout.append(_VARIABLE)
+                name = names.setdefault(value, len(names))
+            else:
+                if abstracted is not None and field == abstracted[0]:
+                    abstract_at = len(layout)
+                layout.append(repr(value))
+
+        label = _intern_label((node_type.__name__, tuple(layout)))
+        if loose:
+            loose_label, loose_name = label, name
+            if abstract_at >= 0 and loose[-1][2] >= abstracted[1]:
+                value = getattr(node, abstracted[0])
+                if node_type is not ast.arg:
+                    layout[abstract_at] = _abstract_value(node_type, value)
+                elif value not in builtin_names:
+                    layout[abstract_at] = _VARIABLE
+                    loose_name = names.setdefault(value, len(names))
+                loose_label = _intern_label((node_type.__name__, tuple(layout)))
+            for _, labels, rank in loose:
+                labels.append(loose_label if abstracted is not None and rank >= abstracted[1]
+                              else label)
+            flat.level_names.append(loose_name)
+
+        lineno = getattr(node, 'lineno', 0)
+        flat.types.append(_intern_type(node_type))
+        flat.parents.append(parent)
+        flat.sizes.append(1)
+        flat.names.append(name)
+        flat.labels.append(label)
+        flat.linenos.append(lineno)
+        flat.end_linenos.append(getattr(node, 'end_lineno', None) or lineno)
+        flat.col_offsets.append(getattr(node, 'col_offset', 0))
+        flat.end_col_offsets.append(getattr(node, 'end_col_offset', None) or 0)
+
+        for child in reversed(children):
+            stack.append((child, index))
+
+    # Children follow their parent in pre-order, so one backwards sweep sizes everything
+    sizes = flat.sizes
+    parents = flat.parents
+    for i in range(len(sizes) - 1, 0, -1):
+        sizes[parents[i]] += sizes[i]
+
+    return flat
+
+
+class NodeRecord(NamedTuple):
+    """Compact, picklable description of one candidate node"""
+    fingerprint: str
+    filepath: str
+    lineno: int
+    complexity: int
+    index: int  # position of the node in a pre-order walk of its file
+    end_lineno: int = 0
+    col_offset: int = 0
+    end_col_offset: int = 0
+    parent: int = -1  # pre-order index of the nearest enclosing candidate, -1 for the module
+
+
+def _preorder_nodes(tree: ast.AST) -> List[ast.AST]:
+    """List every node of a tree in the order ``extract_all_nodes`` visits them"""
+    return _preorder_with_parents(tree)[0]
+
+
+def _preorder_with_parents(tree: ast.AST) -> Tuple[List[ast.AST], List[int]]:
+    """Pre-order nodes of a tree along with the index of each node's parent"""
+    nodes = []
+    parents = []
+    stack = [(tree, -1)]
+    while stack:
+        node, parent = stack.pop()
+        index = len(nodes)
+        nodes.append(node)
+        parents.append(parent)
+        for child in reversed(list(ast.iter_child_nodes(node))):
+            stack.append((child, index))
+    return nodes, parents
+
+
+def _flat_records(filepath: str, flat: FlatTree, min_complexity: int,
+                  levels: Sequence[str] = ("names",),
+                  granularity: Optional[Sequence[str]] = None) -> List[NodeRecord]:
+    """Build the records of a file from its ``FlatTree``.
+
+    With several ``levels`` (strictest first), a candidate only gets a record
+    at a looser level if that level changes its form: otherwise it matches
+    exactly the nodes it already matched. With a ``granularity`` only nodes
+    of those kinds are candidates, and each record's parent is its nearest
+    enclosing candidate.
+    """
+    sizes = flat.sizes
+    parents = flat.parents
+    kinds = _granularity_types(granularity)
+    if kinds is None:
+        candidates = [
+            i for i in range(len(sizes))
+            if sizes[i] >= min_complexity and not flat.is_trivial(i)
         ]
+    else:
+        # Decide once per interned type rather than once per node
+        chosen = [False] * len(_TYPE_IS_TRIVIAL)
+        for node_type, type_id in _TYPE_IDS.items():
+            chosen[type_id] = issubclass(node_type, kinds) and not _TYPE_IS_TRIVIAL[type_id]
+        selected = [chosen[type_id] for type_id in flat.types]
+        candidates = [i for i in range(len(sizes)) if selected[i] and sizes[i] >= min_complexity]
+        if candidates:
+            parents = _enclosing_candidates(parents, selected)
+    if not candidates:
+        return []
+
+    if len(levels) == 1:
+        by_level = {levels[0]: flat.fingerprints(levels[0])}
+    else:
+        by_level = flat.level_fingerprints(levels)
+    records = []
+    previous = None
+    for level, digests in by_level.items():
+        records.extend(
+            NodeRecord(_level_form(level, digests[i].hex()), filepath, flat.linenos[i],
+                       sizes[i], i, flat.end_linenos[i], flat.col_offsets[i],
+                       flat.end_col_offsets[i], parents[i])
+            for i in candidates
+            if previous is None or digests[i] is not previous[i]
+        )
+        previous = digests
+    return records
+
+
+def _parse_or_warn(filepath: str) -> Optional[ast.AST]:
+    """Parse a file, reporting on stderr and returning None if it cannot be parsed"""
+    if not os.path.exists(filepath):
+        print(f"Warning: File {filepath} not found", file=sys.stderr)
+        return None
+
+    try:
+        return parse_python_file(filepath)
+    except (SyntaxError, OSError, UnicodeDecodeError) as e:
+        print(f"Error parsing {filepath}: {e}", file=sys.stderr)
+        return None
+    except RecursionError:
+        # Everything after parsing is iterative; only CPython's parser has a depth limit
+        print(f"Error parsing {filepath}: nested too deeply for the Python parser",
+              file=sys.stderr)
+        return None
+
+
+def _node_record(generic_form: str, filepath: str, node: ast.AST, complexity: int,
+                 index: int, parent: int) -> NodeRecord:
+    lineno = node.lineno if hasattr(node, 'lineno') else 0
+    return NodeRecord(
+        generic_form, filepath, lineno, complexity, index,
+        getattr(node, 'end_lineno', None) or lineno,
+        getattr(node, 'col_offset', 0),
+        getattr(node, 'end_col_offset', None) or 0,
+        parent,
+    )
+
 
-        # Compact header: [complexity] Nx: file:line, file:line, ...
-        print(f"[{result.complexity}] {result.repetition}x: {', '.join(locations)}")
+def _analyze_file(filepath: str, min_complexity: int, engine: str,
+                  builtin_names: Set[str],
+                  stats: Optional[FileStats] = None,
+                  normalize: Sequence[str] = ("names",),
+                  granularity: Optional[Sequence[str]] = None) -> Optional[List[NodeRecord]]:
+    """Parse one file and fingerprint its candidate nodes.
 
-        # Show code only once (from first instance)
-        _, _, first_node = result.original_nodes[0]
+    Returns ``None`` when the file could not be read or parsed. The number
+    of nodes visited is stored in ``stats`` if given. ``normalize`` lists
+    the levels to fingerprint at, strictest first, and ``granularity`` the
+    node kinds to keep (see ``_flat_records``); the flat engine computes all
+    levels in one pass.
+    """
+    tree = _parse_or_warn(filepath)
+    if tree is None:
+        return None
+
+    if engine == "flat":
+        flat = flatten_tree(tree, builtin_names, normalize)
+        if stats is not None:
+            stats.nodes = len(flat.types)
+        return _flat_records(filepath, flat, min_complexity, normalize, granularity)
+
+    sizes = compute_subtree_sizes(tree)
+    nodes, parents = _preorder_with_parents(tree)
+    if stats is not None:
+        stats.nodes = len(nodes)
+    kinds = _granularity_types(granularity)
+    # Prune small subtrees and other kinds before they reach normalization
+    candidates = [
+        (index, node) for index, node in enumerate(nodes)
+        if not isinstance(node, _TRIVIAL_NODES) and sizes[node] >= min_complexity
+        and (kinds is None or isinstance(node, kinds))
+    ]
+    if not candidates:
+        return []
+    if kinds is not None:
+        parents = _enclosing_candidates(parents, [
+            isinstance(node, kinds) and not isinstance(node, _TRIVIAL_NODES) for node in nodes
+        ])
+
+    records = []
+    previous = None
+    for level in normalize:
+        fingerprints = None
+        if engine == "tree":
+            fingerprints = compute_fingerprints(tree, builtin_names, level)
+        forms = []
+        for (index, node), earlier in zip(candidates, previous or itertools.repeat(None)):
+            if fingerprints is not None:
+                generic_form = fingerprints[node].hex()
+            else:
+                generic_form = normalized_dump(node, builtin_names, level)
+            forms.append(generic_form)
+            if generic_form != earlier:
+                records.append(_node_record(_level_form(level, generic_form), filepath, node,
+                                            sizes[node], index, parents[index]))
+        previous = forms
+
+    return records
+
+
+def analyze_file(filepath: str, min_complexity: int = 3, engine: str = "flat",
+                 normalize: Sequence[str] = ("names",),
+                 granularity: Optional[Sequence[str]] = None) -> Optional[List[NodeRecord]]:
+    """Return the fingerprint records of one file without keeping its AST.
+
+    This is the unit of work shipped to worker processes by ``find_repetitions``.
+    Returns ``None`` when the file could not be read or parsed. ``normalize``
+    lists the normalization levels to fingerprint at and ``granularity`` the
+    node kinds to fingerprint (see ``extract_all_nodes``).
+    """
+    return _analyze_file(filepath, min_complexity, engine, get_builtin_names(),
+                         normalize=_ordered_levels(normalize), granularity=granularity)
+
+
+def _analyze_file_measured(filepath: str, min_complexity: int, engine: str,
+                           normalize: Sequence[str] = ("names",),
+                           granularity: Optional[Sequence[str]] = None
+                           ) -> Tuple[Optional[List[NodeRecord]], FileStats]:
+    """``analyze_file`` that also reports what the file cost"""
+    stats = FileStats(filepath)
+    start = time.perf_counter()
+    records = _analyze_file(filepath, min_complexity, engine, get_builtin_names(), stats,
+                            normalize, granularity)
+    stats.seconds = time.perf_counter() - start
+    try:
+        stats.bytes_read = os.path.getsize(filepath)
+    except OSError:
+        pass
+    stats.candidates = len(records or ())
+    return records, stats
+
+
+def _tool_version() -> str:
+    """Version of the installed package, used to invalidate cached records"""
+    try:
+        from . import __version__
+    except ImportError:
+        return "unknown"
+    return __version__
+
+
+def _interpreter() -> str:
+    """Python implementation and minor version; ``ast`` output differs between them"""
+    return f"{sys.implementation.name}-{sys.version_info[0]}.{sys.version_info[1]}"
+
+
+# Returned by ``FingerprintCache.load`` for a file that last failed to parse
+_UNPARSEABLE: List[NodeRecord] = []
+
+
+class FingerprintCache:
+    """On-disk store of per-file ``NodeRecord``s.
+
+    Each analyzed file gets one JSON entry keyed by its absolute path. An entry
+    is reused when the file's size and mtime are unchanged, or failing that
+    when its content hash still matches, and only if it was produced by the
+    same tool version, interpreter and analysis settings. Files that could not
+    be parsed get an entry too, so they are not parsed again until they change.
+
+    ``prune`` keeps a manifest of the path behind each entry, so that it only
+    has to read the entries written since it last ran.
+    """
+
+    MANIFEST = 'paths.manifest'
+
+    def __init__(self, directory: str = DEFAULT_CACHE_DIR, **settings):
+        self.directory = directory
+        self.settings = dict(settings, version=_tool_version(), format=CACHE_FORMAT,
+                             interpreter=_interpreter())
+
+    def _entry_path(self, filepath: str) -> str:
+        key = hashlib.sha1(os.path.abspath(filepath).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, key + '.json')
+
+    @staticmethod
+    def _content_hash(filepath: str) -> str:
+        with open(filepath, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+
+    def load(self, filepath: str) -> Optional[List[NodeRecord]]:
+        """Return the cached records of a file, or None if they are stale.
+
+        A file cached as unparseable gives ``_UNPARSEABLE``.
+        """
+        entry_path = self._entry_path(filepath)
         try:
-            print(ast.unparse(first_node))
-        except AttributeError:
-            # Fallback for Python < 3.9
-            print(ast.dump(first_node, indent=2))
+            with open(entry_path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+            stat = os.stat(filepath)
+        except (OSError, ValueError):
+            return None
 
-        print()
-        print("=" * 70)
-        print()
+        if entry.get('settings') != self.settings:
+            return None
+        if (entry['size'], entry['mtime_ns']) != (stat.st_size, stat.st_mtime_ns):
+            try:
+                if entry['sha256'] != self._content_hash(filepath):
+                    return None
+            except OSError:
+                return None
+            # Touched but unchanged: refresh the stat key for the next run
+            entry['size'], entry['mtime_ns'] = stat.st_size, stat.st_mtime_ns
+            self._write(entry_path, entry)
 
+        if entry['records'] is None:
+            return _UNPARSEABLE
+        return [NodeRecord(fingerprint, filepath, *fields)
+                for fingerprint, *fields in entry['records']]
 
-def collect_python_files(paths: List[str]) -> List[str]:
-    """Collect all Python files from given paths"""
-    files = []
-    
-    for path in paths:
-        if os.path.isfile(path) and path.endswith('.py'):
-            files.append(path)
-        elif os.path.isdir(path):
-            for root, dirs, filenames in os.walk(path):
-                for filename in filenames:
-                    if filename.endswith('.py'):
-                        files.append(os.path.join(root, filename))
-    
-    return files
+    def store(self, filepath: str, records: Optional[List[NodeRecord]]) -> None:
+        """Save the records of a freshly analyzed file, None if it could not be parsed"""
+        try:
+            stat = os.stat(filepath)
+            content_hash = self._content_hash(filepath)
+        except OSError:
+            return
+        self._write(self._entry_path(filepath), {
+            'path': os.path.abspath(filepath),
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'sha256': content_hash,
+            'settings': self.settings,
+            'records': None if records is None else [[r.fingerprint, *r[2:]] for r in records],
+        })
 
+    def _write(self, entry_path: str, entry: dict) -> None:
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            tmp_path = f"{entry_path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(entry, f, separators=(',', ':'))
+            os.replace(tmp_path, entry_path)
+        except OSError as e:
+            print(f"Warning: could not write cache entry {entry_path}: {e}", file=sys.stderr)
 
-def main() -> None:
-    parser = argparse.ArgumentParser(description='Find repetitions in Python code')
-    parser.add_argument('paths', nargs='+', help='Python files or directories to analyze')
-    parser.add_argument('--min-complexity', type=int, default=4, 
-                       help='Minimum complexity threshold (default: 4)')
-    parser.add_argument('--min-repetition', type=int, default=2, 
-                       help='Minimum repetition threshold (default: 2)')
-    parser.add_argument('--sort', choices=['complexity', 'repetition'], default='complexity',
-                       help='Sort by complexity or repetition (default: complexity)')
-    
-    args = parser.parse_args()
-    
-    # Collect all Python files
-    files = collect_python_files(args.paths)
-    
-    if not files:
-        print("No Python files found", file=sys.stderr)
-        sys.exit(1)
-    
-    print(f"Analyzing {len(files)} Python files...")
-    
-    # Find repetitions
-    results = find_repetitions(files, args.min_complexity, args.min_repetition)
-    
-    if not results:
-        print("No repetitions found")
+    def prune(self) -> int:
+        """Delete entries of files that no longer exist; return how many"""
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return 0
+        manifest_path = os.path.join(self.directory, self.MANIFEST)
+        try:
+            with open(manifest_path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            manifest = {}
+
+        paths = {}
+        removed = 0
+        for name in names:
+            if not name.endswith('.json'):
+                continue
+            entry_path = os.path.join(self.directory, name)
+            path = manifest.get(name)
+            if path is None:
+                # Written since the last prune: the entry itself names its file
+                try:
+                    with open(entry_path, 'r', encoding='utf-8') as f:
+                        path = json.load(f)['path']
+                except (OSError, ValueError, KeyError):
+                    path = None
+            if path is not None and os.path.exists(path):
+                paths[name] = path
+                continue
+            try:
+                os.remove(entry_path)
+                removed += 1
+            except OSError:
+                pass
+
+        if paths != manifest:
+            if paths:
+                self._write(manifest_path, paths)
+            else:
+                try:
+                    os.remove(manifest_path)
+                except OSError:
+                    pass
+        return removed
+
+
+# Files per pool task when the file count is not known up front
+_STREAM_CHUNKSIZE = 8
+
+
+def _map_files(worker: Callable, files: Iterable[str], jobs: int) -> Iterator:
+    """Apply a per-file worker in order, in this process or in a process pool.
+
+    ``files`` may be a lazy iterable: workers start on the first files
+    while the rest are still being discovered.
+    """
+    sized = isinstance(files, (list, tuple))
+    if jobs == 1 or (sized and len(files) < 2):
+        for filepath in files:
+            yield worker(filepath)
         return
+
+    chunksize = max(1, len(files) // (jobs * 4)) if sized else _STREAM_CHUNKSIZE
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        # map() yields in submission order, which keeps the output deterministic
+        yield from executor.map(worker, files, chunksize=chunksize)
+
+
+def _iter_analyzed(files: Iterable[str], min_complexity: int, engine: str, jobs: int,
+                   hooks: Optional[ScanHooks] = None,
+                   normalize: Sequence[str] = ("names",),
+                   granularity: Optional[Sequence[str]] = None
+                   ) -> Iterator[Optional[List[NodeRecord]]]:
+    """Analyze files in order, in this process or fanned out to a process pool"""
+    if hooks is None:
+        worker = partial(analyze_file, min_complexity=min_complexity, engine=engine,
+                         normalize=normalize, granularity=granularity)
+        return _map_files(worker, files, jobs)
+    return _iter_measured(files, min_complexity, engine, jobs, hooks, normalize, granularity)
+
+
+def _iter_measured(files: Iterable[str], min_complexity: int, engine: str, jobs: int,
+                   hooks: ScanHooks,
+                   normalize: Sequence[str] = ("names",),
+                   granularity: Optional[Sequence[str]] = None
+                   ) -> Iterator[Optional[List[NodeRecord]]]:
+    worker = partial(_analyze_file_measured, min_complexity=min_complexity, engine=engine,
+                     normalize=normalize, granularity=granularity)
+    for records, stats in _map_files(worker, files, jobs):
+        hooks.file_analyzed(stats)
+        yield records
+
+
+def _iter_file_records(files: Iterable[str], min_complexity: int, engine: str, jobs: int,
+                       cache: Optional[FingerprintCache] = None,
+                       known: Optional[Dict[str, List[NodeRecord]]] = None,
+                       hooks: Optional[ScanHooks] = None,
+                       normalize: Sequence[str] = ("names",),
+                       granularity: Optional[Sequence[str]] = None
+                       ) -> Iterator[Tuple[str, List[NodeRecord]]]:
+    """Yield (file, records) in file order, analyzing only cache misses.
+
+    Files that cannot be parsed are skipped. ``known`` maps files already
+    analyzed during this run to their records. ``files`` is read once and
+    lazily, so paths can stream in while earlier files are analyzed.
+    ``normalize`` and ``granularity`` are passed on to ``analyze_file``.
+    """
+    known = known or {}
+    # (file, records) in file order; records is None until a miss is analyzed
+    order = deque()
+
+    def misses() -> Iterator[str]:
+        for filepath in files:
+            records = known.get(filepath)
+            if records is None and cache is not None:
+                records = cache.load(filepath)
+                if records is not None and hooks is not None:
+                    hooks.file_analyzed(FileStats(filepath, candidates=len(records),
+                                                  cached=True))
+                if records is _UNPARSEABLE:
+                    print(f"Error parsing {filepath}: unchanged since it last failed to parse",
+                          file=sys.stderr)
+                    continue
+            order.append((filepath, records))
+            if records is None:
+                yield filepath
+
+    analyzed = _iter_analyzed(misses(), min_complexity, engine, jobs, hooks, normalize,
+                              granularity)
+    ready = deque()  # analyzed records not yet matched with their place in ``order``
+    while True:
+        if not order:
+            # Pulling the next analysis also discovers the files before it
+            try:
+                ready.append(next(analyzed))
+            except StopIteration:
+                if not order:
+                    return
+            continue
+        filepath, records = order.popleft()
+        if records is None:
+            records = ready.popleft() if ready else next(analyzed)
+            if cache is not None:
+                cache.store(filepath, records)
+            if records is None:
+                continue
+        yield filepath, records
+
+
+def _iter_changed_matches(files: List[str], changed: Set[str], min_complexity: int,
+                          engine: str, jobs: int, cache: Optional[FingerprintCache] = None,
+                          hooks: Optional[ScanHooks] = None,
+                          normalize: Sequence[str] = ("names",),
+                          granularity: Optional[Sequence[str]] = None
+                          ) -> Iterator[Tuple[str, List[NodeRecord]]]:
+    """Yield (file, records) in file order, keeping forms that occur in a changed file.
+
+    Changed files are analyzed first; the rest of the tree, usually served
+    by the cache, is then only matched against their fingerprints, so the
+    group table holds the few forms a change can touch.
+    """
+    changed_files = [filepath for filepath in files if filepath in changed]
+    known = dict(_iter_file_records(changed_files, min_complexity, engine, jobs, cache,
+                                    hooks=hooks, normalize=normalize, granularity=granularity))
+    wanted = {record.fingerprint for records in known.values() for record in records}
+    for filepath, records in _iter_file_records(files, min_complexity, engine, jobs, cache, known,
+                                                hooks, normalize=normalize,
+                                                granularity=granularity):
+        yield filepath, [record for record in records if record.fingerprint in wanted]
+
+
+def git_changed_files(ref: str, cwd: Optional[str] = None) -> List[str]:
+    """Absolute paths of files changed since the merge base of ``ref`` and HEAD.
+
+    The repository is the one holding ``cwd``, by default the working
+    directory. Uncommitted and untracked files count as changed; deleted
+    ones do not. Raises ``subprocess.CalledProcessError`` if git fails, e.g.
+    on a bad ref.
+    """
+    def git(*args, cwd=cwd):
+        return subprocess.run(('git',) + args, cwd=cwd, check=True, capture_output=True,
+                              text=True).stdout
+
+    root = git('rev-parse', '--show-toplevel').strip()
+    base = git('merge-base', ref, 'HEAD', cwd=root).strip()
+    names = git('diff', '--name-only', '--diff-filter=d', base, '--', cwd=root).splitlines()
+    # ls-files only lists what is under its working directory
+    names += git('ls-files', '--others', '--exclude-standard', cwd=root).splitlines()
+    return [os.path.join(root, name) for name in names if name]
+
+
+Group = Tuple[str, List[NodeRecord]]
+RunGroup = Tuple[str, List[List[NodeRecord]]]  # every occurrence is a list of statements
+
+# Out-of-core grouping: records are first spread over _SPILL_PARTITIONS files;
+# a partition whose records would not fit the memory budget is split again
+# _SPILL_FANOUT ways with a different hash seed, up to _SPILL_MAX_DEPTH levels.
+_SPILL_PARTITIONS = 64
+_SPILL_FANOUT = 16
+_SPILL_MAX_DEPTH = 4
+_SPILL_MEMORY_FACTOR = 4  # bytes of grouped records in memory per spilled byte
+
+_SIZE_SUFFIXES = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+
+def _parse_size(text: str) -> int:
+    """Parse a byte count such as ``1048576``, ``512M`` or ``2G``"""
+    value = text.strip().upper()
+    if value.endswith('B'):
+        value = value[:-1]
+    suffix = value[-1:] if value[-1:] in _SIZE_SUFFIXES else ''
+    try:
+        size = int(float(value[:len(value) - len(suffix)]) * _SIZE_SUFFIXES[suffix])
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid size: {text!r}")
+    if size <= 0:
+        raise argparse.ArgumentTypeError(f"size must be positive: {text!r}")
+    return size
+
+
+def _spill_partition(fingerprint: str, seed: int, count: int) -> int:
+    return zlib.crc32(fingerprint.encode('utf-8'), seed) % count
+
+
+def _group_spill_file(path: str, depth: int, filepaths: List[str], min_repetition: int,
+                      max_memory: int) -> Iterator[List[Tuple[int, NodeRecord]]]:
+    """Yield the repeated groups of one spill file as (sequence, record) lists"""
+    if depth < _SPILL_MAX_DEPTH and os.path.getsize(path) * _SPILL_MEMORY_FACTOR > max_memory:
+        parts = [f"{path}.{i}" for i in range(_SPILL_FANOUT)]
+        outputs = [open(part, 'w', encoding='utf-8') for part in parts]
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    fingerprint = line[:line.index('\t')]
+                    outputs[_spill_partition(fingerprint, depth, _SPILL_FANOUT)].write(line)
+        finally:
+            for output in outputs:
+                output.close()
+        os.remove(path)
+        for part in parts:
+            yield from _group_spill_file(part, depth + 1, filepaths, min_repetition, max_memory)
+        return
+
+    groups = defaultdict(list)
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            fingerprint, seq, file_id, *fields = line.rstrip('\n').split('\t')
+            record = NodeRecord(fingerprint, filepaths[int(file_id)], *map(int, fields))
+            groups[fingerprint].append((int(seq), record))
+    os.remove(path)
+
+    for instances in groups.values():
+        if len(instances) >= min_repetition:
+            yield instances
+
+
+def _group_out_of_core(file_records: Iterable[List[NodeRecord]],
+                       min_repetition: int, max_memory: int) -> List[Group]:
+    """Group records through hash-partitioned spill files on disk.
+
+    Every record gets a global sequence number so that groups and their
+    instances come out in the same order as ``RepetitionIndex`` would give.
+    """
+    repeated = []
+    with tempfile.TemporaryDirectory(prefix='repetition_hunter_') as spill_dir:
+        paths = [os.path.join(spill_dir, f"part{i}") for i in range(_SPILL_PARTITIONS)]
+        file_ids = {}
+        seq = 0
+        outputs = [open(path, 'w', encoding='utf-8') for path in paths]
+        try:
+            for records in file_records:
+                for record in records:
+                    file_id = file_ids.setdefault(record.filepath, len(file_ids))
+                    output = outputs[_spill_partition(record.fingerprint, 0, _SPILL_PARTITIONS)]
+                    fields = '\t'.join(map(str, record[2:]))
+                    output.write(f"{record.fingerprint}\t{seq}\t{file_id}\t{fields}\n")
+                    seq += 1
+        finally:
+            for output in outputs:
+                output.close()
+
+        filepaths = list(file_ids)
+        for path in paths:
+            repeated.extend(_group_spill_file(path, 1, filepaths, min_repetition, max_memory))
+
+    repeated.sort(key=lambda instances: instances[0][0])
+    return [
+        (instances[0][1].fingerprint, [record for _, record in instances])
+        for instances in repeated
+    ]
+
+
+def _index_forms(tree: ast.AST, nodes: List[ast.AST], indices: Iterable[int],
+                 engine: str) -> Dict[int, str]:
+    """Fingerprint the nodes at some pre-order indices with the chosen engine.
+
+    The legacy engine's dumps are hashed so every engine yields hex digests.
+    """
+    builtin_names = get_builtin_names()
+    if engine == "flat":
+        digests = flatten_tree(tree, builtin_names).fingerprints()
+        return {index: digests[index].hex() for index in indices}
+    if engine == "tree":
+        fingerprints = compute_fingerprints(tree, builtin_names)
+        return {index: fingerprints[nodes[index]].hex() for index in indices}
+    return {
+        index: hashlib.blake2b(
+            normalized_dump(nodes[index], builtin_names).encode('utf-8'),
+            digest_size=16,
+        ).hexdigest()
+        for index in indices
+    }
+
+
+def analyze_statements(filepath: str, min_statements: int = 2,
+                       engine: str = "flat") -> Optional[List[List[NodeRecord]]]:
+    """Fingerprint every statement of every block with at least ``min_statements``.
+
+    Each block (a function body, an ``else`` branch, ...) becomes one list of
+    records in source order, regardless of ``min_complexity``. Returns
+    ``None`` when the file could not be read or parsed.
+    """
+    tree = _parse_or_warn(filepath)
+    if tree is None:
+        return None
+
+    nodes, parents = _preorder_with_parents(tree)
+    index_of = {id(node): index for index, node in enumerate(nodes)}
+    blocks = [
+        [index_of[id(stmt)] for stmt in value]
+        for node in nodes
+        for _, value in ast.iter_fields(node)
+        if isinstance(value, list) and len(value) >= min_statements
+        and isinstance(value[0], ast.stmt)
+    ]
+    if not blocks:
+        return []
+
+    sizes = compute_subtree_sizes(tree)
+    forms = _index_forms(tree, nodes, [index for block in blocks for index in block], engine)
+
+    return [
+        [_node_record(forms[index], filepath, nodes[index], sizes[nodes[index]], index,
+                      parents[index])
+         for index in block]
+        for block in blocks
+    ]
+
+
+def suffix_array(seq: List[int]) -> List[int]:
+    """Sort the suffixes of an integer sequence by prefix doubling.
+
+    Each round orders suffixes by their first 2k symbols with a counting sort
+    keyed on the ranks of the previous round, so the whole sort is O(n log n).
+    """
+    n = len(seq)
+    if n == 0:
+        return []
+    alphabet = {symbol: rank for rank, symbol in enumerate(sorted(set(seq)))}
+    rank = [alphabet[symbol] for symbol in seq]
+    classes = len(alphabet)
+    sa = sorted(range(n), key=rank.__getitem__)
+
+    k = 1
+    while classes < n:
+        # Order by the second half first: suffixes that run out of symbols lead
+        by_second = list(range(n - k, n))
+        by_second.extend(i - k for i in sa if i >= k)
+
+        # Then stable counting sort by the first half
+        starts = [0] * classes
+        for r in rank:
+            starts[r] += 1
+        total = 0
+        for r in range(classes):
+            starts[r], total = total, total + starts[r]
+        for i in by_second:
+            r = rank[i]
+            sa[starts[r]] = i
+            starts[r] += 1
+
+        new_rank = [0] * n
+        classes = 1
+        previous = sa[0]
+        for i in sa[1:]:
+            if (rank[i] != rank[previous] or
+                    (rank[i + k] if i + k < n else -1) !=
+                    (rank[previous + k] if previous + k < n else -1)):
+                classes += 1
+            new_rank[i] = classes - 1
+            previous = i
+        rank = new_rank
+        k *= 2
+
+    return sa
+
+
+def lcp_array(seq: List[int], sa: List[int]) -> List[int]:
+    """Kasai's algorithm: ``lcp[r]`` is the common prefix of ``sa[r - 1]`` and ``sa[r]``"""
+    n = len(seq)
+    rank = [0] * n
+    for r, i in enumerate(sa):
+        rank[i] = r
+
+    lcp = [0] * n
+    h = 0
+    for i in range(n):
+        if rank[i] == 0:
+            h = 0
+            continue
+        j = sa[rank[i] - 1]
+        while i + h < n and j + h < n and seq[i + h] == seq[j + h]:
+            h += 1
+        lcp[rank[i]] = h
+        if h:
+            h -= 1
+    return lcp
+
+
+def _repeated_runs(seq: List[int], min_length: int) -> Iterator[Tuple[int, List[int]]]:
+    """Yield (length, start positions) for every left- and right-maximal repeat.
+
+    Walks the LCP intervals of the suffix array bottom-up with a stack. Each
+    interval is a run that cannot be extended to the right without losing an
+    occurrence; runs whose occurrences are all preceded by the same symbol
+    are skipped because the longer run one symbol to the left covers them.
+    """
+    sa = suffix_array(seq)
+    lcp = lcp_array(seq, sa)
+    stack = [(0, 0)]  # (lcp value, left bound)
+
+    for i in range(1, len(seq) + 1):
+        height = lcp[i] if i < len(seq) else 0
+        left = i - 1
+        while height < stack[-1][0]:
+            length, left = stack.pop()
+            if length >= min_length:
+                starts = sa[left:i]
+                before = {seq[start - 1] if start else None for start in starts}
+                if len(before) > 1 or None in before:
+                    yield length, sorted(starts)
+        if height > stack[-1][0]:
+            stack.append((height, left))
+
+
+def _find_sequence_groups(files: List[str], min_complexity: int, min_repetition: int,
+                          min_statements: int, engine: str, jobs: int) -> List[RunGroup]:
+    """Find runs of at least ``min_statements`` statements repeated across blocks.
+
+    Every block becomes a string of statement fingerprints, blocks are joined
+    with unique separators and repeated runs are read off a suffix array.
+    Statements are normalized one by one, so a run matches when each of its
+    statements does.
+    """
+    worker = partial(analyze_statements, min_statements=min_statements, engine=engine)
+    symbols = {}
+    seq = []
+    statements = []
+    for blocks in _map_files(worker, files, jobs):
+        for block in blocks or ():
+            for record in block:
+                seq.append(symbols.setdefault(record.fingerprint, len(symbols)))
+                statements.append(record)
+            # A separator that matches nothing keeps runs inside one block
+            seq.append(-len(seq) - 1)
+            statements.append(None)
+
+    groups = []
+    for length, starts in _repeated_runs(seq, min_statements):
+        # Tandem repeats (a; a; a) overlap themselves; keep disjoint occurrences
+        occurrences = []
+        for start in starts:
+            if not occurrences or start >= occurrences[-1] + length:
+                occurrences.append(start)
+        if len(occurrences) < min_repetition:
+            continue
+
+        run = statements[occurrences[0]:occurrences[0] + length]
+        if sum(record.complexity for record in run) < min_complexity:
+            continue
+        generic_form = hashlib.blake2b(
+            '\n'.join(record.fingerprint for record in run).encode('utf-8'),
+            digest_size=16,
+        ).hexdigest()
+        instances = [statements[start:start + length] for start in occurrences]
+        groups.append((occurrences[0], generic_form, instances))
+
+    # Positions follow file order, so this matches the order of node groups
+    groups.sort(key=lambda group: group[0])
+    return [(generic_form, instances) for _, generic_form, instances in groups]
+
+
+# Near-miss detection: one-permutation MinHash with _MINHASH_BINS bins,
+# banded for locality-sensitive hashing
+_MINHASH_BINS = 128
+# Neighbours, in size order, each unit of an LSH bucket is scored against
+_BUCKET_WINDOW = 32
+_UNIT_NODES = (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)
+
+
+class UnitRecord(NamedTuple):
+    """A function or class together with the fingerprints of its subtrees"""
+    record: NodeRecord
+    kind: str  # "function" or "class"; only units of one kind are compared
+    shingles: Tuple[int, ...]  # 64-bit prefixes of descendant fingerprints
+
+
+def analyze_units(filepath: str, engine: str = "flat") -> Optional[List[UnitRecord]]:
+    """Describe every function and class of a file by its subtree fingerprints.
+
+    Returns ``None`` when the file could not be read or parsed.
+    """
+    tree = _parse_or_warn(filepath)
+    if tree is None:
+        return None
+
+    nodes, parents = _preorder_with_parents(tree)
+    units = [index for index, node in enumerate(nodes) if isinstance(node, _UNIT_NODES)]
+    if not units:
+        return []
+
+    sizes = compute_subtree_sizes(tree)
+    first = units[0]
+    forms = _index_forms(tree, nodes, range(first, len(nodes)), engine)
+
+    result = []
+    for index in units:
+        node = nodes[index]
+        shingles = tuple(
+            int(forms[i][:16], 16)
+            for i in range(index + 1, index + sizes[node])
+            if not isinstance(nodes[i], _TRIVIAL_NODES)
+        )
+        result.append(UnitRecord(
+            _node_record(forms[index], filepath, node, sizes[node], index, parents[index]),
+            "class" if isinstance(node, ast.ClassDef) else "function",
+            shingles,
+        ))
+    return result
+
+
+def minhash_signature(shingles: Iterable[int], bins: int = _MINHASH_BINS) -> Tuple[int, ...]:
+    """One-permutation MinHash of a set of 64-bit integers, densified by rotation.
+
+    Each hash falls into bin ``h % bins`` and each bin keeps its minimum, so
+    a signature costs one pass instead of one pass per hash function. Empty
+    bins borrow from the next non-empty bin with a per-step offset, which
+    keeps the collision probability of every bin equal to the Jaccard index.
+    """
+    signature = [None] * bins
+    for shingle in set(shingles):
+        # Mix the bits so inputs that are not already uniform still spread out
+        h = (shingle * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+        h ^= h >> 29
+        b = h % bins
+        value = h // bins
+        if signature[b] is None or value < signature[b]:
+            signature[b] = value
+
+    if all(value is None for value in signature):
+        return tuple([0] * bins)
+    offset = 1 << 60
+    filled = list(signature)
+    for b in range(bins):
+        if filled[b] is None:
+            step = 1
+            while signature[(b + step) % bins] is None:
+                step += 1
+            filled[b] = signature[(b + step) % bins] + step * offset
+    return tuple(filled)
+
+
+def _lsh_bands(threshold: float, bins: int = _MINHASH_BINS) -> Tuple[int, int]:
+    """Pick (bands, rows) whose S-curve threshold sits just below ``threshold``"""
+    best = (bins, 1)
+    for rows in range(1, bins + 1):
+        if bins % rows:
+            continue
+        bands = bins // rows
+        if (1 / bands) ** (1 / rows) <= threshold * 0.9:
+            best = (bands, rows)
+    return best
+
+
+def tree_similarity(a: Iterable[int], b: Iterable[int]) -> float:
+    """Weighted Jaccard index of two multisets of subtree fingerprints.
+
+    Counts each shared subtree as often as it occurs in both, so the score
+    is bounded by the smaller tree and computed in O(|a| + |b|). Either
+    side may already be a ``Counter``.
+    """
+    count_a = a if isinstance(a, Counter) else Counter(a)
+    count_b = b if isinstance(b, Counter) else Counter(b)
+    total = sum(count_a.values()) + sum(count_b.values())
+    if not total:
+        return 1.0
+    shared = sum((count_a & count_b).values())
+    return shared / (total - shared)
+
+
+def _find_similar_groups(files: List[str], min_complexity: int, min_repetition: int,
+                         threshold: float, engine: str, jobs: int,
+                         hooks: Optional[ScanHooks] = None
+                         ) -> List[Tuple[float, List[NodeRecord]]]:
+    """Cluster functions and classes that are similar but not identical.
+
+    Units with the same shingles are scored once, through one representative.
+    Representatives are bucketed by MinHash bands and sorted by size, and
+    each is scored with ``tree_similarity`` against the up to
+    ``_BUCKET_WINDOW`` next smaller members of each of its buckets, once per
+    neighbour and never when both are already clustered together. The work
+    so grows linearly with a bucket rather than with its square. Pairs at or above ``threshold`` are joined with union-find
+    and every cluster reports its weakest link. The number of scored pairs is
+    counted as ``similarity_pairs``.
+    """
+    worker = partial(analyze_units, engine=engine)
+    units = [
+        unit
+        for analyzed in _map_files(worker, files, jobs)
+        for unit in analyzed or ()
+        if unit.record.complexity >= min_complexity
+    ]
+
+    parent = list(range(len(units)))
+
+    def find(x):
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    # Units with equal shingles score 1.0 against each other and the same
+    # against everything else: only the first of them is paired
+    representatives = {}
+    for number, unit in enumerate(units):
+        parent[number] = representatives.setdefault((unit.kind, tuple(sorted(unit.shingles))),
+                                                    number)
+
+    bands, rows = _lsh_bands(threshold)
+    buckets = defaultdict(list)
+    for number in representatives.values():
+        unit = units[number]
+        signature = minhash_signature(unit.shingles)
+        for band in range(bands):
+            buckets[(unit.kind, band, signature[band * rows:(band + 1) * rows])].append(number)
+
+    # Every unit's place in each of its buckets, in one order of size for all
+    order = sorted(representatives.values(), key=lambda number: (len(units[number].shingles),
+                                                                  number))
+    rank = {number: position for position, number in enumerate(order)}
+    slots = defaultdict(list)
+    for members in buckets.values():
+        if len(members) < 2:
+            continue
+        members.sort(key=rank.__getitem__)
+        for position, number in enumerate(members):
+            if position:
+                slots[number].append((members, position))
+
+    counters = {}
+    scores = {}
+    pairs = 0
+    for b in order:
+        size_b = len(units[b].shingles)
+        # Neighbours shared by several bands are scored once
+        neighbours = set()
+        for members, position in slots.get(b, ()):
+            for a in reversed(members[max(0, position - _BUCKET_WINDOW):position]):
+                if len(units[a].shingles) < threshold * size_b:
+                    break  # Smaller still from here on
+                neighbours.add(a)
+        for a in sorted(neighbours, key=rank.__getitem__, reverse=True):
+            root_a, root_b = find(a), find(b)
+            if root_a == root_b:
+                continue
+            for number in (a, b):
+                if number not in counters:
+                    counters[number] = Counter(units[number].shingles)
+            pairs += 1
+            score = tree_similarity(counters[a], counters[b])
+            if score < threshold:
+                continue
+            weakest = min(score, scores.pop(root_a, 1.0), scores.pop(root_b, 1.0))
+            parent[root_b] = root_a
+            scores[root_a] = weakest
+    if hooks is not None:
+        hooks.count("similarity_pairs", pairs)
+
+    clusters = defaultdict(list)
+    for number in range(len(units)):
+        clusters[find(number)].append(number)
+
+    return [
+        (scores.get(root, 1.0), [units[number].record for number in members])
+        for root, members in clusters.items()
+        if len(members) >= max(2, min_repetition)
+        # Exact clones alone are reported by the exact search
+        and len({units[number].record.fingerprint for number in members}) > 1
+    ]
+
+
+def drop_subsumed_groups(groups: List[Group], runs: Sequence[RunGroup] = ()
+                         ) -> Tuple[List[Group], List[RunGroup]]:
+    """Keep only maximal clones.
+
+    A node group is dropped when all its instances sit inside instances of
+    one single larger clone: the parent of each belongs to that group, or the
+    instance (or its parent) is a statement of one repeated run. A run is
+    dropped when the blocks of all its occurrences belong to one node group.
+    Groups are visited from the most complex down, and instances of dropped
+    groups stand for whatever encloses them, so a clone nested several levels
+    deep inside another one is dropped too. A group with any instance outside
+    such an enclosing clone is kept whole. Only clones found at the same
+    normalization level enclose each other; runs are at the names level.
+    Runs in O(g log g + instances).
+    """
+    units = [(instances[0].complexity, 'node', number, instances, form_level(form))
+             for number, (form, instances) in enumerate(groups)]
+    units.extend((sum(record.complexity for record in occurrences[0]), 'run', number, occurrences,
+                  "names")
+                 for number, (_, occurrences) in enumerate(runs))
+    units.sort(key=lambda unit: unit[0], reverse=True)
+
+    # (level, file, node index) -> outermost kept clone containing that node
+    container = {}
+    dropped = set()
+    for _, kind, number, instances, level in units:
+        if kind == 'node':
+            enclosing = {
+                container.get((level, record.filepath, record.index))
+                or container.get((level, record.filepath, record.parent))
+                for record in instances
+            }
+        else:
+            enclosing = {container.get((level, run[0].filepath, run[0].parent))
+                         for run in instances}
+
+        if len(enclosing) == 1 and None not in enclosing:
+            dropped.add((kind, number))
+            owner = enclosing.pop()
+        else:
+            owner = (kind, number)
+
+        if kind == 'node':
+            for record in instances:
+                container[(level, record.filepath, record.index)] = owner
+        else:
+            for run in instances:
+                for record in run:
+                    container[(level, record.filepath, record.index)] = owner
+
+    return (
+        [group for number, group in enumerate(groups) if ('node', number) not in dropped],
+        [group for number, group in enumerate(runs) if ('run', number) not in dropped],
+    )
+
+
+def drop_repeated_levels(groups: List[Group]) -> List[Group]:
+    """Drop groups a stricter normalization level found with the same instances.
+
+    A looser level only adds a group worth reporting when it matches nodes
+    the stricter ones do not group together.
+    """
+    keys = [(tuple((record.filepath, record.index) for record in instances),
+             NORMALIZE_LEVELS.index(form_level(form)))
+            for form, instances in groups]
+    strictest = {}
+    for key, rank in keys:
+        if rank < strictest.get(key, len(NORMALIZE_LEVELS)):
+            strictest[key] = rank
+    return [group for group, (key, rank) in zip(groups, keys) if strictest[key] == rank]
+
+
+class RepetitionIndex:
+    """Fingerprint records of a set of files and the groups they form.
+
+    Files are added, updated and removed one at a time and only those files
+    are analyzed; ``repetitions`` answers from the group table and memoizes
+    its results until the next change. Records are kept for nodes of at
+    least ``min_complexity``, the lowest threshold that can be queried.
+
+        index = RepetitionIndex()
+        index.add_files(collect_python_files(["src"]))
+        for result in index:
+            ...
+        index.update_file("src/app.py")
+    """
+
+    def __init__(self, min_complexity: int = 3, engine: str = "flat"):
+        if engine not in ENGINES:
+            raise ValueError(f"Unknown engine: {engine}")
+        self.min_complexity = min_complexity
+        self.engine = engine
+        self.interpreter = _interpreter()  # the one that produced the records
+        self._order = {}  # filepath -> position, so groups come out in file order
+        self._files = {}  # filepath -> records
+        self._groups = defaultdict(dict)  # fingerprint -> filepath -> records
+        self._memo = {}
+        self._nodes = {}  # filepath -> node index -> record, built on demand
+        self._builtin_names = None
+
+    def __len__(self) -> int:
+        return len(self._files)
+
+    def __contains__(self, filepath: str) -> bool:
+        return filepath in self._files
+
+    def __iter__(self) -> Iterator[RepetitionResult]:
+        return iter(self.repetitions())
+
+    @property
+    def files(self) -> List[str]:
+        """Indexed files, in the order they were first added"""
+        return sorted(self._files, key=self._order.__getitem__)
+
+    def records(self, filepath: str) -> List[NodeRecord]:
+        """The records an indexed file contributes, in pre-order"""
+        return self._files[filepath]
+
+    def _analyze(self, filepath: str) -> Optional[List[NodeRecord]]:
+        if self._builtin_names is None:
+            self._builtin_names = get_builtin_names()
+        return _analyze_file(filepath, self.min_complexity, self.engine, self._builtin_names)
+
+    def add_file(self, filepath: str) -> bool:
+        """Analyze and index a new file; False if it could not be parsed"""
+        if filepath in self._files:
+            raise ValueError(f"Already indexed: {filepath}")
+        records = self._analyze(filepath)
+        if records is None:
+            return False
+        self._set_records(filepath, records)
+        return True
+
+    def add_files(self, files: Iterable[str], jobs: int = 1,
+                  cache_dir: Optional[str] = None) -> None:
+        """Index many files at once, in ``jobs`` processes and through a cache.
+
+        Files that are already indexed are analyzed again.
+        """
+        if not jobs:
+            jobs = os.cpu_count() or 1
+        cache = None
+        if cache_dir is not None:
+            cache = FingerprintCache(cache_dir, engine=self.engine,
+                                     min_complexity=self.min_complexity)
+        for filepath, records in _iter_file_records(files, self.min_complexity, self.engine,
+                                                    jobs, cache):
+            self._set_records(filepath, records)
+
+    def update_file(self, filepath: str) -> bool:
+        """Re-analyze an indexed file; if it no longer parses its records are kept"""
+        if filepath not in self._files:
+            raise KeyError(filepath)
+        records = self._analyze(filepath)
+        if records is None:
+            return False
+        self._set_records(filepath, records)
+        return True
+
+    def remove_file(self, filepath: str) -> None:
+        """Drop a file and every instance it contributed"""
+        self._nodes.pop(filepath, None)
+        for record in self._files.pop(filepath):
+            by_file = self._groups.get(record.fingerprint)
+            if by_file is None:
+                continue
+            by_file.pop(filepath, None)
+            if not by_file:
+                del self._groups[record.fingerprint]
+        self._memo.clear()
+
+    def _set_records(self, filepath: str, records: List[NodeRecord]) -> None:
+        if filepath in self._files:
+            self.remove_file(filepath)
+        self._order.setdefault(filepath, len(self._order))
+        self._files[filepath] = records
+        self._nodes.pop(filepath, None)
+        groups = self._groups
+        for record in records:
+            by_file = groups[record.fingerprint]
+            instances = by_file.get(filepath)
+            if instances is None:
+                by_file[filepath] = [record]
+            else:
+                instances.append(record)
+        self._memo.clear()
+
+    def _instances(self, fingerprint: str) -> List[NodeRecord]:
+        """Every record of a form, in file and pre-order"""
+        by_file = self._groups.get(fingerprint)
+        if not by_file:
+            return []
+        if len(by_file) == 1:
+            (instances,) = by_file.values()
+            return instances
+        return [
+            record
+            for filepath in sorted(by_file, key=self._order.__getitem__)
+            for record in by_file[filepath]
+        ]
+
+    def _repeated_groups(self, min_complexity: int, min_repetition: int) -> List[Group]:
+        """Repeated groups in file order, instances in file and pre-order"""
+        order = self._order
+        groups = []
+        for fingerprint in self._groups:
+            instances = self._instances(fingerprint)
+            if len(instances) >= min_repetition and instances[0].complexity >= min_complexity:
+                groups.append((fingerprint, instances))
+        groups.sort(key=lambda group: (order[group[1][0].filepath], group[1][0].index))
+        return groups
+
+    def repetitions(self, min_complexity: Optional[int] = None, min_repetition: int = 2,
+                    maximal_only: bool = True) -> List[RepetitionResult]:
+        """Repeated nodes of the indexed files, without analyzing anything"""
+        if min_complexity is None:
+            min_complexity = self.min_complexity
+        if min_complexity < self.min_complexity:
+            raise ValueError(f"Index only holds nodes of complexity {self.min_complexity} and up")
+        key = (min_complexity, min_repetition, maximal_only)
+        results = self._memo.get(key)
+        if results is None:
+            groups = self._repeated_groups(min_complexity, min_repetition)
+            if maximal_only:
+                groups, _ = drop_subsumed_groups(groups)
+            results = self._memo[key] = _group_results(groups, NodeResolver())
+        return list(results)
+
+    def repetitions_of(self, forms: Iterable[str], min_complexity: Optional[int] = None,
+                       min_repetition: int = 2, maximal_only: bool = True
+                       ) -> List[RepetitionResult]:
+        """The repetitions ``repetitions`` would report for some forms only.
+
+        Same groups as ``drop_subsumed_groups`` keeps, but a group's fate is
+        worked out from the groups of its instances' parents alone, on
+        demand, so only the groups around ``forms`` are looked at.
+        """
+        if min_complexity is None:
+            min_complexity = self.min_complexity
+        forms = set(forms)
+
+        def repeated(form):
+            instances = self._instances(form)
+            return (len(instances) >= min_repetition
+                    and instances[0].complexity >= min_complexity)
+
+        if maximal_only:
+            owners = self._owners(forms, repeated)
+            kept = [form for form in forms if owners[form] == form]
+        else:
+            kept = [form for form in forms if repeated(form)]
+        order = self._order
+        groups = [(form, self._instances(form)) for form in kept]
+        groups.sort(key=lambda group: (order[group[1][0].filepath], group[1][0].index))
+        return _group_results(groups, NodeResolver())
+
+    def _parent(self, record: NodeRecord) -> Optional[NodeRecord]:
+        nodes = self._nodes.get(record.filepath)
+        if nodes is None:
+            nodes = self._nodes[record.filepath] = {
+                other.index: other for other in self._files[record.filepath]}
+        return nodes.get(record.parent)
+
+    def _owners(self, forms: Iterable[str], repeated: Callable[[str], bool]
+                ) -> Dict[str, Optional[str]]:
+        """The clone that stands for each form's instances, as in ``drop_subsumed_groups``.
+
+        That is the form itself when its group is kept, the owner shared by
+        the groups of all its instances' parents when it is dropped, and
+        None when it is not repeated. A kept group is settled by its first
+        instance with an unrepeated parent or a second owner, so common
+        small forms are cheap. Parents are resolved first with an explicit
+        stack; being larger, they never lead back to the form.
+        """
+        owners = {}
+        for form in forms:
+            if form in owners:
+                continue
+            if not repeated(form):
+                owners[form] = None
+                continue
+            # Frames are [form, its instances, owner so far, instance to resume at]
+            stack = [[form, iter(self._instances(form)), None, None]]
+            while stack:
+                frame = stack[-1]
+                current, instances, enclosing, record = frame
+                frame[3] = None
+                owner = None
+                while True:
+                    if record is None:
+                        record = next(instances, None)
+                        if record is None:
+                            owner = enclosing  # Every instance sits inside the same clone
+                            break
+                    parent = self._parent(record)
+                    if parent is None:
+                        owner = current
+                        break
+                    if parent.fingerprint not in owners:
+                        if repeated(parent.fingerprint):
+                            frame[2], frame[3] = enclosing, record
+                            stack.append([parent.fingerprint,
+                                          iter(self._instances(parent.fingerprint)), None, None])
+                            break
+                        owners[parent.fingerprint] = None
+                    outer = owners[parent.fingerprint]
+                    if outer is None or (enclosing is not None and outer != enclosing):
+                        owner = current
+                        break
+                    enclosing, record = outer, None
+                if frame[3] is not None:
+                    continue
+                owners[current] = owner
+                stack.pop()
+        return owners
+
+    def query(self, snippet: str) -> List[Location]:
+        """Every place the indexed files contain ``snippet`` (see ``query_index``)"""
+        forms = snippet_forms(snippet, self.engine, self.min_complexity)
+        return _match_snippet(snippet, forms, lambda form: [
+            record for records in self._groups.get(form, {}).values() for record in records
+        ])
+
+    def save(self, path: str) -> None:
+        """Write the index to an SQLite file that ``load`` and ``query_index`` read"""
+        with _IndexWriter(path, self.engine, self.min_complexity, self.interpreter) as writer:
+            for filepath in self.files:
+                writer.add(filepath, self._files[filepath])
+
+    @classmethod
+    def load(cls, path: str) -> "RepetitionIndex":
+        """Read an index written by ``save`` or ``--emit-index``"""
+        db = _open_index(path)
+        try:
+            meta = dict(db.execute('SELECT key, value FROM meta'))
+            index = cls(int(meta['min_complexity']), meta['engine'])
+            index.interpreter = meta['interpreter']
+            unpack = _form_unpacker(index.engine)
+            forms = {form_id: unpack(form) for form_id, form in db.execute('SELECT * FROM forms')}
+            paths = dict(db.execute('SELECT id, path FROM files'))
+            by_file = defaultdict(list)
+            for form_id, file_id, *fields in db.execute(
+                    'SELECT * FROM records ORDER BY file_id, rowid'):
+                by_file[file_id].append(NodeRecord(forms[form_id], paths[file_id], *fields))
+            for file_id in sorted(paths):
+                index._set_records(paths[file_id], by_file.pop(file_id, []))
+        finally:
+            db.close()
+        return index
+
+    def merge(self, other: "RepetitionIndex") -> None:
+        """Add every file of another index; files in both take the other's records.
+
+        The other index must use the same engine and interpreter and hold at
+        least the nodes this one does; its records below this index's
+        complexity are dropped.
+        """
+        if other.engine != self.engine or other.min_complexity > self.min_complexity:
+            raise ValueError(
+                f"Cannot merge an index of {other.engine}/{other.min_complexity} into "
+                f"{self.engine}/{self.min_complexity} (engine/min complexity)")
+        if other.interpreter != self.interpreter:
+            raise ValueError(f"Cannot merge an index built on {other.interpreter} into one "
+                             f"built on {self.interpreter}")
+        for filepath in other.files:
+            records = other._files[filepath]
+            if other.min_complexity < self.min_complexity:
+                records = [record for record in records
+                           if record.complexity >= self.min_complexity]
+            self._set_records(filepath, records)
+
+
+# Saved indexes are SQLite files. Each distinct fingerprint is stored once in
+# forms, as 16 raw bytes for the digest engines; records keep NodeRecord's
+# field order after it, with the file path moved to the files table.
+_INDEX_SCHEMA = """
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE files (id INTEGER PRIMARY KEY, path TEXT NOT NULL);
+CREATE TABLE forms (id INTEGER PRIMARY KEY, fingerprint UNIQUE NOT NULL);
+CREATE TABLE records (
+    form_id INTEGER NOT NULL, file_id INTEGER NOT NULL, lineno INTEGER,
+    complexity INTEGER, node_index INTEGER, end_lineno INTEGER, col_offset INTEGER,
+    end_col_offset INTEGER, parent INTEGER
+);
+"""
+
+
+def _form_packer(engine: str) -> Callable[[str], object]:
+    # The legacy engine's forms are ast dumps, not hex digests
+    return str if engine == "legacy" else bytes.fromhex
+
+
+def _form_unpacker(engine: str) -> Callable[[object], str]:
+    return str if engine == "legacy" else bytes.hex
+
+
+class _IndexWriter:
+    """Streams (file, records) pairs into a new index file.
+
+    The file is written under a temporary name and moved into place on a
+    clean exit, so readers never see a half-written index.
+    """
+
+    def __init__(self, path: str, engine: str, min_complexity: int,
+                 interpreter: Optional[str] = None):
+        self.path = path
+        self.tmp_path = f"{path}.{os.getpid()}.tmp"
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+        self.db = sqlite3.connect(self.tmp_path)
+        self.db.executescript(_INDEX_SCHEMA)
+        self.pack = _form_packer(engine)
+        self.forms = {}
+        self.db.executemany('INSERT INTO meta VALUES (?, ?)', [
+            ('format', str(INDEX_FORMAT)),
+            ('version', _tool_version()),
+            ('engine', engine),
+            ('min_complexity', str(min_complexity)),
+            ('interpreter', interpreter or _interpreter()),
+        ])
+
+    def __enter__(self) -> "_IndexWriter":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if exc_type is None:
+            # Indexing after the bulk insert is much faster than maintaining it
+            self.db.executemany('INSERT INTO forms VALUES (?, ?)',
+                                ((form_id, self.pack(form)) for form, form_id in self.forms.items()))
+            self.db.execute('CREATE INDEX records_form ON records (form_id)')
+            self.db.commit()
+        self.db.close()
+        if exc_type is None:
+            os.replace(self.tmp_path, self.path)
+        else:
+            os.remove(self.tmp_path)
+
+    def add(self, filepath: str, records: List[NodeRecord]) -> None:
+        file_id = self.db.execute('INSERT INTO files (path) VALUES (?)', (filepath,)).lastrowid
+        forms = self.forms
+        self.db.executemany(
+            'INSERT INTO records VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            ((forms.setdefault(record.fingerprint, len(forms) + 1), file_id, *record[2:])
+             for record in records),
+        )
+
+    def tee(self, file_records: Iterable[Tuple[str, List[NodeRecord]]]
+            ) -> Iterator[Tuple[str, List[NodeRecord]]]:
+        """Pass (file, records) pairs through, adding each one on the way"""
+        for filepath, records in file_records:
+            self.add(filepath, records)
+            yield filepath, records
+
+
+def _open_index(path: str) -> sqlite3.Connection:
+    if not os.path.isfile(path):
+        raise ValueError(f"No index at {path}")
+    db = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        meta = dict(db.execute('SELECT key, value FROM meta'))
+    except sqlite3.DatabaseError as e:
+        db.close()
+        raise ValueError(f"Not a repetition index: {path}") from e
+    if meta.get('format') != str(INDEX_FORMAT):
+        db.close()
+        raise ValueError(f"Unsupported index format in {path}: {meta.get('format')}")
+    return db
+
+
+def snippet_forms(snippet: str, engine: str = "flat", min_complexity: int = 1) -> List[str]:
+    """Generic forms of a code fragment's statements, as the engine indexes them.
+
+    A lone expression is looked up as an expression, so it also matches
+    where it is nested inside larger code. Raises ``SyntaxError`` for code
+    that does not parse and ``ValueError`` for a fragment with a statement
+    too small to have been indexed.
+    """
+    tree = ast.parse(textwrap.dedent(snippet).strip('\n'))
+    targets = tree.body
+    if len(targets) == 1 and isinstance(targets[0], ast.Expr):
+        targets = [targets[0].value]
+    if not targets:
+        raise ValueError("Empty snippet")
+
+    sizes = compute_subtree_sizes(tree)
+    for node in targets:
+        if isinstance(node, _TRIVIAL_NODES) or sizes[node] < min_complexity:
+            raise ValueError(f"Snippet is smaller than the indexed complexity of {min_complexity}: "
+                             f"{ast_to_string(node)}")
+
+    if engine == "legacy":
+        builtin_names = get_builtin_names()
+        return [normalized_dump(node, builtin_names) for node in targets]
+    nodes = _preorder_nodes(tree)
+    positions = {id(node): index for index, node in enumerate(nodes)}
+    indices = [positions[id(node)] for node in targets]
+    forms = _index_forms(tree, nodes, indices, engine)
+    return [forms[index] for index in indices]
+
+
+def _block_form(statements: Iterable[ast.AST], builtin_names: Set[str]) -> str:
+    """Legacy form of consecutive statements, variables numbered across all of them"""
+    block = ast.parse("")
+    block.body = list(statements)
+    return normalized_dump(block, builtin_names)
+
+
+def _match_snippet(snippet: str, forms: List[str],
+                   lookup: Callable[[str], Iterable[NodeRecord]]) -> List[Location]:
+    """Chain the records of each form into runs of consecutive sibling statements.
+
+    Forms are per statement, so a chained run can still use its variables
+    differently from the snippet; runs of several statements are kept only
+    if their source normalizes to the snippet's as one block.
+    """
+    runs = [[record] for record in lookup(forms[0])]
+    for form in forms[1:]:
+        # The next sibling starts right after the previous statement's subtree
+        following = {(record.filepath, record.parent, record.index): record
+                     for record in lookup(form)}
+        runs = [
+            run + [following[key]]
+            for run in runs
+            for key in [(run[-1].filepath, run[-1].parent, run[-1].index + run[-1].complexity)]
+            if key in following
+        ]
+    locations = [
+        Location(run[0].filepath, run[0].lineno, run[-1].end_lineno, run[0].col_offset,
+                 run[-1].end_col_offset, forms[0], run[0].index, len(run))
+        for run in runs
+    ]
+    if len(forms) > 1 and locations:
+        builtin_names = get_builtin_names()
+        expected = _block_form(ast.parse(textwrap.dedent(snippet).strip('\n')).body,
+                               builtin_names)
+        resolver = NodeResolver()
+        locations = [location for location in locations
+                     if _block_form(resolver.nodes(location), builtin_names) == expected]
+    return sorted(locations, key=lambda location: (location.filepath, location.lineno,
+                                                   location.col_offset))
+
+
+def query_index(path: str, snippet: str) -> List[Location]:
+    """Find every occurrence of a code fragment in a saved index.
+
+    The fragment is normalized like indexed code, so it matches regardless
+    of variable names, and only the matching rows are read from disk.
+    """
+    db = _open_index(path)
+    try:
+        meta = dict(db.execute('SELECT key, value FROM meta'))
+        if meta['interpreter'] != _interpreter():
+            raise ValueError(f"Index {path} was built on {meta['interpreter']}, "
+                             f"not {_interpreter()}")
+        pack = _form_packer(meta['engine'])
+        paths = {}
+
+        def lookup(form):
+            rows = db.execute(
+                'SELECT records.* FROM forms JOIN records ON records.form_id = forms.id '
+                'WHERE forms.fingerprint = ?', (pack(form),)).fetchall()
+            for file_id in {row[1] for row in rows} - paths.keys():
+                (paths[file_id],) = db.execute('SELECT path FROM files WHERE id = ?',
+                                               (file_id,)).fetchone()
+            return [NodeRecord(form, paths[file_id], *fields) for _, file_id, *fields in rows]
+
+        forms = snippet_forms(snippet, meta['engine'], int(meta['min_complexity']))
+        return _match_snippet(snippet, forms, lookup)
+    finally:
+        db.close()
+
+
+def _iter_reference_matches(file_records: Iterable[Tuple[str, List[NodeRecord]]],
+                            reference: RepetitionIndex
+                            ) -> Iterator[Tuple[str, List[NodeRecord]]]:
+    """Yield (file, records) keeping only the forms the reference corpus has"""
+    known = reference._groups
+    for filepath, records in file_records:
+        yield filepath, [record for record in records if record.fingerprint in known]
+
+
+def _add_reference_instances(groups: List[Group], reference: RepetitionIndex,
+                             min_repetition: int) -> List[Group]:
+    """Prefix each target group with the reference's instances of the same form"""
+    combined = []
+    for generic_form, instances in groups:
+        instances = reference._instances(generic_form) + instances
+        if len(instances) >= min_repetition:
+            combined.append((generic_form, instances))
+    return combined
+
+
+def load_reference(paths: List[str], min_complexity: int = 3, engine: str = "flat",
+                   jobs: int = 1, cache_dir: Optional[str] = None) -> RepetitionIndex:
+    """Build the reference index for ``find_repetitions(reference=...)``.
+
+    Each path is a saved index (see ``RepetitionIndex.save``) or a Python
+    file or directory, which is analyzed through the cache in ``cache_dir``.
+    """
+    index = RepetitionIndex(min_complexity, engine)
+    sources = []
+    for path in paths:
+        if os.path.isfile(path) and not path.endswith('.py'):
+            index.merge(RepetitionIndex.load(path))
+        else:
+            sources.append(path)
+    if sources:
+        index.add_files(iter_python_files(sources), jobs=jobs, cache_dir=cache_dir)
+    return index
+
+
+def _group_results(groups: Iterable[Group], resolver: NodeResolver) -> List[RepetitionResult]:
+    """Turn node groups into results that resolve their nodes through ``resolver``"""
+    results = []
+    for generic_form, instances in groups:
+        complexity = instances[0].complexity  # All instances should have same complexity
+        locations = [
+            Location(record.filepath, record.lineno, record.end_lineno, record.col_offset,
+                     record.end_col_offset, record.fingerprint, record.index)
+            for record in instances
+        ]
+        
+        results.append(RepetitionResult(
+            complexity=complexity,
+            repetition=len(instances),
+            original_nodes=NodeList(locations, resolver),
+            generic_form=generic_form,
+            level=form_level(generic_form),
+        ))
+    return results
+
+
+def find_repetitions(files: Iterable[str], min_complexity: int = 3, min_repetition: int = 2,
+                     engine: str = "flat", jobs: int = 1,
+                     cache_dir: Optional[str] = None,
+                     max_memory: Optional[int] = None,
+                     maximal_only: bool = True, sequences: bool = False,
+                     min_statements: int = 2,
+                     similarity: Optional[float] = None,
+                     changed_files: Optional[Iterable[str]] = None,
+                     emit_index: Optional[str] = None,
+                     reference: Optional[RepetitionIndex] = None,
+                     hooks: Optional[ScanHooks] = None,
+                     normalize: Iterable[str] = ("names",),
+                     granularity: Optional[Iterable[str]] = None) -> List[RepetitionResult]:
+    """Find repetitions across multiple Python files.
+
+    ``engine`` selects how nodes are grouped: ``"flat"`` fingerprints every
+    subtree over a ``FlatTree`` of each file, ``"tree"`` does the same pass
+    over the ``ast`` objects (see ``compute_fingerprints``) and ``"legacy"``
+    writes each candidate's normalized dump in one pass without copying or
+    rewriting it (see ``normalized_dump``). All produce the same groups; the
+    slower engines are kept for verification. No engine runs ``ASTNormalizer``
+    and ``ast.dump`` any more: that original form is only checked against
+    ``normalized_dump`` by the tests.
+
+    With ``jobs`` > 1 files are parsed and fingerprinted in that many worker
+    processes (``0`` uses every CPU). Workers only send back ``NodeRecord``s.
+
+    ``files`` may be a lazy iterable such as ``iter_python_files``; unless
+    ``sequences``, ``similarity`` or ``changed_files`` need a second pass
+    over them, each file is analyzed as soon as it is discovered.
+
+    Results hold compact ``Location``s; ``original_nodes`` re-parses a file
+    only when one of its nodes is actually read.
+
+    If ``cache_dir`` is given, per-file records are kept there (see
+    ``FingerprintCache``) and only files that changed since the last run are
+    analyzed again.
+
+    ``max_memory`` (in bytes) switches to out-of-core grouping: records are
+    spilled to disk partitioned by fingerprint and grouped one partition at
+    a time, so memory stays bounded by the budget rather than corpus size.
+
+    With ``maximal_only`` groups that are only ever found nested inside the
+    instances of one larger group are left out (see ``drop_subsumed_groups``).
+
+    With ``sequences`` runs of at least ``min_statements`` consecutive
+    statements repeated across blocks are reported too, as results of kind
+    ``"sequence"`` whose locations span the whole run.
+
+    With ``similarity`` (between 0 and 1) functions and classes that are not
+    identical but score at least that much under ``tree_similarity`` are
+    clustered as well, as results of kind ``"similar"``.
+
+    With ``changed_files`` only results with at least one instance in one of
+    those files are returned, and only forms found in them are grouped.
+
+    ``emit_index`` names a file to save every analyzed record to, in the
+    format ``RepetitionIndex.load`` and ``query_index`` read.
+
+    With a ``reference`` index (see ``load_reference``) only forms the
+    reference also has are grouped, and only groups with instances on both
+    sides are returned, reference instances first. Files the reference
+    already holds are not analyzed as targets.
+
+    ``hooks`` (see ``ScanHooks`` and ``ScanStats``) is told about every
+    phase, every file analyzed or read from the cache, and the counters.
+    Analysis and grouping stream into each other and are timed together
+    as the ``analysis`` phase.
+
+    ``normalize`` lists levels of ``NORMALIZE_LEVELS`` to group nodes at;
+    each result's ``level`` tells which one matched. A looser level only
+    reports groups whose instances differ from a stricter level's (see
+    ``drop_repeated_levels``).
+
+    ``granularity`` restricts candidates to some node kinds: keys of
+    ``GRANULARITIES`` such as ``"function"``, or ``ast`` class names. Other
+    nodes are still fingerprinted as parts of them but never grouped.
+
+    Indexes, emitted or as a reference, only hold the ``"names"`` level of
+    every node kind.
+    """
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown engine: {engine}")
+    normalize = _ordered_levels(normalize)
+    if granularity is not None:
+        granularity = tuple(sorted(set(granularity)))
+        _granularity_types(granularity)
+    if (normalize != ("names",) or granularity is not None) \
+            and (emit_index is not None or reference is not None):
+        raise ValueError("Indexes only hold the names normalization level of every node kind")
+    if similarity is not None and not 0 < similarity <= 1:
+        raise ValueError(f"Similarity must be in (0, 1]: {similarity}")
+    if emit_index is not None and changed_files is not None:
+        raise ValueError("An index cannot be emitted from a changed-files run")
+    if reference is not None:
+        if reference.engine != engine or reference.min_complexity > min_complexity:
+            raise ValueError(f"Reference index of {reference.engine}/{reference.min_complexity} "
+                             f"does not fit {engine}/{min_complexity} (engine/min complexity)")
+        if sequences or similarity is not None:
+            raise ValueError("Reference mode only compares single nodes")
+        reference_files = {os.path.realpath(filepath) for filepath in reference.files}
+        files = (filepath for filepath in files
+                 if os.path.realpath(filepath) not in reference_files)
+    if sequences or similarity is not None or changed_files is not None:
+        files = list(files)
+    if not jobs:
+        jobs = os.cpu_count() or 1
+    cache = None
+    if cache_dir is not None:
+        settings = dict(engine=engine, min_complexity=min_complexity)
+        # Only non-default settings need their own entries; the default ones
+        # are shared with RepetitionIndex.add_files
+        if normalize != ("names",):
+            settings["normalize"] = ",".join(normalize)
+        if granularity is not None:
+            settings["granularity"] = ",".join(granularity)
+        cache = FingerprintCache(cache_dir, **settings)
+
+    changed = None
+    if changed_files is not None:
+        changed = {os.path.realpath(filepath) for filepath in changed_files}
+        changed = {filepath for filepath in files if os.path.realpath(filepath) in changed}
+        file_records = _iter_changed_matches(files, changed, min_complexity, engine, jobs, cache,
+                                             hooks, normalize, granularity)
+    else:
+        file_records = _iter_file_records(files, min_complexity, engine, jobs, cache, hooks=hooks,
+                                          normalize=normalize, granularity=granularity)
+    with ExitStack() as stack:
+        stack.enter_context(_phase(hooks, "analysis"))
+        if emit_index is not None:
+            writer = stack.enter_context(_IndexWriter(emit_index, engine, min_complexity))
+            file_records = writer.tee(file_records)
+        group_repetition = min_repetition
+        if reference is not None:
+            # A form found once in the target may still repeat one in the reference
+            file_records = _iter_reference_matches(file_records, reference)
+            group_repetition = 1
+        if max_memory is None:
+            index = RepetitionIndex(min_complexity, engine)
+            for filepath, records in file_records:
+                index._set_records(filepath, records)
+        else:
+            repeated = _group_out_of_core((records for _, records in file_records),
+                                          group_repetition, max_memory)
+    if max_memory is None:
+        with _phase(hooks, "grouping"):
+            repeated = index._repeated_groups(min_complexity, group_repetition)
+        if hooks is not None:
+            hooks.count("distinct_fingerprints", len(index._groups))
+    if reference is not None:
+        repeated = _add_reference_instances(repeated, reference, min_repetition)
+    if hooks is not None:
+        hooks.count("groups", len(repeated))
+    sequence_groups = []
+    if sequences:
+        with _phase(hooks, "sequences"):
+            sequence_groups = _find_sequence_groups(files, min_complexity, min_repetition,
+                                                    min_statements, engine, jobs)
+        if hooks is not None:
+            hooks.count("sequence_groups", len(sequence_groups))
+    if maximal_only:
+        with _phase(hooks, "subsumption"):
+            repeated, sequence_groups = drop_subsumed_groups(repeated, sequence_groups)
+        if hooks is not None:
+            hooks.count("maximal_groups", len(repeated) + len(sequence_groups))
+    if len(normalize) > 1:
+        # After subsumption, so a dropped group still hides what it encloses
+        repeated = drop_repeated_levels(repeated)
+
+    # Results keep compact locations; nodes are re-parsed only when read
+    resolver = NodeResolver()
+    results = _group_results(repeated, resolver)
+
+    for generic_form, runs in sequence_groups:
+        locations = [
+            Location(run[0].filepath, run[0].lineno, run[-1].end_lineno, run[0].col_offset,
+                     run[-1].end_col_offset, generic_form, run[0].index, len(run))
+            for run in runs
+        ]
+        results.append(RepetitionResult(
+            complexity=sum(record.complexity for record in runs[0]),
+            repetition=len(runs),
+            original_nodes=NodeList(locations, resolver),
+            generic_form=generic_form,
+            kind="sequence",
+        ))
+
+    if similarity is not None:
+        with _phase(hooks, "similarity"):
+            clusters = _find_similar_groups(files, min_complexity, min_repetition, similarity,
+                                            engine, jobs, hooks)
+        if hooks is not None:
+            hooks.count("similar_clusters", len(clusters))
+        for score, instances in clusters:
+            locations = [
+                Location(record.filepath, record.lineno, record.end_lineno, record.col_offset,
+                         record.end_col_offset, record.fingerprint, record.index)
+                for record in instances
+            ]
+            results.append(RepetitionResult(
+                complexity=min(record.complexity for record in instances),
+                repetition=len(instances),
+                original_nodes=NodeList(locations, resolver),
+                generic_form=instances[0].fingerprint,
+                kind="similar",
+                similarity=score,
+            ))
+
+    if changed is not None:
+        # Node groups were already restricted; runs and clusters are filtered here
+        results = [
+            result for result in results
+            if any(location.filepath in changed for location in result.locations)
+        ]
+    if hooks is not None:
+        hooks.count("results", len(results))
     
-    # Sort and print results
-    sorted_results = sort_results(results, args.sort)
-    print_results(sorted_results)
-    
+    return results
+
+
+def sort_results(results: Iterable[RepetitionResult], sort_by: str = "complexity",
+                 top: Optional[int] = None) -> List[RepetitionResult]:
+    """Sort results by complexity * repetition or repetition * complexity.
+
+    With ``top``, only the best ``top`` results are kept, selected with a
+    heap instead of sorting everything; ties keep the same order either way.
+    """
+    if sort_by == "repetition":
+        key = lambda r: (r.repetition, r.complexity)
+    else:
+        key = lambda r: (r.complexity, r.repetition)
+    if top is not None:
+        return heapq.nlargest(top, results, key=key)
+    return sorted(results, key=key, reverse=True)
+
+
+def shorten_path(filepath: str) -> str:
+    """Shorten file path for display by removing ./ prefix and common directories"""
+    if filepath.startswith('./'):
+        filepath = filepath[2:]
+    if filepath.startswith('src/'):
+        filepath = filepath[4:]
+    return filepath
+
+
+def _format_location(location: Location) -> str:
+    if location.span > 1:
+        return f"{shorten_path(location.filepath)}:{location.lineno}-{location.end_lineno}"
+    return f"{shorten_path(location.filepath)}:{location.lineno}"
+
+
+def _instance_nodes(result: RepetitionResult, number: int = 0) -> List[ast.AST]:
+    """Nodes of one instance: one node, or every statement of a run"""
+    if isinstance(result.original_nodes, NodeList):
+        nodes = result.original_nodes
+        return nodes.resolver.nodes(nodes.locations[number])
+    _, _, node = result.original_nodes[number]
+    return [node] if node is not None else []
+
+
+class SourceCache:
+    """Raw source lines of the files being printed, each read at most once.
+
+    ``ast`` column offsets count UTF-8 bytes, so lines are kept as bytes and
+    only the slice that is shown gets decoded.
+    """
+
+    def __init__(self):
+        self._lines = {}
+
+    def lines(self, filepath: str) -> Optional[List[bytes]]:
+        if filepath not in self._lines:
+            try:
+                with open(filepath, 'rb') as f:
+                    self._lines[filepath] = f.read().splitlines()
+            except OSError:
+                self._lines[filepath] = None
+        return self._lines[filepath]
+
+    def snippet(self, location: Location) -> Optional[str]:
+        """The original text at a location, dedented, or None if it cannot be sliced"""
+        lines = self.lines(location.filepath)
+        if not lines or not 1 <= location.lineno <= location.end_lineno <= len(lines):
+            return None
+        chunk = lines[location.lineno - 1:location.end_lineno]
+        if location.end_col_offset:
+            chunk[-1] = chunk[-1][:location.end_col_offset]
+        # Keep the first line's column so continuation lines dedent with it
+        chunk[0] = b" " * location.col_offset + chunk[0][location.col_offset:]
+        try:
+            text = b"\n".join(chunk).decode('utf-8')
+        except UnicodeDecodeError:
+            return None
+        return textwrap.dedent(text).strip("\n")
+
+
+def _instance_code(result: RepetitionResult, number: int = 0,
+                   sources: Optional[SourceCache] = None) -> str:
+    """Source of one instance, sliced from its file or failing that unparsed"""
+    if sources is not None:
+        text = sources.snippet(result.locations[number])
+        if text is not None:
+            return text
+    code = []
+    for node in _instance_nodes(result, number):
+        try:
+            code.append(ast.unparse(node))
+        except (AttributeError, RecursionError):
+            # ast.unparse is 3.9+ and recursive; the iterative dump is neither
+            code.append(ast_to_string(node))
+    return "\n".join(code)
+
+
+_MIN_COLUMN = 32
+_GUTTER = " | "
+
+
+def _fit(text: str, width: int) -> str:
+    return text[:width - 1] + ">" if len(text) > width else text.ljust(width)
+
+
+def side_by_side(blocks: List[Tuple[str, str]], width: int) -> List[str]:
+    """Lay titled text blocks out in columns, wrapping to more rows if they do not fit"""
+    columns = max(1, min(len(blocks), (width + len(_GUTTER)) // (_MIN_COLUMN + len(_GUTTER))))
+    column = max(1, (width - len(_GUTTER) * (columns - 1)) // columns)
+    lines = []
+    for start in range(0, len(blocks), columns):
+        if lines:
+            lines.append("")
+        cells = [[title, "-" * min(len(title), column)] + text.expandtabs().splitlines()
+                 for title, text in blocks[start:start + columns]]
+        for row in range(max(len(cell) for cell in cells)):
+            lines.append(_GUTTER.join(
+                _fit(cell[row] if row < len(cell) else "", column) for cell in cells
+            ).rstrip())
+    return lines
+
+
+def _format_header(result: RepetitionResult) -> str:
+    # Compact header: [complexity] Nx: file:line, file:line, ...
+    # Near-miss clusters also show their lowest similarity: [complexity] Nx ~85%: ...
+    # and groups found at a looser level that level: [complexity] Nx (constants): ...
+    locations = [_format_location(location) for location in result.locations]
+    note = f" ~{result.similarity:.0%}" if result.kind == "similar" else ""
+    if result.level != "names":
+        note += f" ({result.level})"
+    return f"[{result.complexity}] {result.repetition}x{note}: {', '.join(locations)}"
+
+
+def print_results(results: Iterable[RepetitionResult], side_by_side_width: Optional[int] = None
+                  ) -> None:
+    """Print formatted results in compact format.
+
+    Code is sliced from the original files, so formatting and comments are
+    kept. With ``side_by_side_width``, every instance is shown in columns
+    fitting that many characters instead of only the first one.
+    """
+    sources = SourceCache()
+    for result in results:
+        print(_format_header(result))
+
+        if side_by_side_width is not None:
+            blocks = [(_format_location(location), _instance_code(result, number, sources)
+                       or "<source unavailable>")
+                      for number, location in enumerate(result.locations)]
+            for line in side_by_side(blocks, side_by_side_width):
+                print(line)
+        else:
+            # Show code only once (from first instance)
+            print(_instance_code(result, 0, sources) or "<source unavailable>")
+
+        print()
+        print("=" * 70)
+        print()
+
+
+OUTPUT_FORMATS = ("text", "json", "jsonl", "sarif")
+
+# SARIF rule of each result kind
+_SARIF_RULES = {
+    "node": ("repeated-code", "Code repeated up to renaming"),
+    "sequence": ("repeated-statements", "Run of statements repeated up to renaming"),
+    "similar": ("similar-code", "Functions or classes that are near-miss copies"),
+}
+
+
+def result_to_dict(result: RepetitionResult, sources: Optional[SourceCache] = None) -> dict:
+    """JSON-ready form of one result, as written by ``--format json``"""
+    data = {
+        "kind": result.kind,
+        "complexity": result.complexity,
+        "repetition": result.repetition,
+        "locations": [
+            {"path": location.filepath, "line": location.lineno,
+             "end_line": location.end_lineno, "column": location.col_offset,
+             "end_column": location.end_col_offset, "span": location.span}
+            for location in result.locations
+        ],
+        "code": _instance_code(result, 0, sources if sources is not None else SourceCache()),
+    }
+    if result.kind == "similar":
+        data["similarity"] = round(result.similarity, 4)
+    if result.kind == "node":
+        data["level"] = result.level
+    return data
+
+
+def _iter_jsonl(results: Iterable[RepetitionResult]) -> Iterator[str]:
+    sources = SourceCache()
+    for result in results:
+        yield json.dumps(result_to_dict(result, sources)) + "\n"
+
+
+def _iter_json(results: Iterable[RepetitionResult]) -> Iterator[str]:
+    # One array, written an element at a time
+    sources = SourceCache()
+    separator = "[\n  "
+    for result in results:
+        yield separator + json.dumps(result_to_dict(result, sources))
+        separator = ",\n  "
+    yield "[]\n" if separator.startswith("[") else "\n]\n"
+
+
+def _sarif_location(location: Location) -> dict:
+    region = {"startLine": location.lineno, "startColumn": location.col_offset + 1}
+    if location.end_lineno:
+        region["endLine"] = location.end_lineno
+        if location.span == 1 and location.end_col_offset:
+            region["endColumn"] = location.end_col_offset + 1
+    uri = os.path.relpath(location.filepath) if os.path.isabs(location.filepath) \
+        else os.path.normpath(location.filepath)
+    return {"physicalLocation": {"artifactLocation": {"uri": uri.replace(os.sep, "/")},
+                                 "region": region}}
+
+
+def _sarif_result(result: RepetitionResult) -> dict:
+    locations = [_sarif_location(location) for location in result.locations]
+    text = f"Repeated {result.repetition} times (complexity {result.complexity})"
+    if result.kind == "similar":
+        text = f"{result.repetition} near-miss copies, at least {result.similarity:.0%} similar"
+    elif result.level != "names":
+        text += f" up to {result.level}"
+    sarif = {
+        "ruleId": _SARIF_RULES[result.kind][0],
+        "level": "note",
+        "message": {"text": text},
+        "locations": locations[:1],
+        "relatedLocations": [dict(location, id=number)
+                             for number, location in enumerate(locations[1:], 1)],
+        "properties": {"complexity": result.complexity, "repetition": result.repetition},
+    }
+    if result.kind == "similar":
+        sarif["properties"]["similarity"] = round(result.similarity, 4)
+    if result.kind == "node":
+        sarif["properties"]["normalization"] = result.level
+    return sarif
+
+
+def _iter_sarif(results: Iterable[RepetitionResult]) -> Iterator[str]:
+    rules = [{"id": rule_id, "shortDescription": {"text": text}}
+             for rule_id, text in _SARIF_RULES.values()]
+    log = {
+        "$schema": "https://json.schemastore.org/sarif-2.1.0.json",
+        "version": "2.1.0",
+        "runs": [{
+            "tool": {"driver": {"name": "repetition-hunter", "version": _tool_version(),
+                                "informationUri":
+                                    "https://github.com/waza-agency/repetition-hunter-py",
+                                "rules": rules}},
+            "results": [],
+        }],
+    }
+    # Write everything around the results array once and stream the array itself
+    head, tail = json.dumps(log).split('"results": []')
+    yield head + '"results": ['
+    separator = "\n"
+    for result in results:
+        yield separator + json.dumps(_sarif_result(result))
+        separator = ",\n"
+    yield "\n]" + tail + "\n"
+
+
+_WRITERS = {"json": _iter_json, "jsonl": _iter_jsonl, "sarif": _iter_sarif}
+
+
+def write_results(results: Iterable[RepetitionResult], fmt: str = "text",
+                  stream=None, side_by_side_width: Optional[int] = None) -> None:
+    """Write results to ``stream`` (default stdout) as each one is rendered.
+
+    Machine formats never hold the whole report: every result is serialized
+    and written on its own, so ``results`` may be a lazy iterable.
+    ``side_by_side_width`` only applies to text, see ``print_results``.
+    """
+    if stream is None:
+        stream = sys.stdout
+    if fmt == "text":
+        if stream is sys.stdout:
+            print_results(results, side_by_side_width)
+        else:
+            with redirect_stdout(stream):
+                print_results(results, side_by_side_width)
+        return
+    if fmt not in _WRITERS:
+        raise ValueError(f"unknown format: {fmt!r}, expected one of {', '.join(OUTPUT_FORMATS)}")
+    for chunk in _WRITERS[fmt](results):
+        stream.write(chunk)
+
+
+def _in_shard(filepath: str, shard: int, count: int) -> bool:
+    return zlib.crc32(os.path.normpath(filepath).encode('utf-8')) % count == shard - 1
+
+
+def shard_files(files: Iterable[str], shard: int, count: int) -> List[str]:
+    """The files of shard ``shard`` (1-based) out of ``count``.
+
+    Files are assigned by a hash of their path, so a file lands in the same
+    shard on every machine no matter which other files exist.
+    """
+    return [filepath for filepath in files if _in_shard(filepath, shard, count)]
+
+
+def _parse_levels(text: str) -> Tuple[str, ...]:
+    """Parse comma-separated normalization levels such as ``names,constants``"""
+    try:
+        return _ordered_levels(level.strip() for level in text.split(',') if level.strip())
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(f"{e}; choose from {', '.join(NORMALIZE_LEVELS)}")
+
+
+def _parse_granularity(text: str) -> Tuple[str, ...]:
+    """Parse comma-separated node kinds such as ``function,class`` or ``For,While``"""
+    kinds = tuple(sorted({kind.strip() for kind in text.split(',') if kind.strip()}))
+    try:
+        _granularity_types(kinds)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(
+            f"{e}; choose from {', '.join(GRANULARITIES)} or ast node classes")
+    return kinds
+
+
+def _parse_shard(text: str) -> Tuple[int, int]:
+    """Parse a shard spec such as ``2/8``"""
+    try:
+        shard, count = (int(part) for part in text.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid shard: {text!r}, expected I/N")
+    if not 1 <= shard <= count:
+        raise argparse.ArgumentTypeError(f"shard must be between 1 and {count}: {text!r}")
+    return shard, count
+
+
+class _IgnoreRule(NamedTuple):
+    pattern: "re.Pattern"
+    negate: bool
+    dir_only: bool
+    anchored: bool  # matched against the path from the rule's base, not the name
+
+
+def _glob_regex(glob: str) -> str:
+    """Translate a gitignore-style glob into a regex over ``/``-separated paths"""
+    out = []
+    i = 0
+    while i < len(glob):
+        char = glob[i]
+        if glob.startswith("**/", i):
+            out.append("(?:.*/)?")
+            i += 3
+            continue
+        if glob.startswith("**", i):
+            out.append(".*")
+            i += 2
+            continue
+        if char == "*":
+            out.append("[^/]*")
+        elif char == "?":
+            out.append("[^/]")
+        elif char == "[":
+            start = i + 2 if glob.startswith("[!", i) else i + 1
+            end = glob.find("]", start + 1)
+            if end == -1:
+                out.append(re.escape(char))
+            else:
+                body = glob[start:end].replace("\\", "\\\\")
+                out.append(("[^" if start == i + 2 else "[") + body + "]")
+                i = end
+        elif char == "\\" and i + 1 < len(glob):
+            i += 1
+            out.append(re.escape(glob[i]))
+        else:
+            out.append(re.escape(char))
+        i += 1
+    return "".join(out)
+
+
+def _parse_ignore_rules(lines: Iterable[str]) -> List[_IgnoreRule]:
+    """Parse .gitignore lines (or ``--exclude`` globs) into rules, in order"""
+    rules = []
+    for line in lines:
+        line = line.rstrip("\r\n")
+        if not line.endswith("\\ "):
+            line = line.rstrip(" ")
+        if not line or line.startswith("#"):
+            continue
+        negate = line.startswith("!")
+        if negate:
+            line = line[1:]
+        dir_only = line.endswith("/")
+        line = line.rstrip("/")
+        if not line:
+            continue
+        anchored = "/" in line
+        rules.append(_IgnoreRule(re.compile(_glob_regex(line.lstrip("/")) + r"\Z"), negate,
+                                 dir_only, anchored))
+    return rules
+
+
+def _read_ignore_file(filepath: str) -> List[_IgnoreRule]:
+    try:
+        with open(filepath, encoding="utf-8", errors="replace") as f:
+            return _parse_ignore_rules(f)
+    except OSError:
+        return []
+
+
+def _repository_rules(directory: str) -> Tuple[Tuple[str, str, List[_IgnoreRule]], ...]:
+    """Rulesets that apply to ``directory`` from above it, outermost first.
+
+    These are ``.git/info/exclude`` and the ``.gitignore`` of every directory
+    from the enclosing repository's root down to ``directory``'s parent, so
+    scanning a subdirectory skips what scanning the whole repository would.
+    Their anchored rules are matched on paths relative to their own
+    directory, which is ``prefix`` followed by the path below ``directory``.
+    """
+    start = current = os.path.abspath(directory)
+    ancestors = []
+    while not os.path.exists(os.path.join(current, ".git")):
+        parent = os.path.dirname(current)
+        if parent == current:
+            return ()  # Not in a repository: nothing above applies
+        current = parent
+        ancestors.append(current)
+
+    def prefix(base: str) -> str:
+        return "" if base == start else os.path.relpath(start, base).replace(os.sep, "/") + "/"
+
+    rulesets = []
+    rules = _read_ignore_file(os.path.join(current, ".git", "info", "exclude"))
+    if rules:
+        rulesets.append((directory, prefix(current), rules))
+    for ancestor in reversed(ancestors):
+        rules = _read_ignore_file(os.path.join(ancestor, ".gitignore"))
+        if rules:
+            rulesets.append((directory, prefix(ancestor), rules))
+    return tuple(rulesets)
+
+
+def _is_ignored(rulesets: Tuple[Tuple[str, str, List[_IgnoreRule]], ...], path: str, name: str,
+                is_dir: bool) -> bool:
+    """Apply every rule from the outermost ruleset in, the last match winning.
+
+    Each ruleset is (base, prefix, rules); anchored rules see ``path``
+    relative to ``base`` with ``prefix`` in front.
+    """
+    ignored = False
+    for base, prefix, rules in rulesets:
+        relative = None
+        for rule in rules:
+            # Only rules that could flip the current verdict are worth matching
+            if rule.negate != ignored or (rule.dir_only and not is_dir):
+                continue
+            if rule.anchored:
+                if relative is None:
+                    relative = prefix + path[len(base.rstrip(os.sep)) + 1:].replace(os.sep, "/")
+                target = relative
+            else:
+                target = name
+            if rule.pattern.match(target):
+                ignored = not ignored
+    return ignored
+
+
+def iter_python_files(paths: Iterable[str], exclude: Iterable[str] = DEFAULT_EXCLUDES,
+                      gitignore: bool = True, max_file_size: Optional[int] = None
+                      ) -> Iterator[str]:
+    """Yield the Python files under ``paths`` as they are found.
+
+    Directories are walked with ``os.scandir`` in name order, and pruned
+    before they are entered when a name or path matches one of the
+    gitignore-style ``exclude`` globs or, with ``gitignore``, a rule of a
+    ``.gitignore`` in or above the walked tree, up to the enclosing
+    repository's root, or of its ``.git/info/exclude``. Virtual environments
+    below the given paths are always skipped; exclusions never apply to the
+    given paths themselves. Files above ``max_file_size`` bytes are skipped, and a
+    file reached twice, through a symlink or overlapping paths, is yielded
+    once. Symlinked directories are not followed.
+    """
+    exclude_rules = _parse_ignore_rules(exclude)
+    seen = set()  # (device, inode) of every file yielded
+
+    def wanted(key: Tuple[int, int], size: int) -> bool:
+        if key in seen or (max_file_size is not None and size > max_file_size):
+            return False
+        seen.add(key)
+        return True
+
+    for path in paths:
+        try:
+            info = os.stat(path)
+        except OSError:
+            continue
+        if os.path.isfile(path):
+            if path.endswith('.py') and wanted((info.st_dev, info.st_ino), info.st_size):
+                yield path
+            continue
+        if not os.path.isdir(path):
+            continue
+
+        root = path.rstrip(os.sep) or path
+        rulesets = ((root, "", exclude_rules),) if exclude_rules else ()
+        if gitignore:
+            rulesets += _repository_rules(root)
+        stack = [(root, info.st_dev, rulesets)]
+        while stack:
+            directory, device, rulesets = stack.pop()
+            try:
+                with os.scandir(directory) as scan:
+                    entries = sorted(scan, key=lambda entry: entry.name)
+            except OSError:
+                continue
+            names = {entry.name for entry in entries}
+            if "pyvenv.cfg" in names and directory != root:
+                continue
+            if gitignore and ".gitignore" in names:
+                rules = _read_ignore_file(os.path.join(directory, ".gitignore"))
+                if rules:
+                    rulesets += ((directory, "", rules),)
+
+            subdirectories = []
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if not _is_ignored(rulesets, entry.path, entry.name, True):
+                            subdirectories.append(
+                                (entry.path, entry.stat(follow_symlinks=False).st_dev, rulesets))
+                        continue
+                    if not entry.name.endswith('.py') or not entry.is_file() \
+                            or _is_ignored(rulesets, entry.path, entry.name, False):
+                        continue
+                    if entry.is_symlink() or max_file_size is not None:
+                        info = entry.stat()
+                        key, size = (info.st_dev, info.st_ino), info.st_size
+                    else:
+                        # Free on POSIX: the inode comes with the directory listing
+                        key, size = (device, entry.inode()), 0
+                except OSError:
+                    continue
+                if wanted(key, size):
+                    yield entry.path
+            # Depth first in name order: files of a directory, then each subdirectory
+            stack.extend(reversed(subdirectories))
+
+
+def collect_python_files(paths: List[str], exclude: Iterable[str] = DEFAULT_EXCLUDES,
+                         gitignore: bool = True, max_file_size: Optional[int] = None
+                         ) -> List[str]:
+    """Collect all Python files from given paths (see ``iter_python_files``)"""
+    return list(iter_python_files(paths, exclude, gitignore, max_file_size))
+
+
+def _file_stamp(filepath: str) -> Optional[Tuple[int, int]]:
+    try:
+        stat = os.stat(filepath)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+class Watcher:
+    """Keeps the groups of a tree up to date as its files change.
+
+    ``poll`` re-stats the collected files, re-analyzes only the ones whose
+    size or mtime changed and returns the repetitions that appeared,
+    disappeared or changed their instance count since the previous poll.
+    Only the forms found in the changed files' old or new records are
+    regrouped (see ``RepetitionIndex.repetitions_of``), and nothing is when
+    their records came out the same. ``collect`` lists the files under
+    ``paths`` on every poll.
+    """
+
+    def __init__(self, paths: List[str], min_complexity: int = 3, min_repetition: int = 2,
+                 engine: str = "flat", maximal_only: bool = True,
+                 cache_dir: Optional[str] = None,
+                 collect: Callable[[List[str]], List[str]] = collect_python_files):
+        self.paths = paths
+        self.min_complexity = min_complexity
+        self.min_repetition = min_repetition
+        self.maximal_only = maximal_only
+        self.collect = collect
+
+        files = collect(paths)
+        self.stamps = {filepath: _file_stamp(filepath) for filepath in files}
+        self.index = RepetitionIndex(min_complexity, engine)
+        self.index.add_files(files, cache_dir=cache_dir)
+        self.reported = {
+            result.generic_form: result
+            for result in self.index.repetitions(min_complexity, min_repetition, maximal_only)
+        }
+
+    def results(self) -> List[RepetitionResult]:
+        """Every repetition currently in the tree"""
+        return list(self.reported.values())
+
+    def _diff(self, forms: Set[str]
+              ) -> Tuple[List[RepetitionResult], List[RepetitionResult], List[RepetitionResult]]:
+        """Regroup some forms and replace what was reported for them"""
+        current = {
+            result.generic_form: result
+            for result in self.index.repetitions_of(forms, self.min_complexity,
+                                                    self.min_repetition, self.maximal_only)
+        }
+        previous = {form: self.reported.pop(form) for form in forms if form in self.reported}
+        self.reported.update(current)
+        added = [result for form, result in current.items() if form not in previous]
+        removed = [result for form, result in previous.items() if form not in current]
+        changed = [
+            result for form, result in current.items()
+            if form in previous and result.repetition != previous[form].repetition
+        ]
+        return added, removed, changed
+
+    def poll(self) -> Tuple[List[RepetitionResult], List[RepetitionResult], List[RepetitionResult]]:
+        """Pick up changed files; return the (added, removed, changed) repetitions"""
+        files = self.collect(self.paths)
+        touched = set()  # forms of the records that were dropped or added
+        for filepath in set(self.stamps) - set(files):
+            del self.stamps[filepath]
+            if filepath in self.index:
+                touched.update(record.fingerprint for record in self.index.records(filepath))
+                self.index.remove_file(filepath)
+        for filepath in files:
+            stamp = _file_stamp(filepath)
+            if stamp == self.stamps.get(filepath, False):
+                continue
+            self.stamps[filepath] = stamp
+            before = self.index.records(filepath) if filepath in self.index else []
+            # A file that does not parse mid-edit keeps its last good records
+            if filepath in self.index:
+                self.index.update_file(filepath)
+            else:
+                self.index.add_file(filepath)
+            after = self.index.records(filepath) if filepath in self.index else []
+            if after != before:
+                touched.update(record.fingerprint for record in before)
+                touched.update(record.fingerprint for record in after)
+        if not touched:
+            return [], [], []
+        return self._diff(touched)
+
+
+def watch(watcher: Watcher, interval: float = 0.5) -> None:
+    """Print every repetition, then stream what changes until interrupted"""
+    print_results(sort_results(watcher.results()))
+    print(f"Found {len(watcher.results())} repeated patterns; watching for changes...", flush=True)
+    try:
+        while True:
+            time.sleep(interval)
+            added, removed, changed = watcher.poll()
+            for mark, results in (("-", removed), ("~", changed), ("+", added)):
+                for result in sort_results(results):
+                    print(f"{mark} {_format_header(result)}")
+            if added or removed or changed:
+                print(flush=True)
+    except KeyboardInterrupt:
+        pass
+
+
+def query_main(argv: List[str]) -> None:
+    """``repetition-hunter query``: look a code fragment up in a saved index"""
+    parser = argparse.ArgumentParser(prog='repetition-hunter query',
+                                     description='Find every occurrence of a code fragment '
+                                                 'in an index saved with --emit-index')
+    parser.add_argument('snippet', nargs='?',
+                        help='Code to look for; read from stdin when omitted')
+    parser.add_argument('--index', required=True, help='Index file to search')
+    args = parser.parse_args(argv)
+
+    snippet = args.snippet if args.snippet is not None else sys.stdin.read()
+    try:
+        locations = query_index(args.index, snippet)
+    except (SyntaxError, ValueError, sqlite3.Error) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(2)
+
+    for location in locations:
+        print(_format_location(location))
+    if not locations:
+        sys.exit(1)
+
+
+def merge_main(argv: List[str]) -> None:
+    """``repetition-hunter merge``: report the repetitions of several saved indexes"""
+    parser = argparse.ArgumentParser(prog='repetition-hunter merge',
+                                     description='Combine indexes saved with --emit-index, '
+                                                 'e.g. one per --shard, and report their '
+                                                 'repetitions')
+    parser.add_argument('indexes', nargs='+', metavar='INDEX', help='Index files to combine')
+    parser.add_argument('--output', metavar='FILE', help='Also save the combined index to FILE')
+    parser.add_argument('--min-complexity', type=int,
+                        help='Minimum complexity threshold (default: the indexes\' own)')
+    parser.add_argument('--min-repetition', type=int, default=2,
+                        help='Minimum repetition threshold (default: 2)')
+    parser.add_argument('--sort', choices=['complexity', 'repetition'], default='complexity',
+                        help='Sort by complexity or repetition (default: complexity)')
+    parser.add_argument('--no-maximal-only', dest='maximal_only', action='store_false',
+                        help='Also report every nested sub-repetition')
+    args = parser.parse_args(argv)
+
+    try:
+        index = RepetitionIndex.load(args.indexes[0])
+        for path in args.indexes[1:]:
+            index.merge(RepetitionIndex.load(path))
+        if args.output is not None:
+            index.save(args.output)
+        results = index.repetitions(args.min_complexity, args.min_repetition,
+                                    args.maximal_only)
+    except (ValueError, sqlite3.Error) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(2)
+
+    print(f"Merged {len(index)} Python files from {len(args.indexes)} indexes...")
+    if not results:
+        print("No repetitions found")
+        return
+    print_results(sort_results(results, args.sort))
     print(f"Found {len(results)} repeated patterns")
 
 
+def main() -> None:
+    if sys.argv[1:2] == ['query']:
+        query_main(sys.argv[2:])
+        return
+    if sys.argv[1:2] == ['merge']:
+        merge_main(sys.argv[2:])
+        return
+
+    parser = argparse.ArgumentParser(description='Find repetitions in Python code',
+                                     epilog='Run "%(prog)s query --help" to search a saved index and '
+                                            '"%(prog)s merge --help" to combine several.')
+    parser.add_argument('paths', nargs='+', help='Python files or directories to analyze')
+    parser.add_argument('--min-complexity', type=int, default=4, 
+                       help='Minimum complexity threshold (default: 4)')
+    parser.add_argument('--min-repetition', type=int, default=2, 
+                       help='Minimum repetition threshold (default: 2)')
+    parser.add_argument('--sort', choices=['complexity', 'repetition'], default='complexity',
+                       help='Sort by complexity or repetition (default: complexity)')
+    parser.add_argument('--top', type=int, metavar='K',
+                       help='Only rank and show the K best results')
+    parser.add_argument('--format', choices=OUTPUT_FORMATS, default='text',
+                       help='Output format; json, jsonl and sarif are written to stdout '
+                            'one result at a time (default: text)')
+    parser.add_argument('--side-by-side', nargs='?', type=int, const=0, metavar='WIDTH',
+                       help='Show every instance of a repetition in columns, WIDTH characters '
+                            'wide in total (default: the terminal width)')
+    parser.add_argument('--engine', choices=ENGINES, default='flat',
+                       help='Grouping engine; "tree" and "legacy" are slower reference '
+                            'implementations (default: flat)')
+    parser.add_argument('--normalize', type=_parse_levels, default=("names",), metavar='LEVELS',
+                       help='Comma-separated levels to group code at, each also abstracting '
+                            'the ones before it: names (variables), arguments, attributes, '
+                            'constants; results note the level that matched (default: names)')
+    parser.add_argument('--granularity', type=_parse_granularity, metavar='KINDS',
+                       help='Only group nodes of these comma-separated kinds: '
+                            f'{", ".join(GRANULARITIES)} or ast class names such as For '
+                            '(default: every node)')
+    parser.add_argument('--jobs', type=int, default=1,
+                       help='Number of worker processes, 0 for one per CPU (default: 1)')
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR,
+                       help=f'Directory for cached fingerprints (default: {DEFAULT_CACHE_DIR})')
+    parser.add_argument('--no-cache', action='store_true',
+                       help='Analyze every file from scratch and do not touch the cache')
+    parser.add_argument('--max-memory', type=_parse_size, metavar='SIZE',
+                       help='Group on disk to keep memory under SIZE, e.g. 512M or 2G')
+    parser.add_argument('--maximal-only', dest='maximal_only', action='store_true', default=True,
+                       help='Hide repetitions nested inside a larger reported one (default)')
+    parser.add_argument('--no-maximal-only', dest='maximal_only', action='store_false',
+                       help='Also report every nested sub-repetition')
+    parser.add_argument('--exclude', action='append', metavar='GLOB',
+                       help='Skip files and directories matching this gitignore-style glob; '
+                            f'may be given more than once (always skipped: '
+                            f'{", ".join(DEFAULT_EXCLUDES)})')
+    parser.add_argument('--no-gitignore', dest='gitignore', action='store_false',
+                       help='Also analyze files ignored by .gitignore, in the scanned tree '
+                            'or above it up to the repository root')
+    parser.add_argument('--max-file-size', type=_parse_size, metavar='SIZE',
+                       help='Skip files larger than SIZE, e.g. 1M')
+    parser.add_argument('--sequences', action='store_true',
+                       help='Also find runs of statements repeated inside different blocks')
+    parser.add_argument('--min-statements', type=int, default=2,
+                       help='Minimum statements in a repeated run (default: 2)')
+    parser.add_argument('--similarity', type=float, metavar='THRESHOLD',
+                       help='Also cluster functions and classes at least THRESHOLD '
+                            'similar (0-1), e.g. 0.8')
+    parser.add_argument('--emit-index', metavar='FILE',
+                       help='Save the fingerprints of every analyzed file to FILE for '
+                            '"query" and "merge"')
+    parser.add_argument('--reference', action='append', metavar='PATH',
+                       help='Only report code repeated from this library or saved index; '
+                            'may be given more than once')
+    parser.add_argument('--shard', type=_parse_shard, metavar='I/N',
+                       help='Only analyze the I-th of N deterministic slices of the files, '
+                            'e.g. 1/4; combine the --emit-index outputs with "merge"')
+    parser.add_argument('--watch', action='store_true',
+                       help='Keep running and print repetitions that appear or disappear '
+                            'as files change')
+    parser.add_argument('--interval', type=float, default=0.5,
+                       help='Seconds between checks for changed files in --watch mode '
+                            '(default: 0.5)')
+    changed_group = parser.add_mutually_exclusive_group()
+    changed_group.add_argument('--changed-since', metavar='REF',
+                       help='Only report repetitions touching files changed since the '
+                            'merge base with REF, e.g. origin/main')
+    changed_group.add_argument('--changed-files', action='append', metavar='LIST',
+                       help='Only report repetitions touching these comma-separated files')
+    parser.add_argument('--stats', action='store_true',
+                       help='Print phase timings, counters and the costliest files to stderr')
+    parser.add_argument('--stats-json', metavar='FILE',
+                       help='Write the same statistics as JSON to FILE ("-" for stdout, or '
+                            'stderr with a machine-readable --format)')
+    parser.add_argument('--profile', metavar='FILE',
+                       help='Run under cProfile and save the profile to FILE')
+    
+    args = parser.parse_args()
+    if args.top is not None and args.top < 1:
+        parser.error("--top must be at least 1")
+    if args.watch and args.format != 'text':
+        parser.error("--watch only supports --format text")
+    if args.watch:
+        # Watch mode re-scans and reports plain node repetitions only
+        unsupported = [option for option, used in (
+            ('--shard', args.shard is not None), ('--reference', args.reference is not None),
+            ('--sequences', args.sequences), ('--similarity', args.similarity is not None),
+            ('--emit-index', args.emit_index is not None),
+            ('--changed-since', args.changed_since is not None),
+            ('--changed-files', args.changed_files is not None),
+            ('--max-memory', args.max_memory is not None), ('--jobs', args.jobs != 1),
+            ('--top', args.top is not None), ('--side-by-side', args.side_by_side is not None),
+        ) if used]
+        if unsupported:
+            parser.error(f"--watch cannot be combined with {', '.join(unsupported)}")
+    if args.side_by_side is not None and args.format != 'text':
+        parser.error("--side-by-side only applies to --format text")
+    if args.normalize != ("names",) and (args.watch or args.emit_index or args.reference):
+        parser.error("--watch, --emit-index and --reference only support --normalize names")
+    if args.granularity is not None and (args.watch or args.emit_index or args.reference):
+        parser.error("--watch, --emit-index and --reference cannot be combined with "
+                     "--granularity")
+    stats = ScanStats() if args.stats or args.stats_json else None
+    profiler = cProfile.Profile() if args.profile else None
+    if profiler is not None:
+        profiler.enable()
+    try:
+        _scan(args, stats)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+            print(f"Profile saved to {args.profile}", file=sys.stderr)
+        if args.stats:
+            print(stats.format(), file=sys.stderr)
+        if args.stats_json == '-':
+            # Machine-readable results own stdout; the statistics go next to progress
+            print(json.dumps(stats.as_dict(), indent=2),
+                  file=sys.stdout if args.format == 'text' else sys.stderr)
+        elif args.stats_json:
+            with open(args.stats_json, 'w', encoding='utf-8') as f:
+                json.dump(stats.as_dict(), f, indent=2)
+
+
+def _scan(args: argparse.Namespace, stats: Optional[ScanStats]) -> None:
+    """The default command of ``main``: scan, then print what was found"""
+    # Machine-readable formats own stdout; progress goes to stderr
+    status = sys.stdout if args.format == 'text' else sys.stderr
+    discovery = dict(exclude=DEFAULT_EXCLUDES + tuple(args.exclude or ()),
+                     gitignore=args.gitignore, max_file_size=args.max_file_size)
+    # Paths stream straight into analysis unless the whole list is needed first:
+    # for a file count, a second pass, or to time discovery on its own
+    stream = not (args.watch or args.reference or args.sequences or stats is not None
+                  or args.similarity is not None or args.changed_since is not None
+                  or args.changed_files is not None)
+
+    # Collect all Python files
+    with _phase(stats, "discovery"):
+        files = iter_python_files(args.paths, **discovery)
+        if args.shard is not None:
+            files = (filepath for filepath in files if _in_shard(filepath, *args.shard))
+        if stream:
+            first = next(files, None)
+            files = [] if first is None else itertools.chain([first], files)
+        else:
+            files = list(files)
+    
+    # An empty shard still emits its (empty) index for "merge"
+    if not files and args.shard is None:
+        print("No Python files found", file=sys.stderr)
+        sys.exit(1)
+
+    if args.watch:
+        # Watch mode tracks node repetitions only
+        print(f"Analyzing {len(files)} Python files...", file=status)
+        cache_dir = None if args.no_cache else args.cache_dir
+        watcher = Watcher(args.paths, args.min_complexity, args.min_repetition,
+                          engine=args.engine, maximal_only=args.maximal_only,
+                          cache_dir=cache_dir,
+                          collect=partial(collect_python_files, **discovery))
+        watch(watcher, args.interval)
+        return
+    
+    changed_files = None
+    if args.changed_since is not None:
+        # Ask the repository of each scanned path, wherever we were started from
+        directories = dict.fromkeys(
+            path if os.path.isdir(path) else os.path.dirname(os.path.abspath(path))
+            for path in args.paths
+        )
+        try:
+            changed_files = [filepath for directory in directories
+                             for filepath in git_changed_files(args.changed_since, directory)]
+        except (OSError, subprocess.CalledProcessError) as e:
+            stderr = getattr(e, 'stderr', None) or str(e)
+            print(f"Could not list changed files: {stderr.strip()}", file=sys.stderr)
+            sys.exit(1)
+    elif args.changed_files is not None:
+        changed_files = [name for names in args.changed_files for name in names.split(',') if name]
+
+    cache_dir = None if args.no_cache else args.cache_dir
+    reference = None
+    if args.reference:
+        try:
+            reference = load_reference(args.reference, args.min_complexity, args.engine,
+                                       args.jobs, cache_dir)
+        except (ValueError, sqlite3.Error) as e:
+            print(f"Error: {e}", file=sys.stderr)
+            sys.exit(1)
+        print(f"Analyzing {len(files)} Python files against {len(reference)} reference files...",
+              file=status)
+    elif stream:
+        print("Analyzing Python files...", file=status)
+    else:
+        print(f"Analyzing {len(files)} Python files...", file=status)
+    
+    # Find repetitions
+    try:
+        results = find_repetitions(files, args.min_complexity, args.min_repetition,
+                                   engine=args.engine, jobs=args.jobs, cache_dir=cache_dir,
+                                   max_memory=args.max_memory, maximal_only=args.maximal_only,
+                                   sequences=args.sequences, min_statements=args.min_statements,
+                                   similarity=args.similarity, changed_files=changed_files,
+                                   emit_index=args.emit_index, reference=reference,
+                                   hooks=stats, normalize=args.normalize,
+                                   granularity=args.granularity)
+    except ValueError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+    if cache_dir is not None:
+        FingerprintCache(cache_dir).prune()
+    
+    if not results:
+        print("No repetitions found", file=status)
+        if args.format != 'text':
+            write_results(results, args.format)
+        return
+    
+    # Sort and print results
+    with _phase(stats, "sorting"):
+        sorted_results = sort_results(results, args.sort, args.top)
+    with _phase(stats, "printing"):
+        width = args.side_by_side
+        if width == 0:
+            width = shutil.get_terminal_size().columns
+        write_results(sorted_results, args.format, side_by_side_width=width)
+    
+    if len(sorted_results) < len(results):
+        print(f"Found {len(results)} repeated patterns, showing the top {len(sorted_results)}",
+              file=status)
+    else:
+        print(f"Found {len(results)} repeated patterns", file=status)
+
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,24 +1,87 @@
 """Unit tests for repetition_hunter module."""
 
+import argparse
 import ast
+import contextlib
+import copy
+import io
+import json
 import os
+import shutil
+import subprocess
 import tempfile
 import unittest
+from unittest import mock
 
+from python_repetition_hunter import repetition_hunter
 from python_repetition_hunter.repetition_hunter import (
     ASTNormalizer,
+    ast_to_string,
+    FingerprintCache,
+    Location,
+    RepetitionIndex,
     RepetitionResult,
+    ScanHooks,
+    ScanStats,
+    Watcher,
     calculate_complexity,
     collect_python_files,
+    compute_fingerprints,
+    compute_subtree_sizes,
     extract_all_nodes,
     find_repetitions,
+    flatten_tree,
     get_builtin_names,
+    git_changed_files,
+    iter_python_files,
+    load_reference,
+    minhash_signature,
+    lcp_array,
     normalize_ast,
+    normalized_dump,
     parse_python_file,
+    query_index,
+    shard_files,
+    snippet_forms,
     sort_results,
+    suffix_array,
+    tree_similarity,
+    write_results,
 )
 
 
+# Functions of two shapes; written twice under different names they repeat
+LOOP = """
+def {name}(data):
+    result = []
+    for item in data:
+        result.append(item * 2)
+    return result
+"""
+BRANCH = """
+def {name}(value):
+    if value is None:
+        return [value, value + 1]
+    return value
+"""
+
+
+class TempDirMixin:
+    """A temporary directory per test, and ``write`` to create files in it"""
+
+    def setUp(self):
+        super().setUp()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+
+    def write(self, name, code):
+        path = os.path.join(self.tmpdir.name, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(code)
+        return path
+
+
 class TestGetBuiltinNames(unittest.TestCase):
     def test_returns_set(self):
         result = get_builtin_names()
@@ -66,6 +129,58 @@ class TestASTNormalizer(unittest.TestCase):
         self.assertEqual(unparsed.count("x_0"), 3)
 
 
+class TestIterativeTraversal(unittest.TestCase):
+    sample = os.path.join(os.path.dirname(os.path.dirname(__file__)), "test_sample.py")
+    # Deeper than the interpreter's recursion limit, shallower than the parser's
+    depth = 2000
+
+    def deep_source(self):
+        return "def f(a, b):\n    return " + " + ".join(["a", "b"] * (self.depth // 2)) + "\n"
+
+    def deep_tree(self):
+        return ast.parse(self.deep_source())
+
+    def test_matches_recursive_implementations(self):
+        builtin_names = get_builtin_names()
+        with open(self.sample) as f:
+            tree = ast.parse(f.read())
+        for node in extract_all_nodes(tree):
+            self.assertEqual(ast_to_string(node), ast.dump(node))
+            recursive = ast.NodeTransformer.visit(ASTNormalizer(builtin_names),
+                                                  copy.deepcopy(node))
+            self.assertEqual(ast_to_string(normalize_ast(copy.deepcopy(node), builtin_names)),
+                             ast.dump(recursive))
+            self.assertEqual(normalized_dump(node, builtin_names), ast.dump(recursive))
+        self.assertEqual(extract_all_nodes(tree), [
+            node for node in repetition_hunter._preorder_nodes(tree)
+            if not isinstance(node, repetition_hunter._TRIVIAL_NODES)
+        ])
+
+    def test_deep_trees(self):
+        tree = self.deep_tree()
+        builtin_names = get_builtin_names()
+        self.assertGreater(len(extract_all_nodes(tree)), self.depth)
+        form = normalized_dump(tree, builtin_names)
+        self.assertEqual(form.count("x_0"), self.depth // 2)
+        normalized = normalize_ast(tree, builtin_names)
+        self.assertEqual(ast_to_string(normalized), form)
+
+    def test_deep_files_are_analyzed(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            files = []
+            for name in ("a", "b"):
+                path = os.path.join(tmpdir, f"{name}.py")
+                with open(path, "w") as f:
+                    f.write(self.deep_source())
+                files.append(path)
+            for engine in ("flat", "tree"):
+                results = find_repetitions(files, engine=engine)
+                self.assertEqual([result.repetition for result in results], [2])
+            # Legacy dumps every candidate in full, so only check the few largest
+            largest = calculate_complexity(self.deep_tree()) - 10
+            self.assertTrue(repetition_hunter.analyze_file(files[0], largest, "legacy"))
+
+
 class TestParsePythonFile(unittest.TestCase):
     def test_parses_valid_file(self):
         with tempfile.NamedTemporaryFile(
@@ -136,6 +251,65 @@ class TestCalculateComplexity(unittest.TestCase):
         )
 
 
+class TestComputeSubtreeSizes(unittest.TestCase):
+    def test_matches_calculate_complexity(self):
+        code = """
+def f(a, b):
+    if a:
+        return [x * b for x in range(a)]
+    return {"k": (a, b)}
+"""
+        tree = ast.parse(code)
+        sizes = compute_subtree_sizes(tree)
+        for node in ast.walk(tree):
+            self.assertEqual(sizes[node], calculate_complexity(node))
+
+
+class TestFlatTree(unittest.TestCase):
+    code = """
+def f(a, b):
+    c = a + b
+    for i in range(c):
+        a = a * i + b
+    return [a for a in c if a > b]
+
+def g(x, y):
+    z = x + y
+    for i in range(z):
+        x = x * i + y
+    return {x: y for x in z if x > y}
+"""
+
+    def test_arrays_follow_preorder(self):
+        tree = ast.parse(self.code)
+        flat = flatten_tree(tree, get_builtin_names())
+        # Operators and contexts are shared objects, so track parents by position
+        expected = []
+        stack = [(tree, -1)]
+        while stack:
+            node, parent = stack.pop()
+            index = len(expected)
+            expected.append((parent, calculate_complexity(node),
+                             getattr(node, "lineno", 0)))
+            for child in reversed(list(ast.iter_child_nodes(node))):
+                stack.append((child, index))
+        self.assertEqual(
+            list(zip(flat.parents, flat.sizes, flat.linenos)), expected
+        )
+
+    def test_fingerprints_group_like_object_tree(self):
+        tree = ast.parse(self.code)
+        builtin_names = get_builtin_names()
+        nodes = repetition_hunter._preorder_nodes(tree)
+        expected = compute_fingerprints(tree, builtin_names)
+        digests = flatten_tree(tree, builtin_names).fingerprints()
+        for i, a in enumerate(nodes):
+            for j, b in enumerate(nodes):
+                self.assertEqual(
+                    digests[i] == digests[j], expected[a] == expected[b]
+                )
+
+
 class TestNormalizeAst(unittest.TestCase):
     def test_normalizes_variables(self):
         code = "foo = bar + baz"
@@ -146,6 +320,71 @@ class TestNormalizeAst(unittest.TestCase):
         self.assertIsInstance(normalized, ast.AST)
 
 
+class TestComputeFingerprints(unittest.TestCase):
+    def fingerprint_of(self, code):
+        tree = ast.parse(code)
+        stmt = tree.body[0]
+        return compute_fingerprints(tree, get_builtin_names())[stmt]
+
+    def test_renamed_variables_match(self):
+        self.assertEqual(
+            self.fingerprint_of("a = b + a"),
+            self.fingerprint_of("x = y + x"),
+        )
+
+    def test_binding_pattern_matters(self):
+        self.assertNotEqual(
+            self.fingerprint_of("a = b + a"),
+            self.fingerprint_of("x = y + y"),
+        )
+
+    def test_builtins_are_not_renamed(self):
+        self.assertNotEqual(
+            self.fingerprint_of("a = len(b)"),
+            self.fingerprint_of("a = abs(b)"),
+        )
+
+    def test_constant_types_are_distinguished(self):
+        self.assertNotEqual(
+            self.fingerprint_of("a = b + 1"),
+            self.fingerprint_of("a = b + 1.0"),
+        )
+
+    def test_matches_normalized_dump(self):
+        code = """
+def f(a, b):
+    c = a + b
+    for i in range(c):
+        a = a * i + b
+    return [a for a in c if a > b]
+
+def g(x, y):
+    z = x + y
+    for i in range(z):
+        x = x * i + y
+    return [x for x in z if x > y]
+
+def h(x, y):
+    z = x + y
+    for i in range(z):
+        x = y * i + y
+    return [y for y in z if y > x]
+"""
+        tree = ast.parse(code)
+        builtin_names = get_builtin_names()
+        fingerprints = compute_fingerprints(tree, builtin_names)
+        nodes = extract_all_nodes(tree)
+        dumps = {
+            n: ast.dump(normalize_ast(copy.deepcopy(n), builtin_names))
+            for n in nodes
+        }
+        for a in nodes:
+            for b in nodes:
+                self.assertEqual(
+                    fingerprints[a] == fingerprints[b], dumps[a] == dumps[b]
+                )
+
+
 class TestFindRepetitions(unittest.TestCase):
     def test_finds_duplicates(self):
         code1 = """
@@ -215,6 +454,121 @@ def c(): pass
             finally:
                 os.unlink(f.name)
 
+    def test_engines_group_identically(self):
+        sample = os.path.join(
+            os.path.dirname(os.path.dirname(__file__)), "test_sample.py"
+        )
+
+        def groups(engine):
+            results = find_repetitions(
+                [sample], min_complexity=1, min_repetition=2, engine=engine
+            )
+            return sorted(
+                sorted((ln, type(n).__name__, getattr(n, "col_offset", -1))
+                       for _, ln, n in r.original_nodes)
+                for r in results
+            )
+
+        expected = groups("legacy")
+        self.assertEqual(groups("tree"), expected)
+        self.assertEqual(groups("flat"), expected)
+
+    def test_parallel_matches_serial(self):
+        sample = os.path.join(
+            os.path.dirname(os.path.dirname(__file__)), "test_sample.py"
+        )
+        with tempfile.TemporaryDirectory() as tmpdir:
+            copy_path = os.path.join(tmpdir, "copy.py")
+            with open(sample) as src, open(copy_path, "w") as dst:
+                dst.write(src.read())
+
+            def summary(jobs):
+                results = find_repetitions(
+                    [sample, copy_path], min_complexity=3, jobs=jobs
+                )
+                return [
+                    (r.generic_form, r.complexity,
+                     [(fp, ln, ast.dump(n)) for fp, ln, n in r.original_nodes])
+                    for r in results
+                ]
+
+            self.assertEqual(summary(2), summary(1))
+
+    def test_out_of_core_matches_in_memory(self):
+        sample = os.path.join(
+            os.path.dirname(os.path.dirname(__file__)), "test_sample.py"
+        )
+
+        def summary(results):
+            return [
+                (r.generic_form, r.complexity,
+                 [(fp, ln, ast.dump(n)) for fp, ln, n in r.original_nodes])
+                for r in results
+            ]
+
+        expected = summary(find_repetitions([sample], min_complexity=2))
+        # A one-byte budget forces every partition to be split to the limit
+        for max_memory in (1, 10 ** 9):
+            self.assertEqual(
+                summary(find_repetitions(
+                    [sample], min_complexity=2, max_memory=max_memory
+                )),
+                expected,
+            )
+
+    def test_maximal_only_drops_nested_groups(self):
+        code = """
+def func(data):
+    total = 0
+    for item in data:
+        if item > 0:
+            total = total + item * 2
+    return total
+"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            files = []
+            for name in ("a.py", "b.py"):
+                path = os.path.join(tmpdir, name)
+                with open(path, "w") as f:
+                    f.write(code)
+                files.append(path)
+
+            everything = find_repetitions(files, maximal_only=False)
+            maximal = find_repetitions(files)
+            self.assertGreater(len(everything), 1)
+            self.assertEqual(len(maximal), 1)
+            self.assertIsInstance(
+                maximal[0].original_nodes[0][2], ast.Module
+            )
+
+    def test_maximal_only_reports_outermost_match(self):
+        code = """
+def func(data):
+    for item in data:
+        print(item * 2 + 1)
+
+def other(values):
+    for value in values:
+        print(value * 2 + 1)
+    return values
+"""
+        with tempfile.NamedTemporaryFile(
+            mode="w", suffix=".py", delete=False
+        ) as f:
+            f.write(code)
+            f.flush()
+            try:
+                results = find_repetitions([f.name], min_complexity=4)
+            finally:
+                os.unlink(f.name)
+        self.assertEqual(
+            [r.original_nodes[0][1] for r in results], [3]
+        )
+
+    def test_rejects_unknown_engine(self):
+        with self.assertRaises(ValueError):
+            find_repetitions([], engine="bogus")
+
     def test_handles_missing_file(self):
         results = find_repetitions(
             ["/nonexistent/file.py"], min_complexity=1, min_repetition=2
@@ -222,6 +576,1019 @@ def c(): pass
         self.assertEqual(len(results), 0)
 
 
+class TestFingerprintCache(unittest.TestCase):
+    code = """
+def func1(data):
+    result = []
+    for item in data:
+        result.append(item * 2)
+    return result
+
+def func2(items):
+    output = []
+    for element in items:
+        output.append(element * 2)
+    return output
+"""
+
+    def run_cached(self, files, cache_dir):
+        with mock.patch.object(
+            repetition_hunter, "_analyze_file",
+            wraps=repetition_hunter._analyze_file,
+        ) as analyze:
+            results = find_repetitions(files, cache_dir=cache_dir)
+        analyzed = [call[0][0] for call in analyze.call_args_list]
+        return results, analyzed
+
+    def test_rerun_only_analyzes_changed_files(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache_dir = os.path.join(tmpdir, "cache")
+            files = []
+            for name in ("a.py", "b.py"):
+                path = os.path.join(tmpdir, name)
+                with open(path, "w") as f:
+                    f.write(self.code)
+                files.append(path)
+
+            first, analyzed = self.run_cached(files, cache_dir)
+            self.assertEqual(analyzed, files)
+
+            second, analyzed = self.run_cached(files, cache_dir)
+            self.assertEqual(analyzed, [])
+            self.assertEqual(
+                [(r.generic_form, [(fp, ln) for fp, ln, _ in r.original_nodes])
+                 for r in second],
+                [(r.generic_form, [(fp, ln) for fp, ln, _ in r.original_nodes])
+                 for r in first],
+            )
+
+            with open(files[1], "a") as f:
+                f.write("\nx = 1\n")
+            _, analyzed = self.run_cached(files, cache_dir)
+            self.assertEqual(analyzed, [files[1]])
+
+    def test_settings_change_invalidates_entries(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "a.py")
+            with open(path, "w") as f:
+                f.write(self.code)
+            cache_dir = os.path.join(tmpdir, "cache")
+            self.run_cached([path], cache_dir)
+            cache = FingerprintCache(cache_dir, engine="legacy", min_complexity=3)
+            self.assertIsNone(cache.load(path))
+
+    def test_interpreter_change_invalidates_entries(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "a.py")
+            with open(path, "w") as f:
+                f.write(self.code)
+            cache_dir = os.path.join(tmpdir, "cache")
+            self.run_cached([path], cache_dir)
+            with mock.patch.object(repetition_hunter, "_interpreter", return_value="pypy-3.7"):
+                _, analyzed = self.run_cached([path], cache_dir)
+            self.assertEqual(analyzed, [path])
+            _, analyzed = self.run_cached([path], cache_dir)
+            self.assertEqual(analyzed, [path])
+
+    def test_prune_removes_deleted_files(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "a.py")
+            with open(path, "w") as f:
+                f.write(self.code)
+            cache_dir = os.path.join(tmpdir, "cache")
+            self.run_cached([path], cache_dir)
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+
+            cache = FingerprintCache(cache_dir)
+            self.assertEqual(cache.prune(), 0)
+            os.unlink(path)
+            self.assertEqual(cache.prune(), 1)
+            self.assertEqual(os.listdir(cache_dir), [])
+
+    def test_prune_reads_only_new_entries(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            files = []
+            for name in ("a.py", "b.py"):
+                files.append(os.path.join(tmpdir, name))
+                with open(files[-1], "w") as f:
+                    f.write(self.code)
+            cache_dir = os.path.join(tmpdir, "cache")
+            self.run_cached(files[:1], cache_dir)
+            cache = FingerprintCache(cache_dir)
+            cache.prune()
+
+            self.run_cached(files, cache_dir)
+            with mock.patch.object(repetition_hunter.json, "load",
+                                   wraps=repetition_hunter.json.load) as load:
+                self.assertEqual(cache.prune(), 0)
+            # The manifest and the one entry it did not list yet
+            self.assertEqual(load.call_count, 2)
+
+            with mock.patch.object(repetition_hunter.json, "load",
+                                   wraps=repetition_hunter.json.load) as load:
+                os.unlink(files[0])
+                self.assertEqual(cache.prune(), 1)
+            self.assertEqual(load.call_count, 1)
+            self.assertTrue(os.path.exists(cache._entry_path(files[1])))
+
+    def test_unparseable_file_is_not_parsed_again(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "broken.py")
+            with open(path, "w") as f:
+                f.write("def broken(:\n")
+            cache_dir = os.path.join(tmpdir, "cache")
+            with contextlib.redirect_stderr(io.StringIO()):
+                _, analyzed = self.run_cached([path], cache_dir)
+            self.assertEqual(analyzed, [path])
+
+            with contextlib.redirect_stderr(io.StringIO()) as stderr:
+                results, analyzed = self.run_cached([path], cache_dir)
+            self.assertEqual((results, analyzed), ([], []))
+            self.assertIn(f"Error parsing {path}", stderr.getvalue())
+
+            with open(path, "w") as f:
+                f.write(self.code)
+            results, analyzed = self.run_cached([path], cache_dir)
+            self.assertEqual(analyzed, [path])
+            self.assertTrue(results)
+
+
+class TestParseSize(unittest.TestCase):
+    def test_suffixes(self):
+        self.assertEqual(repetition_hunter._parse_size("1024"), 1024)
+        self.assertEqual(repetition_hunter._parse_size("512M"), 512 * 1024 ** 2)
+        self.assertEqual(repetition_hunter._parse_size("2gb"), 2 * 1024 ** 3)
+
+    def test_rejects_garbage(self):
+        with self.assertRaises(argparse.ArgumentTypeError):
+            repetition_hunter._parse_size("lots")
+
+
+class TestSuffixArray(unittest.TestCase):
+    def test_matches_naive_sort(self):
+        for seq in ([3, 1, 2, 1, 2, 1, 0], [5, 5, 5, 5], [1], [],
+                    [2, -1, 2, 3, -2, 2, 3]):
+            expected = sorted(range(len(seq)), key=lambda i: seq[i:])
+            self.assertEqual(suffix_array(seq), expected)
+
+    def test_lcp(self):
+        seq = [1, 2, 1, 2, 3]
+        sa = suffix_array(seq)
+        lcp = lcp_array(seq, sa)
+        for r in range(1, len(seq)):
+            a, b = seq[sa[r - 1]:], seq[sa[r]:]
+            common = 0
+            while common < min(len(a), len(b)) and a[common] == b[common]:
+                common += 1
+            self.assertEqual(lcp[r], common)
+
+
+class TestSequenceRepetitions(unittest.TestCase):
+    code = """
+def mean(items, flag):
+    if flag:
+        return None
+    total = 0
+    count = 0
+    for item in items:
+        total += item
+        count += 1
+    return total / count
+
+
+class Stats:
+    def mean(self, values):
+        try:
+            total = 0
+            count = 0
+            for item in values:
+                total += item
+                count += 1
+            print(total)
+        except ZeroDivisionError:
+            pass
+"""
+
+    def run_sequences(self, **kwargs):
+        with tempfile.NamedTemporaryFile(
+            mode="w", suffix=".py", delete=False
+        ) as f:
+            f.write(self.code)
+            f.flush()
+            try:
+                return find_repetitions([f.name], sequences=True, **kwargs)
+            finally:
+                os.unlink(f.name)
+
+    def test_finds_run_inside_differently_shaped_blocks(self):
+        results = self.run_sequences()
+        runs = [r for r in results if r.kind == "sequence"]
+        self.assertEqual(len(runs), 1)
+        self.assertEqual(runs[0].repetition, 2)
+        self.assertEqual(
+            [(loc.lineno, loc.end_lineno, loc.span) for loc in runs[0].locations],
+            [(5, 9, 3), (16, 20, 3)],
+        )
+        # The for loops are part of the run, so they are not reported again
+        self.assertEqual([r.kind for r in results], ["sequence"])
+
+    def test_min_statements(self):
+        results = self.run_sequences(min_statements=4)
+        self.assertEqual([r for r in results if r.kind == "sequence"], [])
+
+    def test_off_by_default(self):
+        with tempfile.NamedTemporaryFile(
+            mode="w", suffix=".py", delete=False
+        ) as f:
+            f.write(self.code)
+            f.flush()
+            try:
+                results = find_repetitions([f.name])
+            finally:
+                os.unlink(f.name)
+        self.assertTrue(all(r.kind == "node" for r in results))
+
+
+class TestNormalizeLevels(unittest.TestCase):
+    code = """
+def area(shape, scale):
+    width = shape.width * scale
+    height = shape.height * scale
+    return width * height + 1
+
+
+def volume(box, factor):
+    width = box.depth * factor
+    height = box.length * factor
+    return width * height + 2
+
+
+def copy_a(items):
+    return [item * 10 for item in items if item > 0]
+
+
+def copy_b(values):
+    return [value * 10 for value in values if value > 0]
+
+
+handlers = [lambda a, b: a + b * 2, lambda x, y: x + y * 2]
+"""
+    levels = ("names", "arguments", "attributes", "constants")
+
+    def run_levels(self, **kwargs):
+        with tempfile.NamedTemporaryFile(
+            mode="w", suffix=".py", delete=False
+        ) as f:
+            f.write(self.code)
+            f.flush()
+            try:
+                results = find_repetitions([f.name], min_complexity=6, **kwargs)
+            finally:
+                os.unlink(f.name)
+        return sorted(
+            (r.level, r.complexity, [loc.lineno for loc in r.locations])
+            for r in results
+        )
+
+    def test_engines_group_identically_at_every_level(self):
+        tree = ast.parse(self.code)
+        builtin_names = get_builtin_names()
+        nodes = repetition_hunter._preorder_nodes(tree)
+        flat = flatten_tree(tree, builtin_names, self.levels)
+        single_pass = flat.level_fingerprints(self.levels)
+        for level in self.levels:
+            digests = flat.fingerprints(level)
+            self.assertEqual(single_pass[level], digests)
+            fingerprints = compute_fingerprints(tree, builtin_names, level)
+            dumps = [normalized_dump(n, builtin_names, level) for n in nodes]
+            for i, a in enumerate(nodes):
+                for j, b in enumerate(nodes):
+                    self.assertEqual(
+                        digests[i] == digests[j], fingerprints[a] == fingerprints[b]
+                    )
+                    self.assertEqual(digests[i] == digests[j], dumps[i] == dumps[j])
+
+    def test_looser_levels_add_groups(self):
+        self.assertEqual(
+            self.run_levels(normalize=self.levels),
+            [
+                ("arguments", 13, [22, 22]),
+                ("attributes", 11, [3, 4, 9, 10]),
+                ("constants", 10, [5, 11]),
+                ("names", 6, [5, 11]),
+                ("names", 9, [22, 22]),
+                ("names", 17, [15, 19]),
+            ],
+        )
+
+    def test_names_level_by_default(self):
+        self.assertEqual(
+            self.run_levels(),
+            [r for r in self.run_levels(normalize=self.levels) if r[0] == "names"],
+        )
+
+    def test_looser_level_alone(self):
+        # Without the stricter levels, their groups are found at the looser one
+        results = self.run_levels(normalize=["constants"])
+        self.assertEqual({r[0] for r in results}, {"constants"})
+        self.assertIn(("constants", 17, [15, 19]), results)
+
+    def test_level_is_reported(self):
+        result = RepetitionResult(
+            complexity=10, repetition=2,
+            original_nodes=[("a.py", 5, None), ("a.py", 11, None)],
+            generic_form="constants:00", level="constants",
+        )
+        self.assertEqual(
+            repetition_hunter._format_header(result), "[10] 2x (constants): a.py:5, a.py:11"
+        )
+        self.assertEqual(
+            repetition_hunter.result_to_dict(result)["level"], "constants"
+        )
+
+    def test_rejects_bad_levels(self):
+        with self.assertRaises(ValueError):
+            find_repetitions([], normalize=["variables"])
+        with self.assertRaises(ValueError):
+            find_repetitions([], normalize=["names", "constants"], emit_index="x.idx")
+        self.assertEqual(
+            repetition_hunter._parse_levels("constants, names"), ("names", "constants")
+        )
+        with self.assertRaises(argparse.ArgumentTypeError):
+            repetition_hunter._parse_levels("names,literals")
+
+
+class TestGranularity(unittest.TestCase):
+    code = """
+class Reader:
+    def load(self, path):
+        if path:
+            for line in open(path):
+                print(line.strip().lower())
+        return path
+
+
+class Writer:
+    def load(self, path):
+        if path:
+            for line in open(path):
+                print(line.strip().lower())
+        return None
+"""
+
+    def run_granularity(self, granularity, **kwargs):
+        with tempfile.NamedTemporaryFile(
+            mode="w", suffix=".py", delete=False
+        ) as f:
+            f.write(self.code)
+            f.flush()
+            try:
+                results = find_repetitions([f.name], granularity=granularity, **kwargs)
+                # Node types, read before the file goes away
+                return sorted(
+                    (type(r.original_nodes[0][2]).__name__, r.repetition) for r in results
+                )
+            finally:
+                os.unlink(f.name)
+
+    def test_extract_all_nodes(self):
+        tree = ast.parse(self.code)
+        nodes = extract_all_nodes(tree, ["statement"])
+        self.assertTrue(nodes)
+        self.assertTrue(all(isinstance(n, ast.stmt) for n in nodes))
+        self.assertEqual(
+            [type(n).__name__ for n in extract_all_nodes(tree, ["function", "For"])],
+            ["FunctionDef", "For", "FunctionDef", "For"],
+        )
+
+    def test_only_chosen_kinds_are_grouped(self):
+        for engine in ("flat", "tree", "legacy"):
+            self.assertEqual(
+                self.run_granularity(["statement"], engine=engine), [("If", 2)]
+            )
+
+    def test_nesting_skips_nodes_of_other_kinds(self):
+        # The loops sit inside an If, which is not a candidate; they are
+        # still nested inside the reported methods
+        self.assertEqual(self.run_granularity(["For", "FunctionDef"]), [("For", 2)])
+        code, self.code = self.code, self.code.replace("return None", "return path")
+        try:
+            self.assertEqual(
+                self.run_granularity(["For", "FunctionDef"]), [("FunctionDef", 2)]
+            )
+            self.assertEqual(
+                self.run_granularity(["For", "FunctionDef"], maximal_only=False),
+                [("For", 2), ("FunctionDef", 2)],
+            )
+        finally:
+            self.code = code
+
+    def test_rejects_unknown_kinds(self):
+        with self.assertRaises(ValueError):
+            find_repetitions([], granularity=["method"])
+        with self.assertRaises(ValueError):
+            find_repetitions([], granularity=["ast"])
+        self.assertEqual(
+            repetition_hunter._parse_granularity("function, For"), ("For", "function")
+        )
+        with self.assertRaises(argparse.ArgumentTypeError):
+            repetition_hunter._parse_granularity("function,loops")
+
+
+class TestSimilarity(unittest.TestCase):
+    code = """
+def load_config(path, defaults):
+    result = dict(defaults)
+    with open(path) as handle:
+        for line in handle:
+            key, value = line.split("=")
+            result[key.strip()] = value.strip()
+    return result
+
+
+def load_settings(path, defaults):
+    result = dict(defaults)
+    with open(path) as handle:
+        for line in handle:
+            key, value = line.split(":")
+            result[key.strip()] = value.strip().lower()
+    return result
+
+
+def unrelated(a, b):
+    while a < b:
+        a = a * 2 + 1
+    return [a, b]
+"""
+
+    def run_similarity(self, **kwargs):
+        with tempfile.NamedTemporaryFile(
+            mode="w", suffix=".py", delete=False
+        ) as f:
+            f.write(self.code)
+            f.flush()
+            try:
+                return find_repetitions([f.name], **kwargs)
+            finally:
+                os.unlink(f.name)
+
+    def test_tree_similarity(self):
+        self.assertEqual(tree_similarity([1, 2, 3], [1, 2, 3]), 1.0)
+        self.assertEqual(tree_similarity([1, 1, 2], [1, 2, 2]), 0.5)
+        self.assertEqual(tree_similarity([1], [2]), 0.0)
+
+    def test_minhash_estimates_jaccard(self):
+        a = range(0, 2000)
+        b = range(500, 2500)
+        same = sum(x == y for x, y in zip(minhash_signature(a), minhash_signature(b)))
+        self.assertAlmostEqual(same / len(minhash_signature(a)), 0.6, delta=0.15)
+        self.assertEqual(minhash_signature(a), minhash_signature(list(a)))
+
+    def test_clusters_near_miss_functions(self):
+        results = self.run_similarity(similarity=0.5)
+        similar = [r for r in results if r.kind == "similar"]
+        self.assertEqual(len(similar), 1)
+        self.assertEqual([loc.lineno for loc in similar[0].locations], [2, 11])
+        self.assertGreaterEqual(similar[0].similarity, 0.5)
+        self.assertLess(similar[0].similarity, 1.0)
+
+    def test_scored_pairs_grow_subquadratically(self):
+        def pairs(count):
+            # Each function shares all but one statement with the next
+            with tempfile.TemporaryDirectory() as tmpdir:
+                path = os.path.join(tmpdir, "units.py")
+                with open(path, "w") as f:
+                    for number in range(count):
+                        f.write(f"def f{number}(data):\n" + "".join(
+                            f"    data.append(data[{k}] * {k})\n"
+                            for k in range(number, number + 6)) + "\n")
+                stats = ScanStats()
+                results = find_repetitions([path], similarity=0.5, hooks=stats)
+            self.assertTrue([r for r in results if r.kind == "similar"])
+            return stats.counters["similarity_pairs"]
+
+        # Four times the units: quadratic pairing would score sixteen times the pairs
+        self.assertLess(pairs(240), 6 * pairs(60))
+
+    def test_threshold_excludes_weaker_pairs(self):
+        results = self.run_similarity(similarity=0.99)
+        self.assertEqual([r for r in results if r.kind == "similar"], [])
+
+    def test_off_by_default(self):
+        results = self.run_similarity()
+        self.assertEqual([r for r in results if r.kind == "similar"], [])
+
+    def test_rejects_out_of_range_threshold(self):
+        with self.assertRaises(ValueError):
+            self.run_similarity(similarity=1.5)
+
+
+class TestChangedFiles(TempDirMixin, unittest.TestCase):
+    def test_reports_only_groups_touching_changed_files(self):
+        a = self.write("a.py", LOOP.format(name="a") + BRANCH.format(name="b"))
+        b = self.write("b.py", LOOP.format(name="c"))
+        c = self.write("c.py", BRANCH.format(name="d"))
+        files = [a, b, c]
+        everything = find_repetitions(files)
+        changed = find_repetitions(files, changed_files=[b])
+        self.assertEqual(
+            {loc.filepath for r in everything for loc in r.locations}, {a, b, c}
+        )
+        self.assertTrue(changed)
+        for result in changed:
+            self.assertIn(b, [loc.filepath for loc in result.locations])
+        expected = [
+            r.generic_form for r in everything
+            if b in [loc.filepath for loc in r.locations]
+        ]
+        self.assertEqual([r.generic_form for r in changed], expected)
+
+    def test_unchanged_tree_reports_nothing(self):
+        a = self.write("a.py", LOOP.format(name="a"))
+        b = self.write("b.py", LOOP.format(name="b"))
+        self.assertEqual(find_repetitions([a, b], changed_files=[]), [])
+
+    def git(self, *args):
+        subprocess.run(
+            ("git", "-c", "user.name=t", "-c", "user.email=t@t") + args,
+            cwd=self.tmpdir.name, check=True, capture_output=True,
+        )
+
+    @unittest.skipUnless(shutil.which("git"), "git is not installed")
+    def test_git_changed_files(self):
+        git = self.git
+        git("init", "-q")
+        self.write("kept.py", "x = 1\n")
+        self.write("edited.py", "x = 1\n")
+        git("add", ".")
+        git("commit", "-q", "-m", "base")
+        self.write("edited.py", "x = 2\n")
+        self.write("new.py", "x = 3\n")
+        changed = git_changed_files("HEAD", cwd=self.tmpdir.name)
+        self.assertEqual(
+            sorted(os.path.basename(path) for path in changed), ["edited.py", "new.py"]
+        )
+        with self.assertRaises(subprocess.CalledProcessError):
+            git_changed_files("no-such-ref", cwd=self.tmpdir.name)
+
+    @unittest.skipUnless(shutil.which("git"), "git is not installed")
+    def test_changed_since_asks_the_scanned_repository(self):
+        self.git("init", "-q")
+        a = self.write("pkg/a.py", LOOP.format(name="a"))
+        self.write("pkg/b.py", BRANCH.format(name="b"))
+        self.write("pkg/c.py", BRANCH.format(name="c"))
+        self.git("add", ".")
+        self.git("commit", "-q", "-m", "base")
+        new = self.write("pkg/new.py", LOOP.format(name="n"))
+
+        elsewhere = tempfile.TemporaryDirectory()
+        self.addCleanup(elsewhere.cleanup)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(elsewhere.name)
+        stdout = io.StringIO()
+        argv = ["repetition-hunter", "--format", "json", "--no-cache", "--changed-since", "HEAD",
+                os.path.join(self.tmpdir.name, "pkg")]
+        with mock.patch("sys.argv", argv), contextlib.redirect_stdout(stdout):
+            repetition_hunter.main()
+        results = json.loads(stdout.getvalue())
+        self.assertTrue(results)
+        self.assertEqual({loc["path"] for r in results for loc in r["locations"]}, {a, new})
+
+
+class TestWatcher(TempDirMixin, unittest.TestCase):
+    def test_initial_results_match_find_repetitions(self):
+        a = self.write("a.py", LOOP.format(name="a"))
+        self.write("b.py", LOOP.format(name="b") + "\nx = 1\n")
+        watcher = Watcher([self.tmpdir.name])
+        expected = find_repetitions(sorted(watcher.stamps))
+        self.assertEqual(
+            sorted(r.generic_form for r in watcher.results()),
+            sorted(r.generic_form for r in expected),
+        )
+        self.assertEqual(watcher.poll(), ([], [], []))
+        self.assertTrue(os.path.exists(a))
+
+    def test_poll_reports_delta(self):
+        self.write("a.py", LOOP.format(name="a"))
+        watcher = Watcher([self.tmpdir.name])
+        self.assertEqual(watcher.results(), [])
+
+        b = self.write("b.py", LOOP.format(name="b"))
+        added, removed, changed = watcher.poll()
+        self.assertEqual((removed, changed), ([], []))
+        self.assertTrue(added)
+        self.assertEqual({r.repetition for r in added}, {2})
+        forms = {r.generic_form for r in added}
+
+        self.write("c.py", LOOP.format(name="c"))
+        added, removed, changed = watcher.poll()
+        self.assertEqual((added, removed), ([], []))
+        self.assertEqual({r.generic_form for r in changed}, forms)
+        self.assertEqual({r.repetition for r in changed}, {3})
+
+        os.unlink(b)
+        self.write("c.py", "x = 1\n")
+        added, removed, changed = watcher.poll()
+        self.assertEqual((added, changed), ([], []))
+        self.assertEqual({r.generic_form for r in removed}, forms)
+        self.assertEqual(watcher.results(), [])
+
+    def test_poll_regroups_only_changed_forms(self):
+        self.write("a.py", LOOP.format(name="a") + BRANCH.format(name="b"))
+        self.write("b.py", LOOP.format(name="c") + BRANCH.format(name="d"))
+        watcher = Watcher([self.tmpdir.name])
+
+        def current():
+            return sorted((r.generic_form, [(l.filepath, l.index) for l in r.locations])
+                          for r in watcher.results())
+
+        def full():
+            return sorted((r.generic_form, [(l.filepath, l.index) for l in r.locations])
+                          for r in watcher.index.repetitions())
+
+        # The loop alone is nested in both functions until it also stands outside them
+        loop = "for item in data:\n    result.append(item * 2)\n"
+        for code in (loop, loop + BRANCH.format(name="e"), "x = 1\n"):
+            self.write("c.py", code)
+            with mock.patch.object(watcher.index, "repetitions") as repetitions:
+                added, removed, changed = watcher.poll()
+            repetitions.assert_not_called()
+            self.assertTrue(added or removed or changed)
+            self.assertEqual(current(), full())
+
+    def test_poll_skips_unchanged_records(self):
+        a = self.write("a.py", LOOP.format(name="a"))
+        self.write("b.py", LOOP.format(name="b"))
+        watcher = Watcher([self.tmpdir.name])
+        os.utime(a, ns=(0, 0))
+        with mock.patch.object(watcher.index, "repetitions_of") as repetitions_of:
+            self.assertEqual(watcher.poll(), ([], [], []))
+        repetitions_of.assert_not_called()
+
+    def test_unparsable_file_keeps_last_records(self):
+        self.write("a.py", LOOP.format(name="a"))
+        b = self.write("b.py", LOOP.format(name="b"))
+        watcher = Watcher([self.tmpdir.name])
+        before = {r.generic_form for r in watcher.results()}
+        with open(b, "a") as f:
+            f.write("def broken(:\n")
+        with mock.patch("sys.stderr"):
+            self.assertEqual(watcher.poll(), ([], [], []))
+        self.assertEqual({r.generic_form for r in watcher.results()}, before)
+        self.assertTrue(before)
+
+
+class TestRepetitionIndex(TempDirMixin, unittest.TestCase):
+    @staticmethod
+    def forms(results):
+        return [(r.generic_form, [(l.filepath, l.index) for l in r.locations]) for r in results]
+
+    def test_repetitions_of_matches_full_grouping(self):
+        index = RepetitionIndex(min_complexity=2)
+        index.add_files([
+            self.write("a.py", LOOP.format(name="a") + BRANCH.format(name="b")),
+            self.write("b.py", LOOP.format(name="c") + "for item in data:\n    item.pop()\n"),
+            self.write("c.py", BRANCH.format(name="d") + "for x in y:\n    x.pop()\n"),
+        ])
+        forms = {record.fingerprint for path in index.files for record in index.records(path)}
+        for maximal_only in (True, False):
+            self.assertEqual(
+                sorted(self.forms(index.repetitions_of(forms, maximal_only=maximal_only))),
+                sorted(self.forms(index.repetitions(maximal_only=maximal_only))),
+            )
+
+    def test_matches_find_repetitions(self):
+        files = [
+            self.write("a.py", LOOP.format(name="a")),
+            self.write("b.py", LOOP.format(name="b") + BRANCH.format(name="c")),
+            self.write("c.py", BRANCH.format(name="d")),
+        ]
+        index = RepetitionIndex()
+        for filepath in files:
+            self.assertTrue(index.add_file(filepath))
+        self.assertEqual(len(index), 3)
+        self.assertEqual(index.files, files)
+        for min_complexity in (3, 6):
+            self.assertEqual(
+                self.forms(index.repetitions(min_complexity)),
+                self.forms(find_repetitions(files, min_complexity)),
+            )
+        self.assertEqual(self.forms(index), self.forms(index.repetitions()))
+
+    def test_update_and_remove(self):
+        a = self.write("a.py", LOOP.format(name="a"))
+        b = self.write("b.py", "x = 1\n")
+        index = RepetitionIndex()
+        index.add_files([a, b])
+        self.assertEqual(index.repetitions(), [])
+
+        self.write("b.py", LOOP.format(name="b"))
+        self.assertTrue(index.update_file(b))
+        self.assertEqual(self.forms(index), self.forms(find_repetitions([a, b])))
+        self.assertTrue(index.repetitions())
+
+        index.remove_file(b)
+        self.assertNotIn(b, index)
+        self.assertEqual(index.repetitions(), [])
+
+    def test_results_are_memoized_until_a_change(self):
+        a = self.write("a.py", LOOP.format(name="a"))
+        b = self.write("b.py", LOOP.format(name="b"))
+        index = RepetitionIndex()
+        index.add_files([a, b])
+        with mock.patch.object(
+            repetition_hunter, "_group_results", wraps=repetition_hunter._group_results
+        ) as group_results:
+            index.repetitions()
+            list(index)
+            self.assertEqual(group_results.call_count, 1)
+            index.remove_file(a)
+            index.repetitions()
+            self.assertEqual(group_results.call_count, 2)
+
+    def test_errors(self):
+        a = self.write("a.py", LOOP.format(name="a"))
+        index = RepetitionIndex(min_complexity=5)
+        index.add_file(a)
+        with self.assertRaises(ValueError):
+            index.add_file(a)
+        with self.assertRaises(ValueError):
+            index.repetitions(min_complexity=3)
+        with self.assertRaises(KeyError):
+            index.update_file(os.path.join(self.tmpdir.name, "missing.py"))
+        with self.assertRaises(ValueError):
+            RepetitionIndex(engine="nope")
+
+
+class TestQuery(unittest.TestCase):
+    code = """
+def first(data):
+    total = 0
+    for item in data:
+        total += item * 2
+    return total
+
+
+def second(values):
+    acc = 0
+    for value in values:
+        acc += value * 2
+    print(acc + 1)
+"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.path = os.path.join(self.tmpdir.name, "code.py")
+        with open(self.path, "w") as f:
+            f.write(self.code)
+        self.index_path = os.path.join(self.tmpdir.name, "code.idx")
+
+    def test_emit_index_round_trip(self):
+        results = find_repetitions([self.path], emit_index=self.index_path)
+        index = RepetitionIndex.load(self.index_path)
+        self.assertEqual(index.files, [self.path])
+        self.assertEqual(
+            [r.generic_form for r in index.repetitions()],
+            [r.generic_form for r in results],
+        )
+
+    def test_save_matches_emit_index(self):
+        index = RepetitionIndex()
+        index.add_file(self.path)
+        index.save(self.index_path)
+        loaded = RepetitionIndex.load(self.index_path)
+        self.assertEqual(loaded._files, index._files)
+
+    def test_query_statement_ignores_names(self):
+        find_repetitions([self.path], emit_index=self.index_path)
+        locations = query_index(self.index_path, """
+            for thing in stuff:
+                count += thing * 2
+        """)
+        self.assertEqual([loc.lineno for loc in locations], [4, 11])
+
+    def test_query_expression_and_statement_run(self):
+        index = RepetitionIndex(min_complexity=1)
+        index.add_file(self.path)
+        index.save(self.index_path)
+        self.assertEqual(
+            [loc.lineno for loc in query_index(self.index_path, "n * 2")], [5, 12]
+        )
+        run = query_index(self.index_path, "a = 0\nfor b in c:\n    a += b * 2\nreturn a")
+        self.assertEqual([(loc.lineno, loc.end_lineno, loc.span) for loc in run], [(3, 6, 3)])
+        self.assertEqual(index.query("n * 2"), query_index(self.index_path, "n * 2"))
+
+    def test_query_run_ties_variables_across_statements(self):
+        path = os.path.join(self.tmpdir.name, "flow.py")
+        with open(path, "w") as f:
+            f.write("def g(c, f, b):\n    a, b = f(b)\n    c.append(b)\n")
+        index = RepetitionIndex(min_complexity=1)
+        index.add_file(path)
+        index.save(self.index_path)
+        for search in (index.query, lambda snippet: query_index(self.index_path, snippet)):
+            # Only differs in which assigned variable flows into the second statement
+            self.assertEqual(search("a, b = f(b)\nc.append(a)"), [])
+            self.assertEqual([(loc.lineno, loc.end_lineno) for loc in
+                              search("x, y = h(y)\nz.append(y)")], [(2, 3)])
+
+    def test_query_rejects_unindexable_snippets(self):
+        find_repetitions([self.path], min_complexity=4, emit_index=self.index_path)
+        with self.assertRaises(ValueError):
+            query_index(self.index_path, "x")
+        with self.assertRaises(SyntaxError):
+            query_index(self.index_path, "for")
+        with self.assertRaises(ValueError):
+            query_index(self.path, "a + b")
+
+    def test_engines_agree_on_snippet_forms(self):
+        for engine in repetition_hunter.ENGINES:
+            index = RepetitionIndex(engine=engine)
+            index.add_file(self.path)
+            self.assertEqual(
+                [loc.lineno for loc in index.query("for x in y:\n    z += x * 2")], [4, 11]
+            )
+        self.assertEqual(len(snippet_forms("a = 1\nb = 2")), 2)
+
+
+class TestShardsAndMerge(TempDirMixin, unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.files = [
+            self.write(f"m{number}.py", (LOOP if number % 2 else BRANCH).format(name=f"f{number}"))
+            for number in range(8)
+        ]
+
+    def test_shards_partition_files(self):
+        shards = [shard_files(self.files, shard, 3) for shard in (1, 2, 3)]
+        self.assertEqual(sorted(sum(shards, [])), sorted(self.files))
+        self.assertEqual(shard_files(self.files, 2, 3), shards[1])
+        self.assertEqual(shard_files(self.files, 1, 1), self.files)
+
+    def test_parse_shard(self):
+        self.assertEqual(repetition_hunter._parse_shard("2/4"), (2, 4))
+        for text in ("0/4", "5/4", "2", "a/b"):
+            with self.assertRaises(argparse.ArgumentTypeError):
+                repetition_hunter._parse_shard(text)
+
+    def test_merged_shards_match_single_run(self):
+        index = None
+        for shard in (1, 2, 3):
+            path = os.path.join(self.tmpdir.name, f"shard{shard}.idx")
+            find_repetitions(shard_files(self.files, shard, 3), emit_index=path)
+            if index is None:
+                index = RepetitionIndex.load(path)
+            else:
+                index.merge(RepetitionIndex.load(path))
+
+        def groups(results):
+            return sorted(
+                (r.generic_form, sorted((l.filepath, l.index) for l in r.locations))
+                for r in results
+            )
+
+        self.assertEqual(groups(index.repetitions()), groups(find_repetitions(self.files)))
+
+    def test_merge_rejects_different_settings(self):
+        with self.assertRaises(ValueError):
+            RepetitionIndex().merge(RepetitionIndex(min_complexity=5))
+        with self.assertRaises(ValueError):
+            RepetitionIndex().merge(RepetitionIndex(engine="tree"))
+        other = RepetitionIndex()
+        other.interpreter = "pypy-3.7"
+        with self.assertRaises(ValueError):
+            RepetitionIndex().merge(other)
+
+    def test_index_records_interpreter(self):
+        path = os.path.join(self.tmpdir.name, "all.idx")
+        find_repetitions(self.files, emit_index=path)
+        self.assertEqual(RepetitionIndex.load(path).interpreter, repetition_hunter._interpreter())
+        with mock.patch.object(repetition_hunter, "_interpreter", return_value="pypy-3.7"):
+            with self.assertRaises(ValueError):
+                load_reference([path])
+            with self.assertRaises(ValueError):
+                query_index(path, "for x in y:\n    z += x")
+            # Saving keeps the interpreter the records came from
+            index = RepetitionIndex.load(path)
+            index.save(path)
+        self.assertEqual(RepetitionIndex.load(path).interpreter, repetition_hunter._interpreter())
+
+
+class TestReference(TempDirMixin, unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.library = os.path.join(self.tmpdir.name, "library")
+        self.service = os.path.join(self.tmpdir.name, "service")
+        # The library repeats itself; the service copies one library function
+        # and repeats a different one internally
+        self.write("library/lib.py", LOOP.format(name="a") + LOOP.format(name="b"))
+        self.copied = self.write("service/copied.py", LOOP.format(name="c"))
+        self.write("service/own.py", BRANCH.format(name="d") + BRANCH.format(name="e"))
+        self.targets = collect_python_files([self.service])
+
+    def test_reports_only_groups_spanning_both_sides(self):
+        reference = load_reference([self.library])
+        results = find_repetitions(self.targets, reference=reference)
+        self.assertTrue(results)
+        for result in results:
+            dirs = {os.path.dirname(loc.filepath) for loc in result.locations}
+            self.assertEqual(dirs, {self.library, self.service})
+            # Reference instances come first
+            self.assertEqual(os.path.dirname(result.locations[0].filepath), self.library)
+        # The copied loop is found next to both library instances
+        loops = [r for r in results if r.complexity >= 10]
+        self.assertTrue(loops)
+        for result in loops:
+            self.assertEqual(result.repetition, 3)
+            self.assertEqual(result.locations[-1].filepath, self.copied)
+
+    def test_saved_index_matches_sources(self):
+        index_path = os.path.join(self.tmpdir.name, "library.idx")
+        load_reference([self.library], min_complexity=1).save(index_path)
+        from_sources = find_repetitions(self.targets, reference=load_reference([self.library]))
+        from_index = find_repetitions(self.targets, reference=load_reference([index_path]))
+        self.assertEqual(
+            [[(l.filepath, l.index) for l in r.locations] for r in from_index],
+            [[(l.filepath, l.index) for l in r.locations] for r in from_sources],
+        )
+
+    def test_reference_files_are_not_targets(self):
+        reference = load_reference([self.library])
+        self.assertEqual(
+            [r.repetition for r in find_repetitions(self.targets + reference.files,
+                                                    reference=reference)],
+            [r.repetition for r in find_repetitions(self.targets, reference=reference)],
+        )
+
+    def test_rejects_unsupported_combinations(self):
+        reference = load_reference([self.library], min_complexity=5)
+        with self.assertRaises(ValueError):
+            find_repetitions(self.targets, min_complexity=3, reference=reference)
+        with self.assertRaises(ValueError):
+            find_repetitions(self.targets, min_complexity=5, reference=reference, sequences=True)
+
+
+class TestScanStats(TempDirMixin, unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.files = [self.write(f"{name}.py", LOOP.format(name=name)) for name in ("a", "b")]
+
+    def test_collects_phases_counters_and_files(self):
+        stats = ScanStats()
+        results = find_repetitions(self.files, hooks=stats)
+        report = stats.as_dict(top=1)
+        self.assertEqual(set(report["phases"]), {"analysis", "grouping", "subsumption"})
+        counters = report["counters"]
+        self.assertEqual(counters["files"], 2)
+        self.assertEqual(counters["cached_files"], 0)
+        self.assertEqual(counters["results"], len(results))
+        self.assertGreater(counters["nodes"], counters["candidates"])
+        self.assertGreaterEqual(counters["groups"], counters["maximal_groups"])
+        self.assertEqual(
+            counters["bytes_read"], sum(os.path.getsize(path) for path in self.files)
+        )
+        self.assertEqual(len(report["slowest_files"]), 1)
+        self.assertIn("Slowest files:", stats.format())
+
+    def test_cached_files_are_counted_separately(self):
+        cache_dir = os.path.join(self.tmpdir.name, "cache")
+        find_repetitions(self.files, cache_dir=cache_dir)
+        stats = ScanStats()
+        find_repetitions(self.files, cache_dir=cache_dir, hooks=stats)
+        counters = stats.as_dict()["counters"]
+        self.assertEqual((counters["files"], counters["cached_files"]), (2, 2))
+        self.assertEqual(counters["nodes"], 0)
+        self.assertGreater(counters["candidates"], 0)
+
+    def test_stats_json_on_stdout_keeps_machine_output_parseable(self):
+        for fmt in ("json", "sarif"):
+            stdout, stderr = io.StringIO(), io.StringIO()
+            argv = ["repetition-hunter", "--format", fmt, "--stats-json", "-", "--no-cache",
+                    self.tmpdir.name]
+            with mock.patch("sys.argv", argv), contextlib.redirect_stdout(stdout), \
+                    contextlib.redirect_stderr(stderr):
+                repetition_hunter.main()
+            self.assertTrue(json.loads(stdout.getvalue()))
+            self.assertIn('"phases"', stderr.getvalue())
+
+    def test_custom_hooks(self):
+        class Recorder(ScanHooks):
+            def __init__(self):
+                self.events = []
+
+            def phase_started(self, name):
+                self.events.append(("start", name))
+
+            def file_analyzed(self, stats):
+                self.events.append(("file", os.path.basename(stats.filepath)))
+
+        hooks = Recorder()
+        find_repetitions(self.files, jobs=2, maximal_only=False, hooks=hooks)
+        self.assertEqual(hooks.events, [
+            ("start", "analysis"), ("file", "a.py"), ("file", "b.py"), ("start", "grouping"),
+        ])
+
+
 class TestSortResults(unittest.TestCase):
     def setUp(self):
         self.results = [
@@ -244,6 +1611,137 @@ class TestSortResults(unittest.TestCase):
         sorted_results = sort_results(self.results, "repetition")
         self.assertEqual(sorted_results[0].repetition, 10)
 
+    def test_top_matches_full_sort(self):
+        for sort_by in ("complexity", "repetition"):
+            for top in (1, 2, 5):
+                self.assertEqual(
+                    sort_results(iter(self.results), sort_by, top),
+                    sort_results(self.results, sort_by)[:top],
+                )
+
+
+class TestWriteResults(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        files = []
+        for name in ("a", "b"):
+            path = os.path.join(self.tmpdir.name, f"{name}.py")
+            with open(path, "w") as f:
+                f.write(LOOP.format(name=name))
+            files.append(path)
+        self.results = sort_results(find_repetitions(files))
+
+    def write(self, fmt, results=None):
+        stream = io.StringIO()
+        write_results(self.results if results is None else results, fmt, stream)
+        return stream.getvalue()
+
+    def test_json_and_jsonl_agree(self):
+        report = json.loads(self.write("json"))
+        lines = [json.loads(line) for line in self.write("jsonl").splitlines()]
+        self.assertEqual(report, lines)
+        self.assertEqual(len(report), len(self.results))
+        first = report[0]
+        self.assertEqual(first["complexity"], self.results[0].complexity)
+        self.assertEqual(len(first["locations"]), first["repetition"])
+        self.assertIn("for", first["code"])
+
+    def test_empty_reports_are_valid(self):
+        self.assertEqual(json.loads(self.write("json", [])), [])
+        self.assertEqual(self.write("jsonl", []), "")
+        self.assertEqual(json.loads(self.write("sarif", []))["runs"][0]["results"], [])
+
+    def test_sarif(self):
+        log = json.loads(self.write("sarif"))
+        self.assertEqual(log["version"], "2.1.0")
+        results = log["runs"][0]["results"]
+        self.assertEqual(len(results), len(self.results))
+        result = results[0]
+        self.assertEqual(result["ruleId"], "repeated-code")
+        region = result["locations"][0]["physicalLocation"]["region"]
+        self.assertEqual(region["startLine"], self.results[0].locations[0].lineno)
+        self.assertEqual(len(result["relatedLocations"]), self.results[0].repetition - 1)
+
+    def test_writes_while_consuming(self):
+        # Each result is written before the next one is produced
+        stream = io.StringIO()
+        written = []
+
+        def produce():
+            for result in self.results:
+                written.append(len(stream.getvalue()))
+                yield result
+
+        write_results(produce(), "jsonl", stream)
+        self.assertEqual(written, sorted(set(written)))
+
+    def test_text_format(self):
+        self.assertTrue(self.write("text").startswith(f"[{self.results[0].complexity}]"))
+
+
+class TestSnippets(unittest.TestCase):
+    code = """
+class {name}:
+    def run(self, data):
+        total = 0
+        for item in data:  # keep {name}
+            total += item * (
+                2 + item)
+        return total
+"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.files = []
+        for name in ("A", "B"):
+            path = os.path.join(self.tmpdir.name, f"{name}.py")
+            with open(path, "w") as f:
+                f.write(self.code.format(name=name))
+            self.files.append(path)
+        self.top = sort_results(find_repetitions(self.files))[0]
+
+    def render(self, width=None):
+        stream = io.StringIO()
+        write_results([self.top], "text", stream, side_by_side_width=width)
+        return stream.getvalue()
+
+    def test_slices_original_source(self):
+        output = self.render()
+        # Comments and line breaks survive, and the block is dedented
+        self.assertIn("\ndef run(self, data):\n    total = 0\n    for item in data:  # keep A\n",
+                      output)
+        self.assertIn("        total += item * (\n            2 + item)\n", output)
+
+    def test_reads_each_file_once(self):
+        with mock.patch("builtins.open", side_effect=open) as opened:
+            self.render(width=200)
+        self.assertEqual(len(opened.call_args_list), 2)
+
+    @unittest.skipUnless(hasattr(ast, "unparse"), "ast.unparse is 3.9+")
+    def test_falls_back_to_unparse(self):
+        with mock.patch.object(repetition_hunter.SourceCache, "snippet", return_value=None):
+            self.assertIn("total += item * (2 + item)", self.render())
+
+    def test_falls_back_to_dump_without_source(self):
+        with mock.patch.object(repetition_hunter.SourceCache, "snippet", return_value=None), \
+                mock.patch.object(repetition_hunter.ast, "unparse", side_effect=AttributeError,
+                                  create=True):
+            self.assertIn("AugAssign", self.render())
+        os.unlink(self.files[0])
+        self.top.original_nodes.resolver = repetition_hunter.NodeResolver()
+        self.assertIn("<source unavailable>", self.render())
+
+    def test_side_by_side(self):
+        lines = self.render(width=80).splitlines()
+        self.assertTrue(any("# keep A" in line and "# keep B" in line for line in lines))
+        self.assertTrue(all(len(line) <= 80 for line in lines))
+        # Too narrow for two columns: instances are stacked instead
+        narrow = self.render(width=40)
+        self.assertLess(narrow.index("# keep A"), narrow.index("# keep B"))
+        self.assertFalse(any(" | " in line for line in narrow.splitlines()))
+
 
 class TestCollectPythonFiles(unittest.TestCase):
     def test_collects_single_file(self):
@@ -284,6 +1782,104 @@ class TestCollectPythonFiles(unittest.TestCase):
                 os.unlink(f.name)
 
 
+class TestDiscovery(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.root = self.tmpdir.name
+
+    def touch(self, *relatives, content="x = 1\n"):
+        for relative in relatives:
+            path = os.path.join(self.root, relative)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w") as f:
+                f.write(content)
+
+    def found(self, **options):
+        return [
+            os.path.relpath(path, self.root).replace(os.sep, "/")
+            for path in iter_python_files([self.root], **options)
+        ]
+
+    def test_default_excludes_and_virtualenvs(self):
+        self.touch("pkg/a.py", ".git/hooks/b.py", "node_modules/c.py",
+                   "pkg/__pycache__/d.py", "env/lib/e.py", "env/pyvenv.cfg", "venv/f.py")
+        self.assertEqual(self.found(), ["pkg/a.py", "venv/f.py"])
+        # The given path itself is never excluded
+        self.assertEqual(len(collect_python_files([os.path.join(self.root, "node_modules")])), 1)
+
+    def test_exclude_globs(self):
+        self.touch("a.py", "build/b.py", "src/build/c.py", "src/d_test.py", "docs/conf.py",
+                   "src/docs/conf.py")
+        found = self.found(exclude=["build/", "*_test.py", "/docs"])
+        self.assertEqual(found, ["a.py", "src/docs/conf.py"])
+
+    def test_gitignore(self):
+        self.touch("a.py", "gen/b.py", "gen/keep.py", "pkg/c.py", "pkg/out/d.py",
+                   "pkg/e_pb2.py")
+        self.touch(".gitignore", content="# generated\ngen/*\n!gen/keep.py\n")
+        self.touch("pkg/.gitignore", content="out/\n*_pb2.py\n")
+        self.assertEqual(self.found(), ["a.py", "gen/keep.py", "pkg/c.py"])
+        self.assertEqual(len(self.found(gitignore=False)), 6)
+
+    def test_gitignore_above_scanned_path(self):
+        self.touch(".git/info/exclude", content="scratch.py\n")
+        self.touch(".gitignore", content="build/\n/sub/gen/\n")
+        self.touch("sub/a.py", "sub/build/x.py", "sub/gen/y.py", "sub/scratch.py",
+                   "sub/pkg/gen/z.py")
+        sub = os.path.join(self.root, "sub")
+        found = [os.path.relpath(path, sub).replace(os.sep, "/")
+                 for path in iter_python_files([sub])]
+        self.assertEqual(found, ["a.py", "pkg/gen/z.py"])
+        self.assertEqual(len(collect_python_files([sub], gitignore=False)), 5)
+        # Outside a repository only the scanned tree's own files apply
+        shutil.rmtree(os.path.join(self.root, ".git"))
+        self.assertEqual(len(collect_python_files([sub])), 5)
+
+    def test_max_file_size(self):
+        self.touch("small.py")
+        self.touch("big.py", content="x = 1\n" * 100)
+        self.assertEqual(self.found(max_file_size=100), ["small.py"])
+
+    @unittest.skipUnless(hasattr(os, "symlink"), "needs symlinks")
+    def test_symlinks_are_deduplicated(self):
+        self.touch("pkg/a.py")
+        try:
+            os.symlink(os.path.join(self.root, "pkg", "a.py"), os.path.join(self.root, "b.py"))
+            os.symlink(os.path.join(self.root, "pkg"), os.path.join(self.root, "link"))
+        except OSError:
+            self.skipTest("symlinks not permitted")
+        self.assertEqual(self.found(), ["b.py"])
+        # Overlapping paths yield each file once
+        self.assertEqual(len(collect_python_files([self.root, os.path.join(self.root, "pkg")])),
+                         1)
+
+    def test_paths_stream_into_analysis(self):
+        self.touch("a.py", "b.py", content=LOOP.format(name="f"))
+        seen = []
+
+        def discovered():
+            for path in iter_python_files([self.root]):
+                seen.append(path)
+                yield path
+
+        class Recorder(ScanHooks):
+            discovered_before = []
+
+            def file_analyzed(self, stats):
+                self.discovered_before.append(len(seen))
+
+        results = find_repetitions(discovered(), hooks=Recorder())
+        # The first file was analyzed before the second was discovered
+        self.assertEqual(Recorder.discovered_before, [1, 2])
+        self.assertEqual(
+            [(r.complexity, r.repetition) for r in results],
+            [(r.complexity, r.repetition)
+             for r in find_repetitions(collect_python_files([self.root]))],
+        )
+        self.assertTrue(results)
+
+
 class TestRepetitionResult(unittest.TestCase):
     def test_dataclass_fields(self):
         result = RepetitionResult(
@@ -298,6 +1894,58 @@ class TestRepetitionResult(unittest.TestCase):
         self.assertEqual(result.generic_form, "test")
 
 
+class TestLocations(unittest.TestCase):
+    code = """
+def func1(data):
+    result = []
+    for item in data:
+        result.append(item * 2)
+    return result
+
+def func2(items):
+    output = []
+    for element in items:
+        output.append(element * 2)
+    return output
+"""
+
+    def test_results_hold_locations_and_resolve_nodes_lazily(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "a.py")
+            with open(path, "w") as f:
+                f.write(self.code)
+            results = find_repetitions([path], min_complexity=3)
+            self.assertGreater(len(results), 0)
+
+            with mock.patch.object(
+                repetition_hunter, "parse_python_file",
+                wraps=repetition_hunter.parse_python_file,
+            ) as parse:
+                for result in results:
+                    for location in result.locations:
+                        self.assertIsInstance(location, Location)
+                        self.assertEqual(location.filepath, path)
+                        self.assertGreaterEqual(location.end_lineno, location.lineno)
+                self.assertEqual(parse.call_count, 0)
+
+                for result in results:
+                    for (fp, ln, node), location in zip(
+                        result.original_nodes, result.locations
+                    ):
+                        self.assertEqual(ln, node.lineno)
+                        self.assertEqual(location.col_offset, node.col_offset)
+                self.assertEqual(parse.call_count, 1)
+
+    def test_missing_source_resolves_to_none(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "a.py")
+            with open(path, "w") as f:
+                f.write(self.code)
+            results = find_repetitions([path], min_complexity=3)
+            os.unlink(path)
+            self.assertIsNone(results[0].original_nodes[0][2])
+
+
 class TestEdgeCases(unittest.TestCase):
     def test_empty_file(self):
         """Test handling of empty Python files."""